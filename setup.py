@@ -23,7 +23,8 @@ cpp_core = Extension('tomominer.core.core',
                     library_dirs        = ["/usr/usc/gnu/mpc/1.0.1/lib/", "/auto/cmb-04/fa/zfrazier/local/lib64/", ],
                     include_dirs        = [get_include(), '/usr/include', "tomominer/core/src/",],
                     #include_dirs        = [get_include(), '/usr/include', "tomominer/core/src/", "/usr/usc/gnu/mpc/1.0.1/include/", "/auto/rcf-47/zfrazier/local/include/"],
-                    extra_compile_args  = ['-std=c++11'],
+                    extra_compile_args  = ['-std=c++11', '-fopenmp'],
+                    extra_link_args     = ['-fopenmp'],
                     language='c++',
 )
 
@@ -0,0 +1,77 @@
+
+import numpy as np
+
+
+def rotation_matrix(ang):
+  """
+  Rotation matrix of a ZYZ Euler angle, as built by euler_angle::as_rot_matrix()
+  in the core.
+
+  :param ang: ZYZ Euler angle (3 values).
+  :returns: 3x3 array.
+  """
+
+  s1, s2, s3 = np.sin(ang)
+  c1, c2, c3 = np.cos(ang)
+
+  return np.array([[ c1*c2*c3 - s1*s3,  c1*s3 + c2*c3*s1, -c3*s2],
+                   [-c3*s1 - c1*c2*s3,  c1*c3 - c2*s1*s3,  s2*s3],
+                   [ c1*s2,             s1*s2,             c2   ]])
+
+
+def invert_transform(loc, ang):
+  """
+  Invert an alignment transform.  If rotating v2 by (loc, ang) aligns it to
+  v1, rotating v1 by the returned transform aligns it to v2.
+
+  The rotation about the center maps x to (x-c) R + c + loc, so the inverse
+  has rotation R^T, the ZYZ angle (-ang[2], -ang[1], -ang[0]), and shift
+  -R loc.
+
+  :param loc: Displacement (3 values).
+  :param ang: ZYZ Euler angle (3 values).
+  :returns: Tuple (loc, ang) of the inverse transform.
+  """
+
+  loc = np.asarray(loc, dtype=np.float64)
+  ang = np.asarray(ang, dtype=np.float64)
+
+  return -np.dot(rotation_matrix(ang), loc), -ang[::-1]
+
+
+def euler_angles(R):
+  """
+  ZYZ Euler angle of a rotation matrix.  The inverse of rotation_matrix().
+
+  :param R: 3x3 rotation matrix.
+  :returns: Array of 3 angles.
+  """
+
+  s2 = np.hypot(R[2,0], R[2,1])
+
+  if s2 > 1e-9:
+    return np.array([np.arctan2(R[2,1], R[2,0]), np.arctan2(s2, R[2,2]), np.arctan2(R[1,2], -R[0,2])])
+
+  # the two z rotations are about the same axis, put all of it in the first.
+  if R[2,2] > 0:
+    return np.array([np.arctan2(R[0,1], R[0,0]), 0.0, 0.0])
+  return np.array([np.arctan2(-R[0,1], -R[0,0]), np.pi, 0.0])
+
+
+def compose_transforms(loc1, ang1, loc2, ang2):
+  """
+  Compose two alignment transforms.  Rotating a volume by the returned
+  transform is the same as rotating it by (loc1, ang1) and then rotating
+  the result by (loc2, ang2).
+
+  A transform moves the voxel at x to (x-c) R + c + loc, so the
+  composition has rotation R1 R2 and shift loc1 R2 + loc2.
+
+  :returns: Tuple (loc, ang).
+  """
+
+  R1 = rotation_matrix(ang1)
+  R2 = rotation_matrix(ang2)
+
+  loc = np.dot(np.asarray(loc1, dtype=np.float64), R2) + np.asarray(loc2, dtype=np.float64)
+  return loc, euler_angles(np.dot(R1, R2))
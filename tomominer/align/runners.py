@@ -1,12 +1,14 @@
 
 import numpy as np
 
-from tomominer.parallel import Runner
+from tomominer.parallel import get_runner, TomoMinerExecutor, as_completed
+
+from funcs import invert_transform
 
 # TODO: Add real-space rotational alignment runner.
 # See worker function code: real_space_rotation_align()
 
-def all_vs_all_alignment(host, port, data1, data2, L):
+def all_vs_all_alignment(host, port, data1, data2, L, refine=None):
   """
   Given two sets of (v,m) pairs, compute the optimal alignment between all
   members of each group.
@@ -16,31 +18,20 @@ def all_vs_all_alignment(host, port, data1, data2, L):
   :param data1:   First set of (vol,mask) pairs.
   :param data2:   Second set of (vol,mask) pairs.
   :param L:     Discretization of angles to use.  Spacing is 2\pi/L
+  :param refine:  Optional coarse-to-fine search settings, passed to the
+          align worker functions.
 
   :returns:     List of lists.  result[i][j] is the alignment score between
           data1[i] and data2[j], and the transformation necessary to
           align data2[j] to data1[i].
   """
 
-  runner = Runner(host, port)
-
-  tasks = []
-  tracker = {}
-  results = [ [None for _1 in data2] for _2 in data1 ]
-
-  for i, d1 in enumerate(data1):
-    for j, d2 in enumerate(data2):
-      t = runner.make_task('align.align', args=(d1[0], d1[1], d2[0], d2[1], L))
-      tasks.append(t)
-      tracker[t.task_id] = (i,j)
+  with TomoMinerExecutor(host, port) as ex:
+    futures = [[ex.submit('align.align', d1[0], d1[1], d2[0], d2[1], L, refine) for d2 in data2] for d1 in data1]
+    return [[f.result() for f in row] for row in futures]
 
-  for res in runner.run_batch(tasks):
-    i,j = tracker[res.task_id]
-    results[i][j] = res.result
-  return results
 
-
-def one_vs_all_alignment(host, port, target, data, L):
+def one_vs_all_alignment(host, port, target, data, L, refine=None):
   """
   Compute the optimal alignment of all (v,m) pairs in data to the (v,m) pair
   known as target.
@@ -50,35 +41,23 @@ def one_vs_all_alignment(host, port, target, data, L):
   :param target:   A (volume, mask) tuple to compare all elements of data to.
   :param data:   Set of (volume, mask) we will use to compute all distances.
   :param L:    Discretization of angles to use.  Spacing is 2\pi/L
+  :param refine: Optional coarse-to-fine search settings, passed to the
+         align worker functions.
 
   :returns: Dictionary mapping from arguments to the result.
   """
 
-  runner = Runner(host, port)
-  tasks = []
-  tracker = {}
-
   N = len(data)
 
   # TODO: tuning.
   chunk_size = max(5, N / 1000)
 
-  for idx, i in enumerate(range(0,N,chunk_size)):
-    chunk = data[i:i+chunk_size]
-    t = runner.make_task('align.batch_align', args=(target[0], target[1], chunk, L), burst=1)
+  with TomoMinerExecutor(host, port) as ex:
+    futures = [ex.submit('align.batch_align', target[0], target[1], data[i:i+chunk_size], L, refine) for i in range(0,N,chunk_size)]
+    return [r for f in futures for r in f.result()]
 
-    tracker[t.task_id] = idx
-    tasks.append(t)
 
-  results = [None for _ in tasks]
-  for res in runner.run_batch(tasks):
-    results[tracker[res.task_id]] = res.result
-
-  results = [r for b in results for r in b]
-  return results
-
-
-def pairwise_alignment(host, port, data, L):
+def pairwise_alignment(host, port, data, L, refine=None):
   """
   Calculate alignment scores for all vs. all for elements in data.
 
@@ -86,42 +65,38 @@ def pairwise_alignment(host, port, data, L):
   :param port: port of server to submit jobs to
   :param data: (volume, mask) list for all subtomograms
   :param L:  parameter for alignment
+  :param refine: Optional coarse-to-fine search settings, passed to the
+         align worker functions.
 
   :returns:  Only the score of alginments between all elements of data vs
   all other elements.  The result is a numpy matrix of scores.
   """
 
-  runner = Runner(host, port)
-
   # TODO: consider breaking into chunks.  For now do each one seperate.
 
-  tasks = []
-
   corr    = np.eye(len(data), dtype=np.float)
   transform = [[None for y in data] for x in data]
 
-  pos_map = {}
-
-  for i,d1 in enumerate(data):
-    for j,d2 in enumerate(data):
-      if d2 <= d1:
-        continue
-      t = runner.make_task('align.align', args=(d1[0], d1[1], d2[0], d2[1], L))
-      pos_map[t.task_id] = (i,j)
-      tasks.append(t)
-
-  for res in runner.run_batch(tasks):
-    # The (i,j) result is the transform applied to data[j] to align with data[i]
-    i,j = pos_map[res.task_id]
-    score, loc, ang = res.result
-    transform[i][j] = ( loc,  ang)
-    transform[j][i] = (-loc, -ang)
-    corr[i,j] = score
-    corr[j,i] = score
+  with TomoMinerExecutor(host, port) as ex:
+    futures = {}
+    for i,d1 in enumerate(data):
+      for j,d2 in enumerate(data):
+        if d2 <= d1:
+          continue
+        futures[ex.submit('align.align', d1[0], d1[1], d2[0], d2[1], L, refine)] = (i,j)
+
+    for f in as_completed(futures):
+      # The (i,j) result is the transform applied to data[j] to align with data[i]
+      i,j = futures[f]
+      score, loc, ang = f.result()
+      transform[i][j] = (loc, ang)
+      transform[j][i] = invert_transform(loc, ang)
+      corr[i,j] = score
+      corr[j,i] = score
   return corr, transform
 
 
-def align_vols_to_templates(host, port, data, templates, L):
+def align_vols_to_templates(host, port, data, templates, L, refine=None):
   """
   Run align() between a each data element and all templates. Return the best hit to a template for each data element.
 
@@ -130,19 +105,21 @@ def align_vols_to_templates(host, port, data, templates, L):
   :param data:     A list of (volume, mask) pairs of tomograms we are going to align to a set of templates.
   :param templates:  The set of templates we are going to align each subtomogram to.
   :param L:      Angle discretization.  sampling angle is 2\pi/L
+  :param refine:   Optional coarse-to-fine search settings, passed to the
+             align worker functions.
 
   :returns:      List of (args,results) from alignment results.
   """
 
   # TODO: Come up with a better return structure.
 
-  runner = Runner(host, port)
+  runner = get_runner(host, port)
 
   tasks = []
 
   # TODO: break into chunks.
   for d1 in data:
-    t = runner.make_task('align.align_to_templates', args=(d1[0], d1[1], templates, L))
+    t = runner.make_task('align.align_to_templates', args=(d1[0], d1[1], templates, L, refine))
     tasks.append(t)
   results = []
 
@@ -1,10 +1,28 @@
 
 import numpy as np
 
-from tomominer.common import get_mrc
+from tomominer.common import get_mrc, prefetch_vm
+from tomominer.parallel.profiling import phase
 from tomominer import core
 
-def align(v1, m1, v2, m2, L):
+def search(v1, m1, v2, m2, L, refine=None):
+  """
+  Run the alignment search between two loaded volumes.  If refine is given,
+  the coarse-to-fine combined_search_refine() is used in place of
+  combined_search().
+
+  :param refine: None, or a dictionary of keyword arguments for
+  core.combined_search_refine(): n_peaks, ang_tol, max_iter.
+
+  :returns: List of (score, loc, ang) results sorted by decreasing score.
+  """
+  with phase('align_search'):
+    if refine:
+      return core.combined_search_refine(v1, m1, v2, m2, L, **refine)
+    return core.combined_search(v1, m1, v2, m2, L)
+
+
+def align(v1, m1, v2, m2, L, refine=None):
   """
   Align two subtomograms using combined_search function from core.
 
@@ -13,6 +31,7 @@ def align(v1, m1, v2, m2, L):
   :param v2: Second volume
   :param m2: Second mask
   :param L:  Angular resolution to search over, 2*pi/L will be the angles searched
+  :param refine: Optional settings for the coarse-to-fine search.  See search().
 
   :returns: tuple containing (score, location, angle).  The alignment returned
   is the transformation necessary to align the second volume/mask with the
@@ -25,7 +44,7 @@ def align(v1, m1, v2, m2, L):
   m2 = get_mrc(m2)
 
   try:
-    res = core.combined_search(v1, m1, v2, m2, L)
+    res = search(v1, m1, v2, m2, L, refine)
   except:
     res = []
   if res:
@@ -84,7 +103,7 @@ def real_space_rotation_align(v1, m1, v2, m2, L=36):
   # Return correlation/angle
   return (cors[0], angs[0])
 
-def batch_align(v1_key, m1_key, vm_keys, L):
+def batch_align(v1_key, m1_key, vm_keys, L, refine=None):
   """
   Align subtomograms using combined_search function from core.
 
@@ -92,6 +111,7 @@ def batch_align(v1_key, m1_key, vm_keys, L):
   :param m1: First mask
   :param vm_keys: List of (vol_key, mask_key) pairs for second volume.
   :param L:  Angular resolution to search over, 2*pi/L will be the angles searched
+  :param refine: Optional settings for the coarse-to-fine search.  See search().
 
   :returns: list of tuples containing (score, location, angle).  The alignment returned
   is the transformation necessary to align the second volume/mask with the
@@ -103,13 +123,11 @@ def batch_align(v1_key, m1_key, vm_keys, L):
 
   results = []
 
-  for v2_key,m2_key in vm_keys:
-
-    v2 = get_mrc(v2_key)
-    m2 = get_mrc(m2_key)
+  # the next volumes are read while one is aligned.
+  for v2, m2 in prefetch_vm(vm_keys):
 
     try:
-      res = core.combined_search(v1, m1, v2, m2, L)
+      res = search(v1, m1, v2, m2, L, refine)
     except:
       res = []
     if res:
@@ -120,7 +138,7 @@ def batch_align(v1_key, m1_key, vm_keys, L):
       results.append((0.0, np.zeros((3,)), np.zeros((3,))))
   return results
 
-def align_to_templates(v1_key, m1_key, template_dict, L):
+def align_to_templates(v1_key, m1_key, template_dict, L, refine=None):
   """
   Align a subtomogram against a dictionary of templates.  Return the key of
   the best match, and the transformation of the best alignment.
@@ -129,6 +147,7 @@ def align_to_templates(v1_key, m1_key, template_dict, L):
   :param m1: A mask to align
   :param template_dict: A dictionary mapping from keys, to (vol,mask) pairs.
   :param L: Angular resolution.  2*pi/L is the angular discretization.
+  :param refine: Optional settings for the coarse-to-fine search.  See search().
 
   :returns: tuple containing the the key of the best aligning template, and
   the best result. The result is the output of the combined search. (score,
@@ -142,7 +161,7 @@ def align_to_templates(v1_key, m1_key, template_dict, L):
   for tkey in template_dict:
     v2_key,m2_key = template_dict[tkey]
 
-    res = align(v2_key, m2_key, v1_key, m1_key, L)
+    res = align(v2_key, m2_key, v1_key, m1_key, L, refine)
 
     if res[0] > best_score:
       best_score    = res[0]
@@ -2,9 +2,9 @@
 import os
 import numpy as np
 
-from tomominer.parallel import Runner
+from tomominer.parallel import get_runner
 
-def volume_average(host, port, data, vol_shape, pass_dir, use_fft):
+def volume_average(host, port, data, vol_shape, pass_dir, use_fft, fourier_oversample=0):
   """
   Calculate the average volume of a given list of volumes.
 
@@ -14,19 +14,23 @@ def volume_average(host, port, data, vol_shape, pass_dir, use_fft):
   :param vol_shape: Dimensions of a subtomogram (3 element list/vector)
   :param pass_dir:  Temporary directory to stash results in.
   :param use_fft: If true, do the average in FFT space.
+  :param fourier_oversample: If positive and use_fft is set, rotate the
+  volumes directly in Fourier space with this oversampling factor.
 
   :returns: The key to lookup the average volume.
 
   """
 
-  runner = Runner(host, port)
+  runner = get_runner(host, port)
 
   if use_fft:
     map_fn  = "average.vol_avg_fft_map"
     reduce_fn = "average.vol_avg_fft_reduce"
+    map_args = (fourier_oversample,)
   else:
     map_fn  = "average.vol_avg_map"
     reduce_fn = "average.vol_avg_reduce"
+    map_args = ()
 
   # TODO: use heuristic or data from Runner() to determine
 
@@ -44,7 +48,7 @@ def volume_average(host, port, data, vol_shape, pass_dir, use_fft):
   tasks = []
 
   for i in range(0, N, chunk_size):
-    t = runner.make_task(map_fn, args=(data[i:i+chunk_size], vol_shape, pass_dir), max_time=max_time)
+    t = runner.make_task(map_fn, args=(data[i:i+chunk_size], vol_shape, pass_dir) + map_args, max_time=max_time)
     tasks.append(t)
 
   #print "split into %d tasks" % (len(tasks),)
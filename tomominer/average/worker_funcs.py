@@ -3,13 +3,59 @@ import time
 import tempfile
 
 from tomominer import core
-from tomominer.common import get_mrc, put_mrc
+from tomominer.common import put_mrc, prefetch_vmal
+from tomominer.parallel.profiling import phase
 
 import numpy as np
 from numpy.fft import fftn, fftshift, ifftshift, ifftn
 
 
-def vol_avg_fft_map(data, vol_shape, pass_dir):
+def rotated_batches(data, vol_shape, batch_size=16):
+  """
+  Load and rotate volumes and masks in batches with core.rotate_many().  The
+  next batch is read on background threads while one is rotated.
+
+  :param data: A list of (volume, mask, angle, disp) tuples.
+  :param vol_shape: The dimensions of the subtomograms.
+  :param batch_size: Number of volumes rotated in each call.
+
+  :returns: Generator of (vols, masks) arrays of shape vol_shape + (n,).  The
+  arrays are reused between batches, so copy anything that must be kept.
+  """
+
+  shape = tuple(vol_shape) + (batch_size,)
+  vols      = np.empty(shape, dtype=np.float64, order='F')
+  masks     = np.empty(shape, dtype=np.float64, order='F')
+  vols_out  = np.empty(shape, dtype=np.float64, order='F')
+  masks_out = np.empty(shape, dtype=np.float64, order='F')
+
+  loaded = prefetch_vmal(data, depth=batch_size)
+
+  for start in range(0, len(data), batch_size):
+    chunk = data[start:start+batch_size]
+    n = len(chunk)
+
+    for i in range(n):
+      vol, mask, ang, loc = next(loaded)
+      vols[:,:,:,i]  = vol
+      masks[:,:,:,i] = mask
+
+    angs = np.array([_[2] for _ in chunk], dtype=np.float64)
+    locs = np.array([_[3] for _ in chunk], dtype=np.float64)
+
+    # a short final batch uses the leading part of the buffers.
+    with phase('rotate'):
+      if n < batch_size:
+        core.rotate_many(vols[:,:,:,:n], angs, locs, vols_out[:,:,:,:n], 'mean')
+        core.rotate_many(masks[:,:,:,:n], angs, locs, masks_out[:,:,:,:n], 'mask')
+      else:
+        core.rotate_many(vols, angs, locs, vols_out, 'mean')
+        core.rotate_many(masks, angs, locs, masks_out, 'mask')
+
+    yield vols_out[:,:,:,:n], masks_out[:,:,:,:n]
+
+
+def vol_avg_fft_map(data, vol_shape, pass_dir, fourier_oversample=0):
   """
   Local work for computing average of all volumes.  This calculates a sum
   over the given subset of volumes.  Several of these are done and
@@ -20,36 +66,52 @@ def vol_avg_fft_map(data, vol_shape, pass_dir):
   :param vmal_in: The data for incoming data.  A list of (volume, mask, angle, disp) tuples.
   :param v_out_key: The file location to write our local averaged volume to.
   :param m_out_key: The file location to write our local averaged mask to.
+  :param fourier_oversample: If positive, volumes are rotated directly in
+  Fourier space with core.rotate_vol_fft() using this oversampling factor.
   """
 
   # temporary collection of local volume, and mask.
   vol_sum  = np.zeros(vol_shape, dtype=np.complex128, order='F')
   mask_sum = np.zeros(vol_shape, dtype=np.float64,  order='F')
 
-  # iterate over all volumes/masks and incorporate data into averages.
-  # volume_key, mask_key, angle offset, location offset.
-  for vk, mk, ang, loc in data:
+  if fourier_oversample > 0:
+    for vol, mask, ang, loc in prefetch_vmal(data):
+      with phase('rotate_fft'):
+        vol_fft = core.rotate_vol_fft(vol, ang, loc, fourier_oversample)
+        mask    = core.rotate_mask(mask, ang)
 
-    # load vol/mask.
-    vol  = get_mrc(vk)
-    mask = get_mrc(mk)
+      vol_sum  += vol_fft * mask
+      mask_sum += mask
 
+    return _save_map_sums(vol_sum, mask_sum, pass_dir, 'tm_tmp_vafmv_', 'tm_tmp_vafmm_')
 
-    # rotate vol and mask according to angle/loc.
-    vol  = core.rotate_vol_pad_mean(vol, ang, loc)
-    mask = core.rotate_mask(mask, ang)
+  # iterate over all volumes/masks, rotated by their angle/loc, and
+  # incorporate data into averages.
+  for vols, masks in rotated_batches(data, vol_shape):
+    with phase('fft'):
+      for i in range(vols.shape[3]):
+        vol_sum  += (fftshift(fftn(vols[:,:,:,i])) * masks[:,:,:,i])
+    mask_sum += masks.sum(axis=3)
+
+  return _save_map_sums(vol_sum, mask_sum, pass_dir, 'tm_tmp_vafmv_', 'tm_tmp_vafmm_')
 
-    vol_sum  += (fftshift(fftn(vol)) * mask)
-    mask_sum += mask
+
+def _save_map_sums(vol_sum, mask_sum, pass_dir, v_prefix, m_prefix):
+  """
+  Save the partial sums of a map step to temporary files in pass_dir.
+
+  :returns: The volume and mask file names.
+  """
 
   # volume/mask temporary accumulation locations.
-  (v_fh, v_name) = tempfile.mkstemp(prefix='tm_tmp_vafmv_', suffix='.npy', dir=pass_dir)
-  (m_fh, m_name) = tempfile.mkstemp(prefix='tm_tmp_vafmm_', suffix='.npy', dir=pass_dir)
+  (v_fh, v_name) = tempfile.mkstemp(prefix=v_prefix, suffix='.npy', dir=pass_dir)
+  (m_fh, m_name) = tempfile.mkstemp(prefix=m_prefix, suffix='.npy', dir=pass_dir)
   os.close(v_fh)
   os.close(m_fh)
 
-  np.save(v_name, vol_sum)
-  np.save(m_name, mask_sum)
+  with phase('save_npy'):
+    np.save(v_name, vol_sum)
+    np.save(m_name, mask_sum)
 
   return v_name, m_name
 
@@ -98,8 +160,9 @@ def vol_avg_fft_reduce(vm_in, vol_shape, n_vol, pass_dir):
   (m_fh, m_name) = tempfile.mkstemp(prefix='tm_tmp_vafrm_', suffix='.mrc', dir=pass_dir)
   os.close(v_fh)
   os.close(m_fh)
-  core.write_mrc(vol_avg, v_name)
-  core.write_mrc(mask_avg, m_name)
+  with phase('write_mrc'):
+    core.write_mrc(vol_avg, v_name)
+    core.write_mrc(mask_avg, m_name)
 
   return v_name, m_name
 
@@ -121,31 +184,13 @@ def vol_avg_map(data, vol_shape, pass_dir):
   vol_sum  = np.zeros(vol_shape, dtype=np.float64, order='F')
   mask_sum = np.zeros(vol_shape, dtype=np.float64, order='F')
 
-  # iterate over all volumes/masks and incorporate data into averages.
-  # volume_key, mask_key, angle offset, location offset.
-  for vk, mk, ang, loc in data:
-
-    # load vol/mask.
-    vol  = get_mrc(vk)
-    mask = get_mrc(mk)
-
-    # rotate vol and mask according to angle/loc.
-    vol  = core.rotate_vol_pad_mean(vol, ang, loc)
-    mask = core.rotate_mask(mask, ang)
-
-    vol_sum  += vol
-    mask_sum += mask
+  # iterate over all volumes/masks, rotated by their angle/loc, and
+  # incorporate data into averages.
+  for vols, masks in rotated_batches(data, vol_shape):
+    vol_sum  += vols.sum(axis=3)
+    mask_sum += masks.sum(axis=3)
 
-  # volume/mask temporary accumulation locations.
-  (v_fh, v_name) = tempfile.mkstemp(prefix='tm_tmp_vamv_', suffix='.npy', dir=pass_dir)
-  (m_fh, m_name) = tempfile.mkstemp(prefix='tm_tmp_vamm_', suffix='.npy', dir=pass_dir)
-  os.close(v_fh)
-  os.close(m_fh)
-
-  np.save(v_name, vol_sum)
-  np.save(m_name, mask_sum)
-
-  return v_name, m_name
+  return _save_map_sums(vol_sum, mask_sum, pass_dir, 'tm_tmp_vamv_', 'tm_tmp_vamm_')
 
 
 def vol_avg_reduce(vm_in, vol_shape, n_vol, pass_dir):
@@ -187,7 +232,8 @@ def vol_avg_reduce(vm_in, vol_shape, n_vol, pass_dir):
   (m_fh, m_name) = tempfile.mkstemp(prefix='tm_tmp_varm_', suffix='.mrc', dir=pass_dir)
   os.close(v_fh)
   os.close(m_fh)
-  core.write_mrc(vol_avg, v_name)
-  core.write_mrc(mask_avg, m_name)
+  with phase('write_mrc'):
+    core.write_mrc(vol_avg, v_name)
+    core.write_mrc(mask_avg, m_name)
 
   return v_name, m_name
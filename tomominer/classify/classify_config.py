@@ -44,6 +44,33 @@ class config_options:
 
     self.cluster_dimension_reduction_gauss_smoothing_sigma = 0.0
 
+    self.cluster_dimension_reduction_distributed = False
+    """If true, the PCA is done on the workers from partial Gram matrices,
+    and the difference matrix is never collected on one node."""
+
+    self.cluster_dimension_reduction_method = 'empca'
+    """Dimension reduction backend.  'empca' uses weighted EMPCA (or the
+    distributed PCA) on all subtomograms.  'randomized' fits a randomized PCA
+    on a random subset and projects all subtomograms in parallel tasks."""
+
+    self.cluster_dimension_reduction_subset_size = 1000
+    """Number of subtomograms the 'randomized' method is fitted on."""
+
+    self.cluster_dimension_reduction_seed = 0
+    """Random seed of the subset and of the randomized SVD of the
+    'randomized' method."""
+
+    self.cluster_dimension_reduction_warm_start = False
+    """If true, each pass saves its dimension reduction state in pass_dir.
+    The next pass seeds EMPCA with the previous eigenvectors, stopping once
+    they converge, and reuses the previous neighbor covariance if the global
+    average has not moved by more than
+    cluster_dimension_reduction_warm_start_threshold."""
+
+    self.cluster_dimension_reduction_warm_start_threshold = 0.05
+    """Largest relative change of the global average (norm of the change
+    over norm of the previous average) for which the covariance is reused."""
+
     self.cluster_use_fft_avg    = True
     """Use fft averaging when computing cluster centers"""
 
@@ -61,12 +88,39 @@ class config_options:
     """If kmeans is the clustering method, This is the k value used."""
 
     self.cluster_kmeans_iterations  = 10
-    """Number of k-means iterations."""
+    """Number of k-means iterations (passes over the data)."""
+
+    self.cluster_kmeans_restarts    = 3
+    """Number of k-means restarts.  The best clustering is kept."""
+
+    self.cluster_kmeans_batch_size  = 1000
+    """Mini-batch size for k-means.  With fewer subtomograms than this, plain
+    k-means is run."""
+
+    self.cluster_kmeans_distributed = False
+    """If true, the assignment of all subtomograms to the k-means centroids
+    is done on the workers instead of with threads on this node."""
+
+    self.cluster_hierarchical_max_levels = 100
+    """Number of levels of the hierarchical clustering tree (and of the JSB
+    tree of cluster centers) for which the silhouette score is computed,
+    spaced geometrically in the number of clusters.  0 scores every level."""
+
+    self.cluster_hierarchical_silhouette_sample = 0
+    """If positive, the silhouette score is averaged over this many randomly
+    chosen subtomograms instead of all of them."""
 
     self.template_align_corr_threshold = 1.0
     """Filter out templates that are more similar then this to the largest
     cluster center."""
 
+    self.template_overlap_alignment = False
+    """If true, the subtomograms are aligned to every cluster center while
+    the centers are still being averaged and compared, and the alignments to
+    the kept templates are reused.  This overlaps the alignment with the
+    template selection, but aligns to all centers instead of only the kept
+    ones.  If false, they are aligned to the kept templates afterwards."""
+
     self.given_templates = []
     """A list of templates that will be used in addition to those found by
     clustering"""
@@ -74,6 +128,21 @@ class config_options:
     self.L = 36
     """Angle resolution parameter"""
 
+    self.align_refine_ang_tol = 0.0
+    """Angular step (radians) at which local refinement of the coarse
+    alignment peaks stops.  A value of zero disables refinement."""
+
+    self.align_refine_peaks = 5
+    """Number of coarse alignment peaks to refine."""
+
+    self.align_refine_max_iter = 10
+    """Maximum number of refinement sweeps per peak."""
+
+    self.rotation_fourier_oversample = 0
+    """If positive, the FFT averaging and dimension reduction rotate
+    subtomograms directly in Fourier space, zero padding by this factor.
+    Zero uses real space rotation followed by an FFT."""
+
 
   def parse_config(self, opt_file):
     """
@@ -107,6 +176,18 @@ class config_options:
           self.cluster_dimension_reduction_iterations = dim_red['iterations']
         if 'use_fft_avg' in dim_red:
           self.cluster_dimension_reduction_use_fft_avg = dim_red['use_fft_avg']
+        if 'distributed' in dim_red:
+          self.cluster_dimension_reduction_distributed = dim_red['distributed']
+        if 'method' in dim_red:
+          self.cluster_dimension_reduction_method = dim_red['method']
+        if 'subset_size' in dim_red:
+          self.cluster_dimension_reduction_subset_size = dim_red['subset_size']
+        if 'seed' in dim_red:
+          self.cluster_dimension_reduction_seed = dim_red['seed']
+        if 'warm_start' in dim_red:
+          self.cluster_dimension_reduction_warm_start = dim_red['warm_start']
+        if 'warm_start_threshold' in dim_red:
+          self.cluster_dimension_reduction_warm_start_threshold = dim_red['warm_start_threshold']
 
       if 'kmeans' in cluster:
         self.cluster_method = 'kmeans'
@@ -117,10 +198,23 @@ class config_options:
           self.cluster_kmeans_k = kmeans['k']
         if 'iterations' in kmeans:
           self.cluster_kmeans_iterations = kmeans['iterations']
+        if 'restarts' in kmeans:
+          self.cluster_kmeans_restarts = kmeans['restarts']
+        if 'batch_size' in kmeans:
+          self.cluster_kmeans_batch_size = kmeans['batch_size']
+        if 'distributed' in kmeans:
+          self.cluster_kmeans_distributed = kmeans['distributed']
 
       elif 'hierarchical' in cluster:
         self.cluster_method = 'hierarchical'
 
+        hierarchical = cluster['hierarchical']
+
+        if 'max_levels' in hierarchical:
+          self.cluster_hierarchical_max_levels = hierarchical['max_levels']
+        if 'silhouette_sample' in hierarchical:
+          self.cluster_hierarchical_silhouette_sample = hierarchical['silhouette_sample']
+
         # sel.cluster_hierarchical_threshold
       else:
         print cluster
@@ -130,12 +224,28 @@ class config_options:
       template = conf['template']
       if 'align_corr_threshold'  in template:
         self.template_align_corr_threshold = float(template['align_corr_threshold'])
+      if 'overlap_alignment' in template:
+        self.template_overlap_alignment = bool(template['overlap_alignment'])
       if 'given_templates' in template:
         for i in range(len(template['given_templates'])):
           self.given_templates.append(  ( str(template['given_templates'][i][0]),  str(template['given_templates'][i][1]) )  )
 
     if 'L' in conf: self.L = int(conf['L'])
 
+    if 'align' in conf:
+      align = conf['align']
+      if 'refine_ang_tol' in align:
+        self.align_refine_ang_tol = float(align['refine_ang_tol'])
+      if 'refine_peaks' in align:
+        self.align_refine_peaks = int(align['refine_peaks'])
+      if 'refine_max_iter' in align:
+        self.align_refine_max_iter = int(align['refine_max_iter'])
+
+    if 'rotation' in conf:
+      rotation = conf['rotation']
+      if 'fourier_oversample' in rotation:
+        self.rotation_fourier_oversample = int(rotation['fourier_oversample'])
+
 
 def parse_data(conf):
   """
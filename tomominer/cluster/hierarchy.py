@@ -1,47 +1,156 @@
 
-from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance  import pdist, squareform
+import numpy as np
+import scipy.sparse
 
-from sklearn.metrics     import silhouette_score
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance  import pdist
 
 inf = float('inf')
 
-def hierarchical_clustering(data):
+
+def condensed_rows(dist, n, rows):
+  """
+  Rows of the square distance matrix, read from the condensed distance
+  vector returned by pdist(), without building the square matrix.
+
+  :param dist: Condensed distances, length n*(n-1)/2.
+  :param n: Number of observations.
+  :param rows: Indices of the rows to extract.
+  :returns: Array (len(rows), n).
+  """
+
+  j   = np.arange(n)
+  out = np.zeros((len(rows), n))
+  for r, i in enumerate(rows):
+    # pair (a, b) with a < b is at n*a - a*(a+1)/2 + b - a - 1.
+    lo = j[:i]
+    hi = j[i+1:]
+    out[r, :i]   = dist[n*lo - lo*(lo+1)//2 + i - lo - 1]
+    out[r, i+1:] = dist[n*i - i*(i+1)//2 + hi - i - 1]
+  return out
+
+
+def silhouette_samples_rows(dist_rows, rows, labels):
+  """
+  Silhouette coefficient of the observations in rows, given their distances
+  to all observations.  Same definition as sklearn.metrics: 0 for members
+  of single element clusters.
+
+  :param dist_rows: Array (len(rows), n) of distances.
+  :param rows: Indices of the observations in dist_rows.
+  :param labels: Cluster label of all n observations.
+  :returns: Array of silhouette coefficients, one per row.
+  """
+
+  uniq, lab = np.unique(labels, return_inverse=True)
+  n = len(lab)
+  k = len(uniq)
+
+  onehot = scipy.sparse.csr_matrix((np.ones(n), (lab, np.arange(n))), shape=(k, n))
+  sums   = onehot.dot(dist_rows.T).T
+  sizes  = np.bincount(lab, minlength=k).astype(np.float64)
+
+  r   = np.arange(len(rows))
+  own = lab[rows]
+  own_size = sizes[own]
+
+  a = sums[r, own] / np.maximum(own_size - 1, 1)
+
+  means = sums / sizes
+  means[r, own] = inf
+  b = means.min(axis=1)
+
+  s = (b - a) / np.maximum(np.maximum(a, b), 1e-300)
+  s[own_size == 1] = 0.0
+  return s
+
+
+def best_silhouette_cut(link, dist, max_levels=None, sample_size=None, block_size=256, seed=None):
+  """
+  Find the level of the linkage tree whose flat clustering has the best
+  silhouette score.
+
+  Only the condensed distances are used.  They are expanded a block of rows
+  at a time, and each block is scored for every candidate level at once, so
+  the memory used is O(block_size * n) on top of dist.
+
+  :param link: Linkage matrix from scipy.cluster.hierarchy.linkage().
+  :param dist: Condensed distances the linkage was computed from.
+  :param max_levels: If set, only about this many levels are scored,
+  spaced geometrically in the number of clusters.  Otherwise every level is.
+  :param sample_size: If set, the score is the mean silhouette of this many
+  randomly chosen observations, each measured against all observations.
+  Unlike sklearn's silhouette_score(sample_size=...), which scores the
+  sample against the sample only, the cluster distances are not
+  subsampled.
+  :param block_size: Number of distance rows expanded at a time.
+  :param seed: Random seed for the sample.
+
+  :returns: Tuple (labels, score) of the best level.  labels is None if no
+  level has between 2 and n-1 clusters.
+  """
+
+  n = link.shape[0] + 1
+
+  # level i cuts the tree at the height of merge i.  The last merge leaves
+  # a single cluster.
+  levels = np.arange(n-2)
+  if max_levels is not None and len(levels) > max_levels:
+    n_clusters = np.unique(np.round(np.geomspace(2, n-1, max_levels)).astype(int))
+    levels = np.unique(np.clip(n - 1 - n_clusters, 0, n-3))
+
+  candidates = []
+  for i in levels:
+    label = fcluster(link, link[i,2], criterion='distance')
+    k = len(np.unique(label))
+    if 2 <= k < n:
+      candidates.append(label)
+
+  if not candidates:
+    return None, -inf
+
+  if sample_size is not None and sample_size < n:
+    rows = np.sort(np.random.RandomState(seed).choice(n, sample_size, replace=False))
+  else:
+    rows = np.arange(n)
+
+  totals = np.zeros(len(candidates))
+  for start in range(0, len(rows), block_size):
+    block = rows[start:start+block_size]
+    dist_rows = condensed_rows(dist, n, block)
+    for c, label in enumerate(candidates):
+      totals[c] += silhouette_samples_rows(dist_rows, block, label).sum()
+
+  best = int(np.argmax(totals))
+  return candidates[best], totals[best] / len(rows)
+
+
+def hierarchical_clustering(data, max_levels=None, sample_size=None):
   """
   Perform hierarchical clustering on the observation matrix.
 
   First we convert the observations to a distance matrix.  From the distance
   matrix, we compute the entire hierarchical clustering tree, and then walk
   the levels to find the best cutoff according to the silhouette score
-  metric.
+  metric.  See best_silhouette_cut().
 
   :param data: The observation matrix.
-  :returns: The labels of the best clustering found.
+  :param max_levels: Number of levels scored, None for all.
+  :param sample_size: Number of observations the silhouette score is
+  averaged over, None for all.
+  :returns: The labels of the best clustering found, and the condensed
+  distances.
   """
 
   # convert observations to distances, using euclidean metric.
   # dist will be a compressed distance matrix.
   dist  = pdist(data)
-  # Convert the distance matrix to a square matrix.
-  dist_sq = squareform(dist)
 
   # hierarchical clustering from scipy.cluster
   link = linkage(dist)
 
-  # calculate silhouette for each level.  
-  # Find the optimal level according to silhouette_score.
-
-  best_score = -inf
-  best_label = None
-
-  for i in range(link.shape[0]-1):
-    # threshold = link[:,2]
-    label  = fcluster(link, link[i,2], criterion='distance')
-    score  = silhouette_score(dist_sq, label, metric='precomputed')
-
-    if score > best_score:
-      best_score  = score
-      best_label  = label
+  # Find the optimal level according to the silhouette score.
+  best_label, best_score = best_silhouette_cut(link, dist, max_levels, sample_size)
 
   # return the best labels we have found.
-  return best_label, dist_sq
+  return best_label, dist
@@ -1,18 +1,210 @@
 
-# non-parallel k-means.
-def kmeans_clustering(data, k):
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+def whiten(data):
+  """
+  Scale every feature to unit variance, like scipy.cluster.vq.whiten().
+  Constant features are left unscaled.
+
+  :param data: Array (n_obs, n_features).
   """
-  TODO: add docs
 
-  :param data:
-    :param k:
+  std = data.std(axis=0)
+  std[std == 0] = 1.0
+  return data / std
+
+
+def _assign_chunk(data, centroids, c_sq):
+  """
+  Nearest centroid of each row of data, and the squared distance to it.
+  """
+
+  d = np.dot(data, centroids.T)
+  d *= -2
+  d += c_sq
+  labels = np.argmin(d, axis=1)
+  dist = d[np.arange(len(labels)), labels] + np.einsum('ij,ij->i', data, data)
+  return labels, np.maximum(dist, 0)
+
+
+def assign_labels(data, centroids, pool=None, chunk_size=4096):
+  """
+  Assign every row of data to its nearest centroid.  If a pool is given, the
+  rows are split into chunks handled by its threads.  np.dot() releases the
+  GIL, so a ThreadPool gives real parallelism.
+
+  :param data: Array (n_obs, n_features).
+  :param centroids: Array (k, n_features).
+  :param pool: Optional multiprocessing ThreadPool.
+  :param chunk_size: Number of rows per chunk.
+
+  :returns: Tuple (labels, squared distances), each of length n_obs.
+  """
+
+  c_sq = np.einsum('ij,ij->i', centroids, centroids)
+
+  if pool is None or len(data) <= chunk_size:
+    return _assign_chunk(data, centroids, c_sq)
+
+  chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+  res = pool.map(lambda x: _assign_chunk(x, centroids, c_sq), chunks)
+  return np.concatenate([_[0] for _ in res]), np.concatenate([_[1] for _ in res])
+
+
+def _cluster_sums(data, labels, k):
+  """
+  Sum of the rows of data in each of the k clusters, as one matrix product.
+  """
+
+  onehot = np.zeros((k, len(labels)))
+  onehot[labels, np.arange(len(labels))] = 1
+  return np.dot(onehot, data)
+
+
+def kmeans_plusplus(data, k, rng):
+  """
+  k-means++ seeding: each new centroid is a row of data picked with
+  probability proportional to its squared distance to the nearest centroid
+  so far.
+
+  :param data: Array (n_obs, n_features).
+  :param k: Number of centroids.
+  :param rng: np.random.RandomState.
+
+  :returns: Array (k, n_features).
   """
 
-  from scipy.cluster.vq import kmeans, vq, whiten
+  n = len(data)
+  centroids = np.empty((k, data.shape[1]))
+  centroids[0] = data[rng.randint(n)]
+
+  dist = np.sum((data - centroids[0])**2, axis=1)
+  for j in range(1, k):
+    total = dist.sum()
+    if total > 0:
+      i = np.searchsorted(np.cumsum(dist), rng.rand() * total)
+      i = min(i, n-1)
+    else:
+      i = rng.randint(n)
+    centroids[j] = data[i]
+    dist = np.minimum(dist, np.sum((data - centroids[j])**2, axis=1))
+
+  return centroids
+
+
+def minibatch_kmeans(data, k, n_iter=10, batch_size=1000, rng=None, pool=None):
+  """
+  Mini-batch k-means (Sculley, 2010), seeded with k-means++.
+
+  Each of the n_iter iterations is one pass over the data in random batches
+  of batch_size rows.  A centroid moves towards the mean of its rows in the
+  batch with a step size of 1/(number of rows assigned to it so far).  When
+  a single batch covers all the data, this is ordinary (Lloyd) k-means, and
+  stops early once no label changes.
+
+  :param data: Array (n_obs, n_features).
+  :param k: Number of clusters.
+  :param n_iter: Number of passes over the data.
+  :param batch_size: Rows per mini-batch.
+  :param rng: np.random.RandomState.
+  :param pool: Optional ThreadPool for the distance computations.
+
+  :returns: Array of centroids (k, n_features).
+  """
+
+  if rng is None:
+    rng = np.random.RandomState()
+
+  n = len(data)
+  k = min(k, n)
+
+  # seed on a sample, as in other mini-batch implementations.
+  init_size = min(n, max(3 * batch_size, 10 * k))
+  sample = data[rng.choice(n, init_size, replace=False)] if init_size < n else data
+  centroids = kmeans_plusplus(sample, k, rng)
+
+  if batch_size >= n:
+    labels = None
+    for it in range(n_iter):
+      new_labels, _ = assign_labels(data, centroids, pool)
+      if labels is not None and np.array_equal(labels, new_labels):
+        break
+      labels = new_labels
+
+      counts = np.bincount(labels, minlength=k)
+      sums = _cluster_sums(data, labels, k)
+      nonempty = counts > 0
+      centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+    return centroids
+
+  counts = np.zeros(k)
+  for it in range(n_iter):
+    order = rng.permutation(n)
+    for start in range(0, n, batch_size):
+      batch = data[np.sort(order[start:start+batch_size])]
+      labels, _ = assign_labels(batch, centroids, pool)
+
+      batch_counts = np.bincount(labels, minlength=k)
+      sums = _cluster_sums(batch, labels, k)
+
+      hit = batch_counts > 0
+      counts[hit] += batch_counts[hit]
+      # c += (sum(x) - n_b c) / n_total, the per-row update applied at once.
+      centroids[hit] += (sums[hit] - batch_counts[hit, np.newaxis] * centroids[hit]) / counts[hit, np.newaxis]
+
+  return centroids
+
+
+def kmeans_clustering(data, k, n_iter=10, n_init=3, batch_size=1000, n_threads=None, seed=None, assign=None):
+  """
+  Cluster the rows of data with mini-batch k-means, after whitening.
+
+  The best of n_init restarts, by the total squared distance of all rows to
+  their centroids, is kept.
+
+  :param data: Array (n_obs, n_features).
+  :param k: Number of clusters.
+  :param n_iter: Number of passes over the data per restart.
+  :param n_init: Number of restarts.
+  :param batch_size: Rows per mini-batch.
+  :param n_threads: Threads for the distance computations.  None uses all
+  cores, 1 disables threading.
+  :param seed: Random seed.
+  :param assign: Optional function (centroids) -> (labels, squared
+  distances) for the full assignment of the whitened data, e.g. to run it
+  on the workers.  By default it is done here, with threads.
+
+  :returns: Array of labels, one per row.
+  """
+
+  data = whiten(np.asarray(data, dtype=np.float64))
+  rng = np.random.RandomState(seed)
+
+  if n_threads is None:
+    n_threads = multiprocessing.cpu_count()
+  pool = ThreadPool(n_threads) if n_threads > 1 else None
+
+  if assign is None:
+    assign = lambda c: assign_labels(data, c, pool)
 
-  data = whiten(data)
-  centroids, _ = kmeans(data, k)
-  labels,  _ = vq(data, centroids)
+  try:
+    best_labels  = None
+    best_inertia = np.inf
+    for i in range(max(n_init, 1)):
+      centroids = minibatch_kmeans(data, k, n_iter, batch_size, rng, pool)
+      labels, dist = assign(centroids)
 
-  return labels
+      inertia = dist.sum()
+      if inertia < best_inertia:
+        best_labels  = labels
+        best_inertia = inertia
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
 
+  return best_labels
@@ -1,6 +1,8 @@
 from collections import defaultdict
 
+import os
 import sys
+import tempfile
 
 import time
 import random
@@ -10,4 +12,59 @@ import logging
 
 import numpy as np
 
+from math import sqrt
+
 from tomominer.common import get_mrc, put_mrc
+from tomominer.parallel import get_runner
+
+from kmeans import kmeans_clustering, whiten
+
+
+def kmeans_clustering_parallel(host, port, data, k, pass_dir, n_iter=10, n_init=3, batch_size=1000, seed=None):
+  """
+  kmeans_clustering() with the full assignment of the data to the centroids
+  done on the workers.  The mini-batch updates still run here, as they only
+  touch batch_size rows at a time.
+
+  :param host: Host where a tm_server instance is running
+  :param port: Port where a tm_server instance is running
+  :param data: Array (n_obs, n_features).
+  :param k: Number of clusters.
+  :param pass_dir: Temporary file location, readable by the workers.
+
+  See kmeans_clustering() for the other parameters.
+
+  :returns: Array of labels, one per row.
+  """
+
+  runner = get_runner(host, port)
+
+  # whiten here, so the workers see the same data as kmeans_clustering().
+  # whitening again there is a no-op.
+  data = whiten(np.asarray(data, dtype=np.float64))
+
+  (d_fh, data_key) = tempfile.mkstemp(prefix='tm_tmp_kmeans_', suffix='.npy', dir=pass_dir)
+  os.close(d_fh)
+  np.save(data_key, data)
+
+  n = len(data)
+  chunk_size = max(int(sqrt(n)), 4096)
+
+  def assign(centroids):
+    tasks = []
+    task_order = {}
+    for i,idx in enumerate(range(0, n, chunk_size)):
+      t = runner.make_task('cluster.kmeans_assign_partial', args=(data_key, centroids, idx, min(idx+chunk_size, n)))
+      tasks.append(t)
+      task_order[t.task_id] = i
+
+    parts = [None for _ in range(len(tasks))]
+    for res in runner.run_batch(tasks):
+      parts[task_order[res.task_id]] = res.result
+
+    return np.concatenate([_[0] for _ in parts]), np.concatenate([_[1] for _ in parts])
+
+  try:
+    return kmeans_clustering(data, k, n_iter, n_init, batch_size, seed=seed, assign=assign)
+  finally:
+    os.remove(data_key)
@@ -0,0 +1,20 @@
+
+import numpy as np
+
+from kmeans import assign_labels
+
+
+def kmeans_assign_partial(data_key, centroids, start, stop):
+  """
+  Assign rows start:stop of the saved data to their nearest centroids.
+
+  :param data_key: .npy file with the (whitened) data, shape (n_obs, n_features).
+  :param centroids: Array (k, n_features).
+  :param start: First row of the chunk.
+  :param stop: One past the last row of the chunk.
+
+  :returns: Tuple (labels, squared distances) of the chunk.
+  """
+
+  data = np.load(data_key, mmap_mode='r')
+  return assign_labels(np.array(data[start:stop]), centroids)
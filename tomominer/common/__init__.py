@@ -2,8 +2,10 @@
 import runners
 import worker_funcs
 
-from cache import LRUCache, lru_memoize
+from cache import LRUCache, DiskCache, lru_memoize
 from io import *
+from checkpoint import Checkpoint, fingerprint, file_stamp
+from prefetch import prefetch, prefetch_vmal, prefetch_vm
 from utils import *
 
-__all__ = ["runners", "worker_funcs", "LRUCache", "lru_memoize", "get_mrc", "put_mrc", "snr", "fourier_shell_correlation"]
+__all__ = ["runners", "worker_funcs", "LRUCache", "DiskCache", "lru_memoize", "get_mrc", "put_mrc", "configure_mrc_cache", "Checkpoint", "fingerprint", "file_stamp", "prefetch", "prefetch_vmal", "prefetch_vm", "snr", "fourier_shell_correlation"]
@@ -1,10 +1,19 @@
 import sys
+import os
+import errno
+import fcntl
+import hashlib
 import random
+import shutil
+import tempfile
+import time
 
 from collections import OrderedDict
 import functools
 import logging
 
+import numpy as np
+
 class LRUCache:
   """
   LRU Cache (Least Recently Used)
@@ -12,15 +21,21 @@ class LRUCache:
   This cache discards data according to when it was accessed last.  When
   limits are hit (size/count) it discards elements that have been used least
   recently.
+
+  A second tier (for example a DiskCache shared by all processes on the
+  node) can be attached with next_tier.  Values are written through to it,
+  and looked up in it when they are not held here.
   """
 
-  def __init__(self, max_size=None, max_count=None, size_fn=sys.getsizeof):
+  def __init__(self, max_size=None, max_count=None, size_fn=sys.getsizeof, next_tier=None):
     """
     Create the cache, and place limits.
 
     :param max_size: maximum size in bytes of the storage to be used.
     :param max_count: maximum number of objects to be cached
     :param size_fn: the function to be used to calculate the size of cached objects.
+    :param next_tier: optional cache consulted on a miss, and written to on
+    every insert.
 
     The size parameter is only useful in the case that you provide the
     size_fn definition. For any complex objects the builtin getsizeof()
@@ -29,6 +44,10 @@ class LRUCache:
 
     self.od = OrderedDict()
 
+    # size of each element when it was inserted, so the total stays exact
+    # even if size_fn would now give a different answer.
+    self.sizes = {}
+
     if max_size is None:
       self.max_size = float('inf')
     else:
@@ -41,6 +60,11 @@ class LRUCache:
     self.size  = 0
 
     self.size_fn = size_fn
+    self.next_tier = next_tier
+
+    self.hits      = 0
+    self.misses    = 0
+    self.evictions = 0
 
   def __getitem__(self, key):
     """
@@ -58,26 +82,398 @@ class LRUCache:
     Insert a key/value
     """
 
+    self._insert(key, value)
+
+    if self.next_tier is not None:
+      self.next_tier[key] = value
+
+  def _insert(self, key, value):
+    """
+    Insert a key/value in this tier only.
+    """
+
     # remove if already in cache (overwriting does not update position)
     if key in self.od:
-      old_value = self.od.pop(key)
-      self.size -= self.size_fn(old_value)
+      self.od.pop(key)
+      self.size -= self.sizes.pop(key)
+
+    size = self.size_fn(value)
+    # an element larger than the whole cache would only evict everything
+    # else, and then itself.
+    if size > self.max_size or self.max_count < 1:
+      return
 
     # reinsert the element.
     self.od[key] = value
-    self.size += self.size_fn(value)
+    self.sizes[key] = size
+    self.size += size
 
     # apply cache limits.  Drop elements until we are back in compliance.
-    while len(self.od) >= self.max_count or self.size >= self.max_size:
+    while len(self.od) > self.max_count or self.size > self.max_size:
       # popitem(False) for FIFO
       k,v = self.od.popitem(last=False)
-      self.size -= self.size_fn(v)
+      self.size -= self.sizes.pop(k)
+      self.evictions += 1
 
   def __contains__(self, key):
     return key in self.od
 
+  def __len__(self):
+    return len(self.od)
+
+  def get(self, key, default=None):
+    """
+    Look up key, here and then in the next tier.  Hits in the next tier
+    are kept in this one.  Counts hits and misses of this tier.
+
+    :returns: The value, or default if no tier has it.
+    """
+
+    if key in self.od:
+      self.hits += 1
+      return self[key]
+
+    self.misses += 1
+
+    if self.next_tier is not None:
+      value = self.next_tier.get(key, _missing)
+      if value is not _missing:
+        self._insert(key, value)
+        return value
+
+    return default
+
+  def stats(self):
+    """
+    :returns: dict of hits, misses, evictions, bytes and count of this
+    tier, and the stats of the next tier under 'next_tier'.
+    """
+
+    s = dict(hits=self.hits, misses=self.misses, evictions=self.evictions, bytes=self.size, count=len(self.od), max_bytes=self.max_size)
+    if self.next_tier is not None:
+      s['next_tier'] = self.next_tier.stats()
+    return s
+
+
+_missing = object()
+
+
+# fields of the .stats record of a DiskCache.
+_HITS, _MISSES, _EVICTIONS, _BYTES, _COUNT = range(5)
+_N_STATS = 5
+
 
-def lru_memoize(cache=LRUCache()):
+class DiskCache:
+  """
+  LRU cache of numpy arrays kept as .npy files in a directory, shared by
+  every process that opens the same directory.  On /dev/shm (POSIX shared
+  memory) this is a node wide in-memory cache for all workers; on a local
+  disk it is a second tier.
+
+  The file modification time records the last use.  Files are written under
+  a temporary name and renamed, so readers never see partial files.  Reads
+  use copy-on-write memory maps, so a hit in /dev/shm does not copy the
+  data.  An evicted file that is still mapped by a reader stays valid until
+  the reader drops it.
+
+  The total size and number of the files, and the hit/miss/eviction
+  counters, are kept in a small record in the directory, so stats() covers
+  all processes and inserts do not have to list the directory.  The files
+  are only listed when the total goes over max_size; eviction then goes down
+  to low_water * max_size, so that the listing is not repeated on every
+  insert of a full cache.  Each process counts its hits and misses locally
+  and adds them to the record when it next holds the lock, or every
+  flush_every lookups.
+  """
+
+  def __init__(self, path, max_size, next_tier=None, low_water=0.9, flush_every=100, tmp_max_age=3600):
+    """
+    :param path: Directory for the cache.  Created if needed.
+    :param max_size: Maximum total size of the files, in bytes.
+    :param next_tier: Optional DiskCache that evicted files are moved to,
+    and that is consulted on a miss.
+    :param low_water: Fraction of max_size that eviction goes down to.
+    :param flush_every: Number of lookups after which this process adds its
+    hit and miss counts to the shared record.
+    :param tmp_max_age: Age in seconds after which a temporary file is taken
+    to be left over from a killed writer, and removed.
+    """
+
+    self.path = path
+    self.max_size = max_size
+    self.next_tier = next_tier
+    self.low_water = low_water
+    self.flush_every = flush_every
+    self.tmp_max_age = tmp_max_age
+
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self._lock_name  = os.path.join(path, '.lock')
+    self._stats_name = os.path.join(path, '.stats')
+
+    # hits and misses of this process not yet in the record, and the process
+    # they belong to, so a forked child does not count its parent's again.
+    self._pending = [0, 0]
+    self._pending_pid = os.getpid()
+
+    with self._locked():
+      if not os.path.exists(self._stats_name) or os.path.getsize(self._stats_name) != _N_STATS * 8:
+        self._reset_stats()
+
+  def _locked(self):
+    return _FileLock(self._lock_name)
+
+  def _file(self, key):
+    return os.path.join(self.path, hashlib.sha1(repr(key)).hexdigest() + '.npy')
+
+  def _record(self):
+    """
+    The shared .stats record, as a writable memmap.  Hold the lock.
+    """
+
+    return np.memmap(self._stats_name, dtype=np.int64, mode='r+', shape=(_N_STATS,))
+
+  def _reset_stats(self):
+    """
+    Zero the counters, and take the total size and count from the files.
+    Hold the lock.
+    """
+
+    entries = self._entries()
+    c = np.zeros(_N_STATS, dtype=np.int64)
+    c[_BYTES] = sum(e[1] for e in entries)
+    c[_COUNT] = len(entries)
+    c.tofile(self._stats_name)
+
+  def _count(self, i):
+    """
+    Count a hit (i = 0) or a miss (i = 1) of this process.
+    """
+
+    if self._pending_pid != os.getpid():
+      self._pending = [0, 0]
+      self._pending_pid = os.getpid()
+
+    self._pending[i] += 1
+    if sum(self._pending) >= self.flush_every:
+      with self._locked():
+        c = self._record()
+        self._flush_counts(c)
+        c.flush()
+        del c
+
+  def _flush_counts(self, c):
+    """
+    Add the hits and misses of this process to the record c.  Hold the lock.
+    """
+
+    if self._pending_pid != os.getpid():
+      self._pending = [0, 0]
+      self._pending_pid = os.getpid()
+
+    c[_HITS]   += self._pending[0]
+    c[_MISSES] += self._pending[1]
+    self._pending = [0, 0]
+
+  def _entries(self):
+    """
+    :returns: List of (mtime, size, file name) of the cached files, oldest
+    first.  Temporary files still being written are not included.  Those
+    older than tmp_max_age were left by a killed writer, and are removed.
+    """
+
+    entries = []
+    stale = time.time() - self.tmp_max_age
+    for name in os.listdir(self.path):
+      if not name.endswith('.npy'):
+        continue
+      try:
+        st = os.stat(os.path.join(self.path, name))
+        if name.startswith('.tmp_'):
+          if st.st_mtime < stale:
+            os.remove(os.path.join(self.path, name))
+          continue
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    return entries
+
+  def __contains__(self, key):
+    return os.path.exists(self._file(key))
+
+  def get(self, key, default=None):
+    """
+    Look up key, here and then in the next tier.  Hits in the next tier are
+    copied back into this one.
+
+    :returns: The array, or default.
+    """
+
+    name = self._file(key)
+    try:
+      value = np.load(name, mmap_mode='c')
+      os.utime(name, None)
+      self._count(0)
+      return value
+    except (IOError, OSError, ValueError):
+      pass
+
+    self._count(1)
+
+    if self.next_tier is not None:
+      value = self.next_tier.get(key, _missing)
+      if value is not _missing:
+        self._insert(key, value)
+        return value
+
+    return default
+
+  def __getitem__(self, key):
+    value = self.get(key, _missing)
+    if value is _missing:
+      raise KeyError(key)
+    return value
+
+  def __setitem__(self, key, value):
+    self._insert(key, value)
+
+  def _insert(self, key, value):
+    value = np.asanyarray(value)
+    if value.nbytes > self.max_size:
+      return
+
+    (fh, tmp_name) = tempfile.mkstemp(prefix='.tmp_', suffix='.npy', dir=self.path)
+    try:
+      with os.fdopen(fh, 'wb') as f:
+        np.save(f, value)
+      self._add(tmp_name, self._file(key))
+    except:
+      if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+      raise
+
+  def _adopt(self, src, name):
+    """
+    Move a file evicted from a higher tier into this one.
+    """
+
+    tmp_name = os.path.join(self.path, '.tmp_' + name)
+    shutil.move(src, tmp_name)
+    self._add(tmp_name, os.path.join(self.path, name))
+
+  def _add(self, tmp_name, name):
+    """
+    Rename the complete file tmp_name to name, account for it in the record,
+    and evict if the total is now over max_size.
+    """
+
+    size = os.path.getsize(tmp_name)
+
+    with self._locked():
+      try:
+        old_size = os.path.getsize(name)
+      except OSError:
+        old_size = None
+      os.rename(tmp_name, name)
+
+      c = self._record()
+      self._flush_counts(c)
+      if old_size is None:
+        c[_COUNT] += 1
+      else:
+        c[_BYTES] -= old_size
+      c[_BYTES] += size
+      if c[_BYTES] > self.max_size:
+        self._evict(c)
+      c.flush()
+      del c
+
+  def _evict(self, c):
+    """
+    Remove (or move to the next tier) the least recently used files until
+    the total size is within low_water * max_size, and take the total size
+    and count in the record c from the listing.  Hold the lock.
+    """
+
+    entries = self._entries()
+    total = sum(e[1] for e in entries)
+    count = len(entries)
+
+    evicted = 0
+    for mtime, size, name in entries:
+      if total <= self.low_water * self.max_size:
+        break
+      src = os.path.join(self.path, name)
+      try:
+        if self.next_tier is not None:
+          self.next_tier._adopt(src, name)
+        else:
+          os.remove(src)
+      except (IOError, OSError):
+        logging.warning("could not evict %s from the cache", src)
+        continue
+      total -= size
+      count -= 1
+      evicted += 1
+
+    c[_BYTES] = total
+    c[_COUNT] = count
+    c[_EVICTIONS] += evicted
+
+  def clear(self):
+    """
+    Remove all cached files, and reset the counters.
+    """
+
+    with self._locked():
+      for mtime, size, name in self._entries():
+        os.remove(os.path.join(self.path, name))
+      self._pending = [0, 0]
+      self._reset_stats()
+
+  def stats(self):
+    """
+    :returns: dict of hits, misses, evictions (over all processes), bytes
+    and count of this tier, and the stats of the next tier under
+    'next_tier'.
+    """
+
+    with self._locked():
+      c = self._record()
+      self._flush_counts(c)
+      c.flush()
+      c = np.array(c)
+
+    s = dict(hits=int(c[_HITS]), misses=int(c[_MISSES]), evictions=int(c[_EVICTIONS]), bytes=int(c[_BYTES]), count=int(c[_COUNT]), max_bytes=self.max_size, path=self.path)
+    if self.next_tier is not None:
+      s['next_tier'] = self.next_tier.stats()
+    return s
+
+
+class _FileLock:
+  """
+  Exclusive flock() on a file, as a context manager.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.f = open(self.name, 'a')
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+
+def lru_memoize(cache=None):
   """
   A memoization decorator.
 
@@ -87,32 +483,36 @@ def lru_memoize(cache=LRUCache()):
   given cache.
 
   :param cache: The cache to use for key/value storage of function parameters
-  and function results.
+  and function results.  By default each decorated function gets its own
+  unbounded LRUCache.
   """
 
   def decorating_function(user_function):
 
+    c = LRUCache() if cache is None else cache
+
     @functools.wraps(user_function)
     def wrapper(*args, **kwargs):
       key = args + tuple(sorted(kwargs.items()))
 
-      if key in cache:
+      value = c.get(key, _missing)
+      if value is not _missing:
         wrapper.hits += 1
-        value = cache[key]
-        logging.debug("Cache hit. key = %s, count = %d, size = %d, total hit = %d, total miss = %d" % (key, len(cache.od), cache.size, wrapper.hits, wrapper.misses))
+        logging.debug("Cache hit. key = %s, count = %d, size = %d, total hit = %d, total miss = %d" % (key, len(c), c.size, wrapper.hits, wrapper.misses))
       else:
         value = user_function(*args, **kwargs)
         wrapper.misses += 1
-        cache[key] = value
-        logging.debug("Cache hit. key = %s, count = %d, size = %d, total hit = %d, total miss = %d" % (key, len(cache.od), cache.size, wrapper.hits, wrapper.misses))
+        c[key] = value
+        logging.debug("Cache miss. key = %s, count = %d, size = %d, total hit = %d, total miss = %d" % (key, len(c), c.size, wrapper.hits, wrapper.misses))
       return value
     wrapper.hits   = 0
     wrapper.misses = 0
+    wrapper.cache  = c
     return wrapper
   return decorating_function
 
 if __name__ == '__main__':
-  
+
   logging.basicConfig(level=logging.DEBUG)
 
   cache = LRUCache(max_size = 20*24)
@@ -134,4 +534,3 @@ if __name__ == '__main__':
   for i in range(1000):
     f(random.randint(0,5), random.randint(0,5))
     print i, f.hits, f.misses, cache.size
-
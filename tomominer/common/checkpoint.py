@@ -0,0 +1,167 @@
+
+import os
+import json
+import hashlib
+import pickle
+import tempfile
+import logging
+
+import numpy as np
+
+
+def file_stamp(path):
+  """
+  Identify the contents of a file by its path, size and modification time,
+  without reading it.
+
+  :returns: Tuple (absolute path, size, mtime), or (absolute path, None,
+  None) if the file does not exist.
+  """
+
+  path = os.path.abspath(path)
+  try:
+    st = os.stat(path)
+  except OSError:
+    return (path, None, None)
+  return (path, st.st_size, st.st_mtime)
+
+
+def _canonical(x):
+  """
+  Convert x to something json.dumps() gives a stable string for.  Tuples
+  and lists are the same, as are small numpy arrays and lists.  Large arrays
+  are replaced by a hash of their data.
+  """
+
+  if isinstance(x, np.ndarray):
+    if x.size <= 64:
+      return _canonical(x.tolist())
+    return ['ndarray', x.dtype.str, list(x.shape), hashlib.sha1(np.ascontiguousarray(x).data).hexdigest()]
+  if isinstance(x, np.generic):
+    return x.item()
+  if isinstance(x, (list, tuple)):
+    return [_canonical(_) for _ in x]
+  if isinstance(x, dict):
+    return [[_canonical(k), _canonical(v)] for k,v in sorted(x.items())]
+  return x
+
+
+def fingerprint(*inputs):
+  """
+  Hash of the inputs of a computation.  Inputs may be nested lists, tuples
+  and dicts of numbers, strings and numpy arrays.  File contents are not
+  read: pass file_stamp(path) to include a file.
+
+  :returns: Hex digest string.
+  """
+
+  return hashlib.sha1(json.dumps(_canonical(inputs), sort_keys=True)).hexdigest()
+
+
+def _write_atomic(name, obj):
+  (fh, tmp_name) = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(os.path.abspath(name)))
+  try:
+    with os.fdopen(fh, 'wb') as f:
+      pickle.dump(obj, f, protocol=2)
+    os.rename(tmp_name, name)
+  except:
+    if os.path.exists(tmp_name):
+      os.remove(tmp_name)
+    raise
+
+
+def _read(name):
+  try:
+    with open(name, 'rb') as f:
+      return pickle.load(f)
+  except (IOError, OSError, EOFError, pickle.UnpicklingError):
+    return None
+
+
+def _files_unchanged(stamps):
+  return all(file_stamp(s[0]) == tuple(s) for s in stamps)
+
+
+def stamp(path, fp):
+  """
+  Record that the file at path was computed from inputs with fingerprint
+  fp, in path + '.fingerprint'.
+  """
+
+  _write_atomic(path + '.fingerprint', dict(fingerprint=fp, files=[file_stamp(path)]))
+
+
+def is_current(path, fp):
+  """
+  :returns: True if the file at path was stamped with fingerprint fp and
+  has not changed since.
+  """
+
+  rec = _read(path + '.fingerprint')
+  return rec is not None and rec['fingerprint'] == fp and _files_unchanged(rec['files'])
+
+
+class Checkpoint:
+  """
+  Results of the stages of a computation, saved in a directory together with
+  the fingerprint of their inputs, so that an interrupted run can resume.
+  A stage is only skipped when its saved fingerprint matches, and the files
+  it produced are still there and unchanged.
+
+  A stage's fingerprint should include the fingerprints of the stages it
+  depends on, so a change of input invalidates everything downstream of it.
+  """
+
+  def __init__(self, directory, suffix=''):
+    """
+    :param directory: Where the results are saved.
+    :param suffix: Appended to the stage names to form the file names, e.g.
+    the pass number.
+    """
+
+    self.directory = directory
+    self.suffix = suffix
+
+  def _file(self, name):
+    return os.path.join(self.directory, 'checkpoint_%s%s.pkl' % (name, self.suffix))
+
+  def load(self, name, fp):
+    """
+    :returns: Tuple (found, result).  found is False if the stage has no
+    current checkpoint.
+    """
+
+    rec = _read(self._file(name))
+    if rec is None or rec['fingerprint'] != fp or not _files_unchanged(rec['files']):
+      return False, None
+    logging.info("Stage %s: reusing checkpoint %s", name, self._file(name))
+    return True, rec['result']
+
+  def save(self, name, fp, result, files=()):
+    """
+    Save the result of a stage.
+
+    :param files: Files written by the stage.  The checkpoint is invalid if
+    any of them changes.
+    """
+
+    _write_atomic(self._file(name), dict(fingerprint=fp, files=[file_stamp(f) for f in files], result=result))
+
+  def run(self, name, fp, fn, files=None):
+    """
+    Return the saved result of stage name if it is current, otherwise call
+    fn() and save its result.
+
+    :param fp: Fingerprint of the stage inputs.
+    :param fn: Function with no arguments computing the stage.
+    :param files: Optional function of the result giving the files written
+    by the stage.  See save().
+    """
+
+    found, result = self.load(name, fp)
+    if found:
+      return result
+
+    result = fn()
+    self.save(name, fp, result, files(result) if files is not None else ())
+    return result
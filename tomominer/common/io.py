@@ -3,31 +3,84 @@
 import os
 import tempfile
 import logging
+import threading
 
 import numpy as np
 from numpy.fft import fftn, fftshift, ifftshift, ifftn
 
 from tomominer import core
-from tomominer.common import cache, lru_memoize, LRUCache
+from tomominer.common.cache import LRUCache, DiskCache
+from tomominer.parallel.profiling import phase, count
 
 GB = 1024 * 1024 * 1024
 mrc_cache = LRUCache(max_size=1*GB, size_fn = lambda x: x.nbytes)
 
-# Use the cache to shorten load times of the request function which parses the
-# objects from disk.
-@lru_memoize(mrc_cache)
+# get_mrc() is called from the prefetch threads, and the cache is not
+# thread safe.  The lock is not held while a file is read.
+_mrc_cache_lock = threading.Lock()
+
+def configure_mrc_cache(local_size=1*GB, shm_size=0, shm_dir='/dev/shm/tomominer_cache', ssd_dir=None, ssd_size=0):
+  """
+  Set up the tiers of the cache used by get_mrc().
+
+  The first tier is private to the process.  With shm_size > 0, a DiskCache
+  in shm_dir (POSIX shared memory) is shared by all processes on the node,
+  and a volume read by one worker is a hit for all the others.  With
+  ssd_dir and ssd_size > 0, volumes evicted from shared memory move to a
+  DiskCache on local disk.
+
+  :param local_size: Size in bytes of the per-process tier.
+  :param shm_size: Size in bytes of the shared memory tier, 0 for none.
+  :param shm_dir: Directory of the shared memory tier.
+  :param ssd_dir: Directory of the local disk tier, None for none.
+  :param ssd_size: Size in bytes of the local disk tier.
+
+  :returns: The new cache.
+  """
+
+  global mrc_cache
+
+  next_tier = None
+  if ssd_dir is not None and ssd_size > 0:
+    next_tier = DiskCache(ssd_dir, ssd_size)
+  if shm_size > 0:
+    next_tier = DiskCache(shm_dir, shm_size, next_tier)
+
+  mrc_cache = LRUCache(max_size=local_size, size_fn = lambda x: x.nbytes, next_tier=next_tier)
+  return mrc_cache
+
 def get_mrc(path):
   """
   Load a subtomogram or mask in MRC format from the filesystem.  The
-  mrc_cache decorator, is used to cache previously loaded results.  If
+  mrc_cache is used to cache previously loaded results.  If
   the subtomogram has been loaded before and still exists in the cache,
   we will use that version instead.  This hopefully will reduce disk load
   times as the most frequently used subtomograms will only be loaded
-  once.  We use a cache size of 1 GB.
+  once.  The cache tiers and sizes are set by configure_mrc_cache(), by
+  default a 1 GB per-process cache.
+
+  The file modification time and size are part of the key, so a file that
+  is rewritten is loaded again.
 
   :param path: The disk path to load the subtomogram from
   """
-  return core.read_mrc(path)
+  st  = os.stat(path)
+  key = (os.path.abspath(path), st.st_mtime, st.st_size)
+
+  with _mrc_cache_lock:
+    vol = mrc_cache.get(key)
+  if vol is None:
+    with phase('read_mrc'):
+      vol = core.read_mrc(path)
+    # a failure to store it in a shared tier does not make the read fail.
+    try:
+      with _mrc_cache_lock:
+        mrc_cache[key] = vol
+    except (IOError, OSError) as e:
+      logging.warning("could not cache %s: %s", path, e)
+  else:
+    count('mrc_cache_hit')
+  return vol
 
 def put_mrc(mrc, path):
   """
@@ -38,7 +91,8 @@ def put_mrc(mrc, path):
   """
   # Do not overwrite existing files.
   if not os.path.isfile(path):
-    core.write_mrc(mrc, path)
+    with phase('write_mrc'):
+      core.write_mrc(mrc, path)
 
 #def np_save(f, arr):
 #  """
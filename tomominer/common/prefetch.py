@@ -0,0 +1,88 @@
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from tomominer import core
+from tomominer.common.io import get_mrc
+from tomominer.parallel.profiling import phase
+
+
+def prefetch(items, load, depth=4, n_threads=2):
+  """
+  Apply load() to each item on background threads, keeping up to depth
+  items loaded ahead of the one being processed by the caller.
+
+  The loads overlap with whatever the caller does with each result, as long
+  as one of the two releases the GIL (core.read_mrc() and the real space
+  rotations do).  At most depth + 1 results are held at any time, so the
+  memory used is bounded no matter how long items is.
+
+  :param items: Iterable of arguments for load.
+  :param load: Function of one item.
+  :param depth: Number of items loaded ahead.  0 loads each item in the
+  calling thread when it is needed.
+  :param n_threads: Number of loading threads.
+
+  :returns: Generator of load(item), in the order of items.  Exceptions
+  raised by load are raised when the failed item is reached.
+  """
+
+  if depth < 1:
+    for item in items:
+      yield load(item)
+    return
+
+  pool = ThreadPool(max(1, min(n_threads, depth)))
+  try:
+    pending = deque()
+    for item in items:
+      pending.append(pool.apply_async(load, (item,)))
+      if len(pending) > depth:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    # also reached when the caller stops early; queued loads are dropped.
+    pool.terminate()
+    pool.join()
+
+
+def _read_uncached(path):
+  with phase('read_mrc'):
+    return core.read_mrc(path)
+
+
+def _vmal_loader(read):
+  def load(vmal_item):
+    vk, mk, ang, loc = vmal_item
+    return read(vk), read(mk), ang, loc
+  return load
+
+
+def prefetch_vmal(vmal, depth=4, n_threads=2, cached=True):
+  """
+  Iterate over (volume, mask, angle, loc) records with the volume and mask
+  read ahead on background threads.  See prefetch().
+
+  :param vmal: Iterable of (volume key, mask key, angle, loc) tuples.
+  :param depth: Number of records read ahead.
+  :param n_threads: Number of reading threads.
+  :param cached: Read through get_mrc() and its cache.  If False,
+  core.read_mrc() is called directly, for volumes that are used once.
+
+  :returns: Generator of (volume, mask, angle, loc) tuples with the volume
+  and mask loaded, in the order of vmal.
+  """
+
+  return prefetch(vmal, _vmal_loader(get_mrc if cached else _read_uncached), depth, n_threads)
+
+
+def prefetch_vm(vm_keys, depth=4, n_threads=2):
+  """
+  Iterate over (volume key, mask key) pairs with both read ahead through
+  get_mrc().  See prefetch().
+
+  :returns: Generator of (volume, mask) tuples, in the order of vm_keys.
+  """
+
+  return prefetch(vm_keys, lambda vm: (get_mrc(vm[0]), get_mrc(vm[1])), depth, n_threads)
@@ -0,0 +1,78 @@
+/*
+  Benchmark of cubic volume rotation.
+
+  Compares the generic transform() path (virtual interpolater call and a
+  matrix product per voxel) with transform_cubic().
+
+  Build from the top of the source tree with something like:
+
+    g++ -std=c++11 -O2 -fopenmp -Itomominer/core/src \
+      tomominer/core/bench/bench_rotate.cpp \
+      tomominer/core/src/affine_transform.cpp \
+      tomominer/core/src/arma_extend.cpp \
+      tomominer/core/src/geometry.cpp \
+      tomominer/core/src/interpolation.cpp \
+      tomominer/core/src/rotate.cpp \
+      -larmadillo -o bench_rotate
+
+  and run with OMP_NUM_THREADS=1 to compare single core throughput.
+*/
+
+#include <chrono>
+#include <cstdio>
+
+#include <armadillo>
+
+#include "arma_extend.hpp"
+#include "rotate.hpp"
+
+static double seconds_since(std::chrono::steady_clock::time_point start)
+{
+  return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+}
+
+static void bench(int n, int reps)
+{
+  arma::arma_rng::set_seed(0);
+  arma::cube vol = arma::randu<arma::cube>(n, n, n);
+
+  arma::vec3 ea;
+  ea << 0.3 << 0.7 << 1.1;
+  rot_matrix rm(ea);
+
+  arma::vec3 dx;
+  dx << 1.5 << -0.25 << 2.0;
+
+  arma::vec3 center = get_center(vol);
+  arma::vec3 _dx = (-center.t() * rm + (center.t() + dx.t())).t();
+  affine_transform tform(rm, _dx);
+
+  cubic_interpolater cub_int(vol, arma::math::nan());
+
+  arma::cube a, b(n, n, n);
+
+  std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+  for(int i = 0; i < reps; i++)
+    a = transform(cub_int, tform, arma::shape(vol));
+  double t_generic = seconds_since(start) / reps;
+
+  start = std::chrono::steady_clock::now();
+  for(int i = 0; i < reps; i++)
+    transform_cubic(cub_int, tform, b);
+  double t_cubic = seconds_since(start) / reps;
+
+  // both have NaN at the same out of bounds voxels.
+  double max_diff = 0;
+  for(size_t i = 0; i < a.n_elem; i++)
+    if(arma::is_finite(a(i)))
+      max_diff = std::max(max_diff, std::abs(a(i) - b(i)));
+
+  std::printf("%4d^3  transform: %8.4f s  transform_cubic: %8.4f s  speedup: %5.2fx  max diff: %g\n", n, t_generic, t_cubic, t_generic/t_cubic, max_diff);
+}
+
+int main()
+{
+  bench(64,  10);
+  bench(128, 3);
+  return 0;
+}
@@ -2,5 +2,5 @@
 from core import *
 del core
 
-__all__ = ["combined_search", "read_mrc", "rotate_mask", "rotate_vol_pad_mean", "rotate_vol_pad_zero", "write_mrc"]
+__all__ = ["combined_search", "combined_search_refine", "read_mrc", "rotate_many", "rotate_mask", "rotate_vol_fft", "rotate_vol_pad_mean", "rotate_vol_pad_zero", "write_mrc"]
 
@@ -4,16 +4,23 @@ cimport cython
 
 from libcpp.string cimport string
 
+# The file IO and the real space rotations release the GIL, so they run in
+# parallel with other Python threads, e.g. volumes read ahead by
+# common.prefetch while others are rotated.  The functions using FFTW keep
+# it: the FFTW planner is not thread safe.
 cdef extern from "wrap_core.hpp":
-  cdef void wrap_write_mrc(double *, unsigned int, unsigned int, unsigned int, string) except +
-  cdef void *wrap_read_mrc(string, double **, unsigned int *, unsigned int *, unsigned int *) except +
+  cdef void wrap_write_mrc(double *, unsigned int, unsigned int, unsigned int, string) except + nogil
+  cdef void *wrap_read_mrc(string, double **, unsigned int *, unsigned int *, unsigned int *) except + nogil
   cdef void *wrap_combined_search(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *, unsigned int, unsigned int *, double **) except +
+  cdef void *wrap_combined_search_refine(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *, unsigned int, unsigned int, double, unsigned int, unsigned int *, double **) except +
   cdef void *wrap_rot_search_cor(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v1_data, double *v2_data, unsigned int n_radii, double *radii_data, unsigned int L, unsigned int *n_cor_r, unsigned int *n_cor_c, unsigned int *n_cor_s, double **cor) except +
   cdef void *wrap_local_max_angles(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *cor_data, unsigned int peak_spacing, unsigned int *n_res, double **res_data) except +
-  cdef void wrap_rotate_vol_pad_mean(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *) except +
-  cdef void wrap_rotate_vol_pad_zero(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *) except +
-  cdef void wrap_rotate_mask(unsigned int, unsigned int, unsigned int, double *, double *, double *) except +
-  cdef void wrap_del_cube(void *c) except +
+  cdef void wrap_rotate_vol_pad_mean(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *) except + nogil
+  cdef void wrap_rotate_vol_pad_zero(unsigned int, unsigned int, unsigned int, double *, double *, double *, double *) except + nogil
+  cdef void wrap_rotate_mask(unsigned int, unsigned int, unsigned int, double *, double *, double *) except + nogil
+  cdef void wrap_rotate_vol_fft(unsigned int, unsigned int, unsigned int, double *, double *, double *, unsigned int, double *) except +
+  cdef void wrap_rotate_many(unsigned int, unsigned int, unsigned int, unsigned int, double *, double *, double *, int, double *) except + nogil
+  cdef void wrap_del_cube(void *c) except + nogil
   cdef void wrap_del_mat(void *c) except +
 
 @cython.boundscheck(False)
@@ -25,6 +32,7 @@ def write_mrc(np.ndarray[np.double_t, ndim=3] vol, str filename):
 
   cdef double *vol_data
   cdef unsigned int n_r, n_c, n_s
+  cdef string fn = filename
 
   if not vol.flags.f_contiguous:
     vol = vol.copy(order='F')
@@ -34,7 +42,8 @@ def write_mrc(np.ndarray[np.double_t, ndim=3] vol, str filename):
   n_c = vol.shape[1]
   n_s = vol.shape[2]
 
-  wrap_write_mrc(vol_data, n_r, n_c, n_s, filename)
+  with nogil:
+    wrap_write_mrc(vol_data, n_r, n_c, n_s, fn)
   return
 
 @cython.boundscheck(False)
@@ -48,18 +57,21 @@ def read_mrc(str filename):
   cdef unsigned int n_r, n_c, n_s
   cdef np.ndarray[np.double_t, ndim=3] vol
   cdef void *cube_ptr
+  cdef string fn = filename
 
-  cube_ptr = wrap_read_mrc(filename, &v_data, &n_r, &n_c, &n_s)
+  with nogil:
+    cube_ptr = wrap_read_mrc(fn, &v_data, &n_r, &n_c, &n_s)
 
   vol = np.empty( (n_r, n_c, n_s), dtype=np.double, order='F')
 
   cdef double *np_data = <double*> vol.data
 
   cdef size_t i
-  for i in range(n_r*n_c*n_s):
-    np_data[i] = v_data[i]
+  with nogil:
+    for i in range(n_r*n_c*n_s):
+      np_data[i] = v_data[i]
 
-  wrap_del_cube(cube_ptr)
+    wrap_del_cube(cube_ptr)
 
   return vol
 
@@ -79,8 +91,6 @@ def combined_search(np.ndarray[np.double_t, ndim=3] vol1, np.ndarray[np.double_t
   cdef double *res_data
   cdef unsigned int n_res
 
-  cdef np.ndarray[np.double_t, ndim=2] res
-
   cdef void   *mat_ptr
 
   cdef unsigned int n_r, n_c, n_s
@@ -105,7 +115,66 @@ def combined_search(np.ndarray[np.double_t, ndim=3] vol1, np.ndarray[np.double_t
 
   mat_ptr = wrap_combined_search(n_r, n_c, n_s, v1_data, m1_data, v2_data, m2_data, L, &n_res, &res_data)
 
+  return _unpack_search_results(mat_ptr, n_res, res_data)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def combined_search_refine(np.ndarray[np.double_t, ndim=3] vol1, np.ndarray[np.double_t, ndim=3] mask1, np.ndarray[np.double_t, ndim=3] vol2, np.ndarray[np.double_t, ndim=3] mask2, unsigned int L, unsigned int n_peaks=5, double ang_tol=0.01, unsigned int max_iter=10):
+  """
+  Coarse to fine alignment search.  The combined_search() is run with the
+  coarse L, and the best n_peaks results are refined by a local search over
+  rotations until the angular step is smaller then ang_tol (radians), or
+  max_iter sweeps have been done.
+
+  :returns: List of (score, loc, ang) tuples sorted by decreasing score, the
+  same as combined_search().
+  """
+
+  cdef double *v1_data
+  cdef double *m1_data
+  cdef double *v2_data
+  cdef double *m2_data
+
+  cdef double *res_data
+  cdef unsigned int n_res
+
+  cdef void   *mat_ptr
+
+  cdef unsigned int n_r, n_c, n_s
+
+  if not vol1.flags.f_contiguous:
+    vol1 = vol1.copy(order='F')
+  if not mask1.flags.f_contiguous:
+    mask1 = mask1.copy(order='F')
+  if not vol2.flags.f_contiguous:
+    vol2 = vol2.copy(order='F')
+  if not mask2.flags.f_contiguous:
+    mask2 = mask2.copy(order='F')
+
+  v1_data = <double *> vol1.data
+  m1_data = <double *>mask1.data
+  v2_data = <double *> vol2.data
+  m2_data = <double *>mask2.data
+
+  n_r = vol1.shape[0]
+  n_c = vol1.shape[1]
+  n_s = vol1.shape[2]
+
+  mat_ptr = wrap_combined_search_refine(n_r, n_c, n_s, v1_data, m1_data, v2_data, m2_data, L, n_peaks, ang_tol, max_iter, &n_res, &res_data)
+
+  return _unpack_search_results(mat_ptr, n_res, res_data)
+
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _unpack_search_results(void *mat_ptr, unsigned int n_res, double *res_data):
+  """
+  Convert the n_res x 7 result matrix of a search into a list of (score,
+  loc, ang) tuples, and free the matrix.
+  """
+
+  cdef np.ndarray[np.double_t, ndim=2] res
   res = np.empty( (n_res, 7), dtype=np.double, order='F')
 
   cdef double *np_data = <double*> res.data
@@ -245,7 +314,8 @@ def rotate_vol_pad_mean(np.ndarray[np.double_t, ndim=3] vol, np.ndarray[np.doubl
   dx_data  = <double *> dx.data
   res_data = <double *>res.data
 
-  wrap_rotate_vol_pad_mean(n_r, n_c, n_s, vol_data, ea_data, dx_data, res_data);
+  with nogil:
+    wrap_rotate_vol_pad_mean(n_r, n_c, n_s, vol_data, ea_data, dx_data, res_data);
   return res
 
 
@@ -280,7 +350,8 @@ def rotate_vol_pad_zero(np.ndarray[np.double_t, ndim=3] vol, np.ndarray[np.doubl
   dx_data  = <double *> dx.data
   res_data = <double *>res.data
 
-  wrap_rotate_vol_pad_zero(n_r, n_c, n_s, vol_data, ea_data, dx_data, res_data);
+  with nogil:
+    wrap_rotate_vol_pad_zero(n_r, n_c, n_s, vol_data, ea_data, dx_data, res_data);
   return res
 
 @cython.boundscheck(False)
@@ -311,5 +382,101 @@ def rotate_mask(np.ndarray[np.double_t, ndim=3] mask, np.ndarray[np.double_t, nd
   ea_data  = <double *> ea.data
   res_data = <double *>res.data
 
-  wrap_rotate_mask(n_r, n_c, n_s, mask_data, ea_data, res_data);
+  with nogil:
+    wrap_rotate_mask(n_r, n_c, n_s, mask_data, ea_data, res_data);
   return res
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rotate_vol_fft(np.ndarray[np.double_t, ndim=3] vol, np.ndarray[np.double_t, ndim=1] ea, np.ndarray[np.double_t, ndim=1] dx, unsigned int oversample=2):
+  """
+  Rotate a volume in Fourier space.  This is an approximation of
+  fftshift(fftn(rotate_vol_pad_mean(vol, ea, dx))) computed without real
+  space interpolation.
+
+  :param vol: Volume to rotate.
+  :param ea: Euler angle of the rotation.
+  :param dx: Displacement to apply after the rotation.
+  :param oversample: Zero padding factor used before the FFT.  Larger is more
+  accurate and slower.
+
+  :returns: The centered (fftshifted) spectrum of the rotated volume, as a
+  complex Fortran ordered array.
+  """
+
+  cdef unsigned int n_r, n_c, n_s
+
+  cdef np.ndarray[np.complex128_t, ndim=3] res
+
+  if not vol.flags.f_contiguous:
+    vol = vol.copy(order='F')
+
+  n_r = vol.shape[0]
+  n_c = vol.shape[1]
+  n_s = vol.shape[2]
+
+  res = np.empty((n_r, n_c, n_s), dtype=np.complex128, order='F')
+
+  wrap_rotate_vol_fft(n_r, n_c, n_s, <double *>vol.data, <double *>ea.data, <double *>dx.data, oversample, <double *>res.data)
+  return res
+
+
+_rotate_modes = {'mean' : 0, 'zero' : 1, 'mask' : 2}
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rotate_many(np.ndarray[np.double_t, ndim=4] vols, np.ndarray[np.double_t, ndim=2] angs, np.ndarray[np.double_t, ndim=2] locs, np.ndarray[np.double_t, ndim=4] out=None, str mode='mean'):
+  """
+  Rotate a stack of volumes in one call.  The volumes are rotated in
+  parallel, and the interpolation workspace is reused between volumes.
+
+  :param vols: Array of shape (n_r, n_c, n_s, n).  vols[:,:,:,i] is the i-th
+  volume.  Fortran order avoids a copy.
+  :param angs: Array of shape (n, 3) of Euler angles.
+  :param locs: Array of shape (n, 3) of displacements.  Ignored if mode is
+  'mask'.
+  :param out: Optional Fortran ordered array the same shape as vols to write
+  the results into.  It must not overlap vols.
+  :param mode: 'mean' or 'zero' to pad like rotate_vol_pad_mean() or
+  rotate_vol_pad_zero(), or 'mask' to rotate like rotate_mask().
+
+  :returns: out, or a new array if out was not given.
+  """
+
+  cdef unsigned int n_r, n_c, n_s, n_v
+
+  if mode not in _rotate_modes:
+    raise ValueError("rotate_many: unknown mode %s" % (mode,))
+
+  if not vols.flags.f_contiguous:
+    vols = vols.copy(order='F')
+
+  n_r = vols.shape[0]
+  n_c = vols.shape[1]
+  n_s = vols.shape[2]
+  n_v = vols.shape[3]
+
+  if angs.shape[0] != n_v or angs.shape[1] != 3 or locs.shape[0] != n_v or locs.shape[1] != 3:
+    raise ValueError("rotate_many: angs and locs must have shape (%d, 3)" % (n_v,))
+
+  # (n,3) in C order is 3 x n in Fortran order, one column per volume.
+  if not angs.flags.c_contiguous:
+    angs = angs.copy(order='C')
+  if not locs.flags.c_contiguous:
+    locs = locs.copy(order='C')
+
+  if out is None:
+    out = np.empty((n_r, n_c, n_s, n_v), dtype=np.double, order='F')
+  elif out.shape[0] != n_r or out.shape[1] != n_c or out.shape[2] != n_s or out.shape[3] != n_v or not out.flags.f_contiguous:
+    raise ValueError("rotate_many: out must be a Fortran ordered array of the same shape as vols")
+
+  cdef int c_mode = _rotate_modes[mode]
+  cdef double *vols_data = <double *>vols.data
+  cdef double *angs_data = <double *>angs.data
+  cdef double *locs_data = <double *>locs.data
+  cdef double *out_data  = <double *>out.data
+
+  with nogil:
+    wrap_rotate_many(n_r, n_c, n_s, n_v, vols_data, angs_data, locs_data, c_mode, out_data)
+  return out
@@ -28,16 +28,9 @@ void *wrap_read_mrc(std::string filename, double **vol, unsigned int *n_r, unsig
   return (void *)v;
 }
 
-void *wrap_combined_search(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v1_data, double *m1_data, double *v2_data, double *m2_data, unsigned int L, unsigned int *n_res, double **res_data)
+// pack (score, loc, ang) search results into a n x 7 matrix for python.
+static void *pack_search_results(const std::vector<std::tuple<double, arma::vec3, euler_angle> > &res, unsigned int *n_res, double **res_data)
 {
-  arma::cube v1(v1_data, n_r, n_c, n_s, false, true);
-  arma::cube m1(m1_data, n_r, n_c, n_s, false, true);
-  arma::cube v2(v2_data, n_r, n_c, n_s, false, true);
-  arma::cube m2(m2_data, n_r, n_c, n_s, false, true);
-
-  std::vector<std::tuple<double, arma::vec3, euler_angle> > res = combined_search(v1, m1, v2, m2, L);
-  //std::vector<boost::tuple<double, arma::vec3, euler_angle> > res = combined_search(v1, m1, v2, m2, L);
-
   arma::mat *ret = new arma::mat(res.size(), 7);
 
   *res_data = ret->memptr();
@@ -56,6 +49,31 @@ void *wrap_combined_search(unsigned int n_r, unsigned int n_c, unsigned int n_s,
   return (void *)ret;
 }
 
+void *wrap_combined_search(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v1_data, double *m1_data, double *v2_data, double *m2_data, unsigned int L, unsigned int *n_res, double **res_data)
+{
+  arma::cube v1(v1_data, n_r, n_c, n_s, false, true);
+  arma::cube m1(m1_data, n_r, n_c, n_s, false, true);
+  arma::cube v2(v2_data, n_r, n_c, n_s, false, true);
+  arma::cube m2(m2_data, n_r, n_c, n_s, false, true);
+
+  std::vector<std::tuple<double, arma::vec3, euler_angle> > res = combined_search(v1, m1, v2, m2, L);
+  //std::vector<boost::tuple<double, arma::vec3, euler_angle> > res = combined_search(v1, m1, v2, m2, L);
+
+  return pack_search_results(res, n_res, res_data);
+}
+
+void *wrap_combined_search_refine(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v1_data, double *m1_data, double *v2_data, double *m2_data, unsigned int L, unsigned int n_peaks, double ang_tol, unsigned int max_iter, unsigned int *n_res, double **res_data)
+{
+  arma::cube v1(v1_data, n_r, n_c, n_s, false, true);
+  arma::cube m1(m1_data, n_r, n_c, n_s, false, true);
+  arma::cube v2(v2_data, n_r, n_c, n_s, false, true);
+  arma::cube m2(m2_data, n_r, n_c, n_s, false, true);
+
+  std::vector<std::tuple<double, arma::vec3, euler_angle> > res = combined_search_refine(v1, m1, v2, m2, L, n_peaks, ang_tol, max_iter);
+
+  return pack_search_results(res, n_res, res_data);
+}
+
 void *wrap_rot_search_cor(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v1_data, double *v2_data, unsigned int n_radii, double *radii_data, unsigned int L, unsigned int *n_cor_r, unsigned int *n_cor_c, unsigned int *n_cor_s, double **cor)
 {
   arma::cube v1(v1_data, n_r, n_c, n_s, false, true);
@@ -164,6 +182,32 @@ void wrap_rotate_mask(unsigned int n_r, unsigned int n_c, unsigned int n_s, doub
 }
 
 
+void wrap_rotate_vol_fft(unsigned int n_r, unsigned int n_c, unsigned int n_s, double *v_data, double *ea_data, double *dx_data, unsigned int oversample, double *res_data)
+{
+  arma::cube   v(v_data, n_r, n_c, n_s,   false, true);
+  arma::vec3  ea(ea_data);
+  arma::vec3  dx(dx_data);
+  arma::mat33 rm = rot_matrix(ea);
+
+  // res_data holds n_r*n_c*n_s complex values, as (real, imag) pairs.
+  arma::cx_cube res(reinterpret_cast<std::complex<double> *>(res_data), n_r, n_c, n_s, false, true);
+  res = rotate_vol_fft(v, rm, dx, oversample);
+  return;
+}
+
+
+void wrap_rotate_many(unsigned int n_r, unsigned int n_c, unsigned int n_s, unsigned int n_v, double *v_data, double *ea_data, double *dx_data, int mode, double *res_data)
+{
+  arma::cube  v(v_data, n_r, n_c, n_s*n_v, false, true);
+  arma::mat  ea(ea_data, 3, n_v, false, true);
+  arma::mat  dx(dx_data, 3, n_v, false, true);
+  arma::cube res(res_data, n_r, n_c, n_s*n_v, false, true);
+
+  rotate_vol_batch(v, ea, dx, static_cast<rotate_mode>(mode), res);
+  return;
+}
+
+
 void wrap_del_cube(void *v)
 {
   arma::cube *c = (arma::cube *)v;
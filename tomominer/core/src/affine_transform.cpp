@@ -48,3 +48,8 @@ void affine_transform::forward(const arma::vec4 &in, arma::vec4 &out)
 {
   out = (in.t() * A).t();
 }
+
+const arma::mat44 &affine_transform::inverse_matrix() const
+{
+  return Ai;
+}
@@ -161,6 +161,15 @@ class affine_transform
     
     */
     void forward(const arma::vec4 &in, arma::vec4 &out);
+
+    /**
+      The cached inverse transform matrix.  A row vector [x,y,z,1.0]
+      multiplied on the right by this matrix gives the point of origin of
+      the transformed point (x,y,z).
+
+      @return the inverse of the forward transform.
+    */
+    const arma::mat44 &inverse_matrix() const;
     
     // operator*(affine_transform) 
     //affine_transform(const rot_matrix &rm);
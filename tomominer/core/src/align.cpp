@@ -26,7 +26,40 @@ std::complex<double> trapz(const arma::vec &x, const arma::cx_vec &y)
 }
 
 
-std::tuple<arma::vec3, double> cons_corr_max(const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, euler_angle ang)
+arma::vec3 peak_subvoxel_offset(const arma::cube &corr, const arma::uvec3 &max_loc)
+{
+  arma::vec3 offset = arma::zeros<arma::vec>(3);
+  arma::uvec3 siz;
+  siz << corr.n_rows << corr.n_cols << corr.n_slices;
+
+  double c0 = corr(max_loc(0), max_loc(1), max_loc(2));
+
+  for(size_t d = 0; d < 3; d++)
+  {
+    if(siz(d) < 3)
+      continue;
+
+    // neighbors of the peak along this axis.  The correlation is periodic,
+    // so they wrap around the edges of the cube.
+    arma::uvec3 lo(max_loc), hi(max_loc);
+    lo(d) = (max_loc(d) + siz(d) - 1) % siz(d);
+    hi(d) = (max_loc(d) + 1) % siz(d);
+
+    double cm = corr(lo(0), lo(1), lo(2));
+    double cp = corr(hi(0), hi(1), hi(2));
+
+    // vertex of the parabola through the three samples.
+    double denom = cm + cp - 2.0*c0;
+    if(denom >= 0)
+      continue;
+
+    offset(d) = std::max(-0.5, std::min(0.5, 0.5*(cm - cp)/denom));
+  }
+  return offset;
+}
+
+
+std::tuple<arma::vec3, double> cons_corr_max(const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, euler_angle ang, bool subvoxel)
 //boost::tuple<arma::vec3, double> cons_corr_max(const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, euler_angle ang)
 {
   rot_matrix rm = ang.as_rot_matrix();
@@ -56,11 +89,13 @@ std::tuple<arma::vec3, double> cons_corr_max(const arma::cube &vol1, const arma:
   arma::uvec3 max_loc;
   double max_val = corr.max(max_loc(0), max_loc(1), max_loc(2));
 
-  arma::vec3 pos;
+  arma::vec3 pos = arma::conv_to<arma::vec>::from(max_loc);
+  if(subvoxel)
+    pos += peak_subvoxel_offset(corr, max_loc);
+
   arma::ivec3 siz = arma::shape(corr);
   for(size_t i = 0; i < 3; i++)
   {
-    pos(i) = max_loc(i);
     if(pos(i) > siz(i)/2)
       pos(i) -= siz(i);
   }
@@ -402,3 +437,65 @@ std::vector<std::tuple<double, arma::vec3, euler_angle> > combined_search( const
   }  
   return angs_locs_scores;
 }
+
+
+std::tuple<double, arma::vec3, euler_angle> local_angle_refine(const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, const std::tuple<double, arma::vec3, euler_angle> &start, double step, double ang_tol, unsigned int max_iter)
+{
+  double      best_score = std::get<0>(start);
+  arma::vec3  best_loc   = std::get<1>(start);
+  euler_angle best_ang   = std::get<2>(start);
+
+  for(unsigned int iter = 0; iter < max_iter && step >= ang_tol; iter++)
+  {
+    bool improved = false;
+
+    // compass search: try a step in both directions along each angle.
+    for(size_t d = 0; d < 3; d++)
+    {
+      for(int sign = -1; sign <= 1; sign += 2)
+      {
+        euler_angle ang(best_ang);
+        ang(d) += sign * step;
+
+        arma::vec3 loc;
+        double score;
+        std::tie(loc, score) = cons_corr_max(vol1, mask1, vol2, mask2, ang);
+
+        if(score > best_score)
+        {
+          best_score = score;
+          best_loc   = loc;
+          best_ang   = ang;
+          improved   = true;
+        }
+      }
+    }
+
+    // no better rotation at this step size.  Look closer.
+    if(!improved)
+      step /= 2.0;
+  }
+
+  return std::make_tuple(best_score, best_loc, best_ang);
+}
+
+
+std::vector<std::tuple<double, arma::vec3, euler_angle> > combined_search_refine( const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, unsigned int L, unsigned int n_peaks, double ang_tol, unsigned int max_iter)
+{
+  if(ang_tol <= 0)
+    throw fatal_error() << "combined_search_refine: ang_tol must be positive.";
+
+  std::vector<std::tuple<double, arma::vec3, euler_angle> > res = combined_search(vol1, mask1, vol2, mask2, L);
+
+  // The coarse grid has a spacing of 2*pi/(2*L), so the true peak is within
+  // half of that from the grid point.
+  double step = M_PI / (2.0 * L);
+
+  // results are sorted by decreasing score, so refine the first n_peaks.
+  for(size_t i = 0; i < res.size() && i < n_peaks; i++)
+    res[i] = local_angle_refine(vol1, mask1, vol2, mask2, res[i], step, ang_tol, max_iter);
+
+  std::sort(res.begin(), res.end(), tup_compare);
+
+  return res;
+}
@@ -111,6 +111,21 @@ std::complex<double> trapz(const arma::vec &x, const arma::cx_vec &y);
 
 */
 
+/**
+  Estimate the sub-voxel location of a correlation peak.
+
+  Along each axis a parabola is fit through the peak and its two neighbors,
+  and the vertex of the parabola is taken as the refined location.  The
+  correlation is treated as periodic, so neighbors wrap around the edges of
+  the cube.  Offsets are clamped to [-0.5, 0.5].
+
+  @param corr     correlation cube
+  @param max_loc  index of the maximum of corr.
+
+  @return offset from max_loc to the refined peak, in voxels.
+*/
+arma::vec3 peak_subvoxel_offset(const arma::cube &corr, const arma::uvec3 &max_loc);
+
 /** 
   Compute constrained correlation of two tomograms.  Search for best
   alignment between subtomograms.
@@ -127,13 +142,15 @@ std::complex<double> trapz(const arma::vec &x, const arma::cx_vec &y);
   @param mask2  second mask in Fourier space.
   @param ang1   Euler angle of how first volume is rotated.
   @param ang2   Euler angle of how second volume is rotated.
+  @param subvoxel If true, the integer peak of the correlation is refined to
+  sub-voxel precision with peak_subvoxel_offset().
   
   @return Tuple containing the optimal offset to maximize correlation between
   subtomograms, and the constrained correlation score achieved at that
-  displacement.
+  displacement.  The score is the correlation at the integer peak.
 
 */
-std::tuple<arma::vec3, double> cons_corr_max(const arma::cube &v1, const arma::cube &m1, const arma::cube &v2, const arma::cube &m2, euler_angle ang);
+std::tuple<arma::vec3, double> cons_corr_max(const arma::cube &v1, const arma::cube &m1, const arma::cube &v2, const arma::cube &m2, euler_angle ang, bool subvoxel = true);
 //boost::tuple<arma::vec3, double> cons_corr_max(const arma::cube &v1, const arma::cube &m1, const arma::cube &v2, const arma::cube &m2, euler_angle ang);
 
 
@@ -265,6 +282,54 @@ std::vector<std::tuple<double, arma::vec3, euler_angle> > combined_search( const
 //std::vector<boost::tuple<double, arma::vec3, euler_angle> > combined_search( const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, unsigned int max_l);
 
 
+/**
+  Improve a single alignment by a local search over rotations.
+
+  Starting from the given (score, translation, rotation) we do a compass
+  search in Euler angle space.  Each sweep tries a step of +/- step in each
+  of the three angles, and evaluates the rotation with cons_corr_max().  Any
+  improvement is kept, and if a sweep does not improve the score the step is
+  halved.  The search stops once the step falls below ang_tol, or after
+  max_iter sweeps.
+
+  @param vol1   a cubic volume of data.
+  @param mask1  a mask to be applied to the data.
+  @param vol2   a cubic volume of data
+  @param mask2  a mask to be applied to vol2
+  @param start  the alignment to start from, usually a combined_search() peak.
+  @param step   initial angular step in radians.
+  @param ang_tol  the search stops when the step is smaller then this (radians).
+  @param max_iter maximum number of sweeps to carry out.
+
+  @returns The best alignment found, as a tuple of (score, translation, rotation).
+*/
+std::tuple<double, arma::vec3, euler_angle> local_angle_refine(const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, const std::tuple<double, arma::vec3, euler_angle> &start, double step, double ang_tol, unsigned int max_iter);
+
+
+/**
+  Coarse to fine search for an optimal alignment of the two volumes.
+
+  The combined_search() with a coarse max_l is used to find candidate peaks.
+  The best n_peaks candidates are then refined by local_angle_refine(),
+  starting with a step of half the coarse angular spacing (\f$\pi/(2L)\f$).
+  This gives close to the accuracy of a fine angular grid, for the cost of
+  the coarse search and a few cons_corr_max() calls per peak.
+
+  @param vol1   a cubic volume of data.
+  @param mask1  a mask to be applied to the data.
+  @param vol2   a cubic volume of data
+  @param mask2  a mask to be applied to vol2
+  @param max_l  maximum degree of spherical harmonic expansion to use in the coarse search.
+  @param n_peaks  number of the best coarse peaks to refine.
+  @param ang_tol  angular tolerance (radians) to refine the peaks to.
+  @param max_iter maximum number of local search sweeps per peak.
+
+  @returns A list of the best transformations found, sorted by decreasing
+  score.  The format is the same as combined_search().
+*/
+std::vector<std::tuple<double, arma::vec3, euler_angle> > combined_search_refine( const arma::cube &vol1, const arma::cube &mask1, const arma::cube &vol2, const arma::cube &mask2, unsigned int max_l, unsigned int n_peaks, double ang_tol, unsigned int max_iter);
+
+
 /**
   Compare two tuples based on their first item which is a double.
 
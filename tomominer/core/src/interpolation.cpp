@@ -28,7 +28,7 @@ double interpolater::get_ext_val() const { return ext; }
 
 
 cubic_interpolater::cubic_interpolater(const arma::cube &f_) 
-  : interpolater(f_)
+  : interpolater(f_), f(f_own)
 {
   update_data();
 }
@@ -36,43 +36,49 @@ cubic_interpolater::cubic_interpolater(const arma::cube &f_)
 
 
 cubic_interpolater::cubic_interpolater(const arma::cube &f_, double ext_val)
-  : interpolater(f_, ext_val)
+  : interpolater(f_, ext_val), f(f_own)
+{
+  update_data();
+}
+
+
+cubic_interpolater::cubic_interpolater(const arma::cube &f_, double ext_val, arma::cube &workspace)
+  : interpolater(f_, ext_val), f(workspace)
 {
   update_data();
 }
 
 double cubic_interpolater::operator()(const arma::vec &x) const { return (*this)(x(0), x(1), x(2)); }
 
+const arma::cube &cubic_interpolater::padded_data() const { return f; }
+
 void cubic_interpolater::update_data()
 {
   arma::uword M = data.n_rows;
   arma::uword N = data.n_cols;
   arma::uword P = data.n_slices;
 
-  f = arma::cube(M+2, N+2, P+2);
+  // set_size() keeps the existing memory if f is already the right size.
+  f.set_size(M+2, N+2, P+2);
 
   f(span(1,M), span(1,N), span(1,P)) = data;
   
   // fill in missing data:
   //
-  //! @todo this is the slow but easy way to do this.  optimize.
-  // 
-  // We need three passes. In the first the sides are set, in the second the
-  // edges, and in the third the corners.  In each additional round, the data
-  // from before is still correct.  We do not need to actually calculate it
-  // twice.  This was much less work however.  In the future, do this, then
-  // iterate over edges, then corners to improve speed.
-  for(arma::uword i = 0; i < 3; i++)
-  {
-    f(span((arma::uword)0),   span(), span()) = 3 * f(span((arma::uword)1), span(), span()) - 3 * f(span((arma::uword)2),   span(), span()) + f(span((arma::uword)3),   span(), span());
-    f(span(M+1), span(), span()) = 3 * f(span(M), span(), span()) - 3 * f(span(M-1), span(), span()) + f(span(M-2), span(), span());
-
-    f(span(), span((arma::uword)0),   span()) = 3 * f(span(), span((arma::uword)1), span()) - 3 * f(span(), span((arma::uword)2),   span()) + f(span(), span((arma::uword)3),   span());
-    f(span(), span(N+1), span()) = 3 * f(span(), span(N), span()) - 3 * f(span(), span(N-1), span()) + f(span(), span(N-2), span());
-
-    f(span(), span(), span((arma::uword)0)  ) = 3 * f(span(), span(), span((arma::uword)1)) - 3 * f(span(), span(), span((arma::uword)2)  ) + f(span(), span(), span((arma::uword)3)  );
-    f(span(), span(), span(P+1)) = 3 * f(span(), span(), span(P)) - 3 * f(span(), span(), span(P-1)) + f(span(), span(), span(P-2));
-  }
+  // The extrapolation is linear and separable, so a single pass is enough
+  // if each direction is done over the full extent of the padded cube.  The
+  // sides set first may contain garbage along their edges, but every value
+  // read by a later direction is in the interior of the earlier ones, and
+  // the garbage is overwritten.  The corners end up with the same values the
+  // old three pass version produced.
+  f(span((arma::uword)0),   span(), span()) = 3 * f(span((arma::uword)1), span(), span()) - 3 * f(span((arma::uword)2),   span(), span()) + f(span((arma::uword)3),   span(), span());
+  f(span(M+1), span(), span()) = 3 * f(span(M), span(), span()) - 3 * f(span(M-1), span(), span()) + f(span(M-2), span(), span());
+
+  f(span(), span((arma::uword)0),   span()) = 3 * f(span(), span((arma::uword)1), span()) - 3 * f(span(), span((arma::uword)2),   span()) + f(span(), span((arma::uword)3),   span());
+  f(span(), span(N+1), span()) = 3 * f(span(), span(N), span()) - 3 * f(span(), span(N-1), span()) + f(span(), span(N-2), span());
+
+  f(span(), span(), span((arma::uword)0)  ) = 3 * f(span(), span(), span((arma::uword)1)) - 3 * f(span(), span(), span((arma::uword)2)  ) + f(span(), span(), span((arma::uword)3)  );
+  f(span(), span(), span(P+1)) = 3 * f(span(), span(), span(P)) - 3 * f(span(), span(), span(P-1)) + f(span(), span(), span(P-2));
 }
   
 
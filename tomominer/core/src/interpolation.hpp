@@ -181,13 +181,36 @@ class cubic_interpolater : public interpolater
     
     cubic_interpolater(const arma::cube &f_);
 
+    /**
+      Initialize a cubic interpolater which builds its padded copy of the
+      data in a caller supplied workspace.  If the workspace already has the
+      padded size, no memory is allocated, so one workspace can be reused
+      across many volumes of the same shape.
+
+      @param f_ cube to interpolate.
+      @param ext_val value to return in the event of extrapolation.
+      @param workspace cube used to store the padded data.  It must outlive
+      the interpolater.
+    */
+    cubic_interpolater(const arma::cube &f_, double ext_val, arma::cube &workspace);
+
     virtual double operator()(double x, double y, double z) const;
 
     double operator()(const arma::vec &x) const;
 
+    /**
+      The data padded by one voxel on every side with the extrapolated
+      values used near the boundary.  Voxel (i,j,k) of the data is at
+      (i+1,j+1,k+1) of the padded cube.
+
+      @return the padded cube.
+    */
+    const arma::cube &padded_data() const;
+
   private:
     void update_data();
-    arma::cube f;
+    arma::cube f_own;
+    arma::cube &f;
 };
     
 /**
@@ -2,24 +2,35 @@
 #include "interpolation.hpp"
 
 #include "arma_extend.hpp"
+#include "fatal_error.hpp"
+#include "fft.hpp"
 
 arma::cube transform(const interpolater &inter, affine_transform &at, arma::ivec3 size)
 {
   arma::cube out(size(0), size(1), size(2));
+  transform(inter, at, out);
+  return out;
+}
 
+void transform(const interpolater &inter, affine_transform &at, arma::cube &out)
+{
   arma::vec4 x;
   arma::vec4 y;
 
+  int n_r = out.n_rows;
+  int n_c = out.n_cols;
+  int n_s = out.n_slices;
+
   #pragma omp parallel for private(x,y)
-  for(int x0 = 0; x0 < size(0); x0++)
+  for(int x0 = 0; x0 < n_r; x0++)
   {
     x(0) = x0;
 
-    for(int x1 = 0; x1 < size(1); x1++)
+    for(int x1 = 0; x1 < n_c; x1++)
     {
       x(1) = x1;
       
-      for(int x2 = 0; x2 < size(2); x2++)
+      for(int x2 = 0; x2 < n_s; x2++)
       {
         x(2) = x2;
         x(3) = 1.0;
@@ -29,76 +40,208 @@ arma::cube transform(const interpolater &inter, affine_transform &at, arma::ivec
       }
     }
   }
+}
 
-  return out;
+
+/**
+  Catmull-Rom weights for a point t in [0,1] between the middle two of four
+  samples.  These are catmull_rom_coeff() with the factor of 1/2 folded in.
+*/
+static inline void catmull_rom_weights(double t, double *w)
+{
+  double t2 = t*t;
+  w[0] = 0.5*t*((2-t)*t-1);
+  w[1] = 0.5*(t2*(3*t-5)+2);
+  w[2] = 0.5*t*((4-3*t)*t+1);
+  w[3] = 0.5*t2*(t-1);
 }
 
-arma::cube rotate_vol(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
+void transform_cubic(const cubic_interpolater &inter, const affine_transform &at, arma::cube &out)
 {
+  const arma::cube  &f  = inter.padded_data();
+  const arma::mat44 &Ai = at.inverse_matrix();
+  const double ext = inter.get_ext_val();
+
+  // last valid coordinate of the unpadded data along each axis.
+  const double max_x = f.n_rows   - 3;
+  const double max_y = f.n_cols   - 3;
+  const double max_z = f.n_slices - 3;
+
+  // strides of the padded data.
+  const arma::uword sy = f.n_rows;
+  const arma::uword sz = f.n_rows * f.n_cols;
+  const double *fp = f.memptr();
+
+  //Fudge factor to handle data that maps to slightly outside of the boundary.
+  const double EPSILON = 1e-13;
 
+  const int n_r = out.n_rows;
+  const int n_c = out.n_cols;
+  const int n_s = out.n_slices;
+
+  #pragma omp parallel for
+  for(int x2 = 0; x2 < n_s; x2++)
+  {
+    double wx[4], wy[4], wz[4], wyz[16];
+
+    for(int x1 = 0; x1 < n_c; x1++)
+    {
+      double *o = out.slice_memptr(x2) + x1*n_r;
+
+      // source position of out(0,x1,x2).  Stepping along x0 adds the first
+      // row of the inverse transform.
+      double px = Ai(3,0) + x1*Ai(1,0) + x2*Ai(2,0);
+      double py = Ai(3,1) + x1*Ai(1,1) + x2*Ai(2,1);
+      double pz = Ai(3,2) + x1*Ai(1,2) + x2*Ai(2,2);
+
+      for(int x0 = 0; x0 < n_r; x0++, px += Ai(0,0), py += Ai(0,1), pz += Ai(0,2))
+      {
+        double x = px;
+        double y = py;
+        double z = pz;
+
+        if( x < 0 && x > -EPSILON) x = 0;
+        if( y < 0 && y > -EPSILON) y = 0;
+        if( z < 0 && z > -EPSILON) z = 0;
+        if( x > max_x && x < max_x + EPSILON) x = max_x;
+        if( y > max_y && y < max_y + EPSILON) y = max_y;
+        if( z > max_z && z < max_z + EPSILON) z = max_z;
+
+        if( x < 0 || max_x < x || y < 0 || max_y < y || z < 0 || max_z < z )
+        {
+          o[x0] = ext;
+          continue;
+        }
+
+        arma::uword i0 = (arma::uword)x;
+        arma::uword j0 = (arma::uword)y;
+        arma::uword k0 = (arma::uword)z;
+
+        // allow the case where we are on the rightmost edge.
+        if( i0 == max_x ) i0--;
+        if( j0 == max_y ) j0--;
+        if( k0 == max_z ) k0--;
+
+        catmull_rom_weights(x - i0, wx);
+        catmull_rom_weights(y - j0, wy);
+        catmull_rom_weights(z - k0, wz);
+
+        for(size_t k = 0; k < 4; k++)
+          for(size_t j = 0; j < 4; j++)
+            wyz[4*k+j] = wz[k]*wy[j];
+
+        // the data is padded, so the 4x4x4 neighborhood starts at
+        // (i0,j0,k0) of the padded cube.
+        const double *p = fp + i0 + j0*sy + k0*sz;
+
+        double sum = 0;
+        for(size_t k = 0; k < 4; k++)
+        {
+          for(size_t j = 0; j < 4; j++)
+          {
+            const double *r = p + j*sy + k*sz;
+            sum += wyz[4*k+j] * (wx[0]*r[0] + wx[1]*r[1] + wx[2]*r[2] + wx[3]*r[3]);
+          }
+        }
+        o[x0] = sum;
+      }
+    }
+  }
+}
+
+
+/**
+  The affine transformation used to rotate vol about its center by rm, and
+  then displace it by dx.
+*/
+static affine_transform rotation_transform(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx)
+{
   arma::vec3 center = get_center(vol);
 
   //arma::vec3 dx = -rm * center + center;
   arma::vec3 _dx = (-center.t() * rm + (center.t() + dx.t())).t();
 
-  // our affine transformation matrix:
-  affine_transform tform(rm, _dx);
-
-  // the interpolation we will use.
-  cubic_interpolater cub_int(vol, arma::math::nan());
-
-  // do transformation.
-  return transform(cub_int, tform, arma::shape(vol));
+  return affine_transform(rm, _dx);
 }
 
-arma::cube rotate_vol_pad_mean(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
+/**
+  Replace all non-finite values with the mean of the finite ones.
+*/
+static void pad_mean(arma::cube &vol)
 {
-  arma::cube vol2 = rotate_vol(vol, rm, dx);
-  
   double s = 0;
   size_t n = 0;
   // calculate mean of locations that are finite, not NaN.
-  for(size_t i = 0; i < vol2.n_elem; i++)
+  for(size_t i = 0; i < vol.n_elem; i++)
   {
-    if(arma::is_finite(vol2(i)))
+    if(arma::is_finite(vol(i)))
     {
-      s+=vol2(i);
+      s+=vol(i);
       n++;
     }
   }
   double mean = s / static_cast<double>(n);
 
   // fill in this average for all NaN/infinite values.
-  for(size_t i = 0; i < vol2.n_elem; i++)
-    if(!arma::is_finite(vol2(i)))
-      vol2(i) = mean;
+  for(size_t i = 0; i < vol.n_elem; i++)
+    if(!arma::is_finite(vol(i)))
+      vol(i) = mean;
+}
 
-  return vol2;
+/**
+  Replace all non-finite values with zero.
+*/
+static void pad_zero(arma::cube &vol)
+{
+  for(size_t i = 0; i < vol.n_elem; i++)
+    if( !arma::is_finite(vol(i)) )
+      vol(i) = 0;
 }
 
+/**
+  Clip negative values produced by interpolation of a mask.
+*/
+static void clip_mask(arma::cube &mask)
+{
+  for(size_t i = 0; i < mask.n_elem; i++)
+    if( mask(i) < 0 )
+      mask(i) = 0.0;
+}
 
-arma::cube rotate_vol_pad_zero(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
+arma::cube rotate_vol(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
 {
-  arma::cube vol2 = rotate_vol(vol, rm, dx);
+  // our affine transformation matrix:
+  affine_transform tform = rotation_transform(vol, rm, dx);
 
-  for(size_t i = 0; i < vol2.n_elem; i++)
-    if( !arma::is_finite(vol2(i)) )
-      vol2(i) = 0;
+  // the interpolation we will use.
+  cubic_interpolater cub_int(vol, arma::math::nan());
 
+  // do transformation.
+  arma::cube out(vol.n_rows, vol.n_cols, vol.n_slices);
+  transform_cubic(cub_int, tform, out);
+  return out;
+}
+
+arma::cube rotate_vol_pad_mean(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
+{
+  arma::cube vol2 = rotate_vol(vol, rm, dx);
+  pad_mean(vol2);
   return vol2;
 }
 
 
-arma::cube rotate_mask(const arma::cube &mask, const rot_matrix &rm)
+arma::cube rotate_vol_pad_zero(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */)
 {
-  // our output volume has the same dimensions as the input.
-  arma::vec3 center = get_center(mask);
+  arma::cube vol2 = rotate_vol(vol, rm, dx);
+  pad_zero(vol2);
+  return vol2;
+}
 
-  //arma::vec3 dx = -rm * center + center;
-  arma::vec3 dx = (-center.t() * rm + center.t()).t();
 
+arma::cube rotate_mask(const arma::cube &mask, const rot_matrix &rm)
+{
   // our affine transformation matrix:
-  affine_transform tform(rm, dx);
+  affine_transform tform = rotation_transform(mask, rm, arma::zeros<arma::vec>(3));
 
   // the interpolation we will use.
   // linear is used to avoid negatives... but we still screen for them below?
@@ -106,10 +249,183 @@ arma::cube rotate_mask(const arma::cube &mask, const rot_matrix &rm)
 
   // do transformation.
   arma::cube mask_r = transform(lin_int, tform, arma::shape(mask));
-  
-  for(size_t i = 0; i < mask_r.n_elem; i++)
-    if( mask_r(i) < 0 )
-      mask_r(i) = 0.0;
+  clip_mask(mask_r);
 
   return mask_r;
 }
+
+
+/**
+  Phase factors exp(sign * 2 pi i * (j - c)/n * a) for j = 0..n-1.
+*/
+static arma::cx_vec axis_phase(arma::uword n, double c, double a, double sign)
+{
+  arma::cx_vec ph(n);
+  for(arma::uword j = 0; j < n; j++)
+    ph(j) = std::polar(1.0, sign * 2.0 * M_PI * (j - c) / n * a);
+  return ph;
+}
+
+arma::cx_cube rotate_vol_fft(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx /* = {0,0,0} */, unsigned int oversample /* = 2 */)
+{
+  if(oversample < 1)
+    throw fatal_error() << "rotate_vol_fft: oversample must be at least 1.";
+
+  arma::uword n_r = vol.n_rows;
+  arma::uword n_c = vol.n_cols;
+  arma::uword n_s = vol.n_slices;
+
+  // The mean is put back at the zero frequency at the end, so that the
+  // zero padding does not add an edge to the volume.
+  double mean = arma::accu(vol) / vol.n_elem;
+
+  arma::cube padded = arma::zeros<arma::cube>(oversample*n_r, oversample*n_c, oversample*n_s);
+  padded(arma::span(0, n_r-1), arma::span(0, n_c-1), arma::span(0, n_s-1)) = vol - mean;
+
+  arma::cx_cube G = fftshift(fft(padded));
+
+  // real space center the rotation is about, and the location of the zero
+  // frequency of each spectrum.
+  arma::vec3 c   = get_center(vol);
+  arma::vec3 g_c = get_fftshift_center(padded);
+  arma::vec3 o_c = get_fftshift_center(vol);
+
+  // Shift the spectrum so that it is of the volume centered at the origin.
+  // This is smooth, so it can be interpolated linearly.
+  arma::cx_vec g0 = axis_phase(G.n_rows,   g_c(0), c(0), 1.0);
+  arma::cx_vec g1 = axis_phase(G.n_cols,   g_c(1), c(1), 1.0);
+  arma::cx_vec g2 = axis_phase(G.n_slices, g_c(2), c(2), 1.0);
+
+  for(arma::uword k = 0; k < G.n_slices; k++)
+    for(arma::uword j = 0; j < G.n_cols; j++)
+      for(arma::uword i = 0; i < G.n_rows; i++)
+        G(i,j,k) *= g0(i) * g1(j) * g2(k);
+
+  // Moves the rotated spectrum back to the center, and applies the
+  // displacement.
+  arma::cx_vec o0 = axis_phase(n_r, o_c(0), c(0) + dx(0), -1.0);
+  arma::cx_vec o1 = axis_phase(n_c, o_c(1), c(1) + dx(1), -1.0);
+  arma::cx_vec o2 = axis_phase(n_s, o_c(2), c(2) + dx(2), -1.0);
+
+  arma::cx_cube out(n_r, n_c, n_s);
+
+  #pragma omp parallel for
+  for(int k = 0; k < (int)n_s; k++)
+  {
+    arma::vec3 f, q;
+
+    for(arma::uword j = 0; j < n_c; j++)
+    {
+      for(arma::uword i = 0; i < n_r; i++)
+      {
+        // frequency of this voxel, in cycles per voxel.
+        f(0) = (i - o_c(0)) / n_r;
+        f(1) = (j - o_c(1)) / n_c;
+        f(2) = (k - o_c(2)) / n_s;
+
+        // the frequency it comes from, as an index into G.
+        q = rm * f;
+        q(0) = q(0) * G.n_rows   + g_c(0);
+        q(1) = q(1) * G.n_cols   + g_c(1);
+        q(2) = q(2) * G.n_slices + g_c(2);
+
+        if( q(0) < 0 || q(0) > G.n_rows-1 || q(1) < 0 || q(1) > G.n_cols-1 || q(2) < 0 || q(2) > G.n_slices-1 )
+        {
+          out(i,j,k) = 0;
+          continue;
+        }
+
+        arma::uword i0 = std::min((arma::uword)q(0), G.n_rows-2);
+        arma::uword j0 = std::min((arma::uword)q(1), G.n_cols-2);
+        arma::uword k0 = std::min((arma::uword)q(2), G.n_slices-2);
+
+        double x = q(0) - i0;
+        double y = q(1) - j0;
+        double z = q(2) - k0;
+
+        std::complex<double> v =
+            (1-z) * ( (1-y) * ((1-x) * G(i0, j0,   k0  ) + x * G(i0+1, j0,   k0  ))
+                    +    y  * ((1-x) * G(i0, j0+1, k0  ) + x * G(i0+1, j0+1, k0  )) )
+          +    z  * ( (1-y) * ((1-x) * G(i0, j0,   k0+1) + x * G(i0+1, j0,   k0+1))
+                    +    y  * ((1-x) * G(i0, j0+1, k0+1) + x * G(i0+1, j0+1, k0+1)) );
+
+        out(i,j,k) = v * o0(i) * o1(j) * o2(k);
+      }
+    }
+  }
+
+  out(o_c(0), o_c(1), o_c(2)) += mean * vol.n_elem;
+
+  return out;
+}
+
+
+void rotate_vol_batch(const arma::cube &vols, const arma::mat &angs, const arma::mat &locs, rotate_mode mode, arma::cube &out)
+{
+  arma::uword n_vol = angs.n_cols;
+
+  if(angs.n_rows != 3 || locs.n_rows != 3 || locs.n_cols != n_vol)
+    throw fatal_error() << "rotate_vol_batch: angs and locs must both be 3 x n.  angs: " << angs.n_rows << " x " << angs.n_cols << " locs: " << locs.n_rows << " x " << locs.n_cols;
+  if(n_vol == 0)
+    return;
+  if(vols.n_slices % n_vol != 0)
+    throw fatal_error() << "rotate_vol_batch: " << vols.n_slices << " slices can not be split into " << n_vol << " volumes.";
+  if(!same_shape(vols, out))
+    throw fatal_error() << "rotate_vol_batch: output must be the same shape as the input.";
+
+  arma::uword n_r = vols.n_rows;
+  arma::uword n_c = vols.n_cols;
+  arma::uword n_s = vols.n_slices / n_vol;
+
+  std::string err;
+
+  #pragma omp parallel
+  {
+    // padded copy for the cubic interpolation, reused by every volume this
+    // thread rotates.
+    arma::cube workspace;
+
+    #pragma omp for schedule(dynamic)
+    for(int i = 0; i < (int)n_vol; i++)
+    {
+      try
+      {
+        // views of the i-th volume of the input and output stacks.
+        const arma::cube vol(const_cast<double *>(vols.slice_memptr(i*n_s)), n_r, n_c, n_s, false, true);
+        arma::cube res(out.slice_memptr(i*n_s), n_r, n_c, n_s, false, true);
+
+        arma::vec3 ang = angs.col(i);
+        arma::vec3 loc = locs.col(i);
+        rot_matrix rm(ang);
+
+        if(mode == ROTATE_MASK)
+        {
+          affine_transform tform = rotation_transform(vol, rm, arma::zeros<arma::vec>(3));
+          linear_interpolater lin_int(vol, 0);
+          transform(lin_int, tform, res);
+          clip_mask(res);
+        }
+        else
+        {
+          affine_transform tform = rotation_transform(vol, rm, loc);
+          cubic_interpolater cub_int(vol, arma::math::nan(), workspace);
+          transform_cubic(cub_int, tform, res);
+
+          if(mode == ROTATE_PAD_MEAN)
+            pad_mean(res);
+          else
+            pad_zero(res);
+        }
+      }
+      catch(std::exception &e)
+      {
+        #pragma omp critical
+        err = e.what();
+      }
+    }
+  }
+
+  // exceptions can not leave an OpenMP region, so rethrow here.
+  if(!err.empty())
+    throw fatal_error() << err;
+}
@@ -34,6 +34,30 @@
 */
 arma::cube transform(const interpolater &inter, affine_transform &at, arma::ivec3 size);
 
+/**
+  Fill an existing volume by interpolation with the given base transformation.
+
+  @param inter Interpolation object to use for values
+  @param at Transformation to act on the cube
+  @param out volume to fill.  Its size determines the points interpolated.
+*/
+void transform(const interpolater &inter, affine_transform &at, arma::cube &out);
+
+/**
+  Specialized version of transform() for cubic interpolation.
+
+  This gives the same result as transform() with a cubic_interpolater, but
+  avoids the per voxel matrix product and virtual call.  Output voxels are
+  visited in memory order, and the source position is updated by adding
+  the step along the first axis.  The Catmull-Rom weights are evaluated
+  into flat arrays and applied directly to the padded data.
+
+  @param inter cubic interpolation object holding the data.
+  @param at Transformation to act on the cube
+  @param out volume to fill.  Its size determines the points interpolated.
+*/
+void transform_cubic(const cubic_interpolater &inter, const affine_transform &at, arma::cube &out);
+
 
 /**
   Rotate the volume.
@@ -81,6 +105,55 @@ arma::cube rotate_vol_pad_zero(const arma::cube &vol, const rot_matrix &rm, cons
 */
 arma::cube rotate_mask(const arma::cube &mask, const rot_matrix &rm);
 
+/**
+  Rotate the volume in Fourier space.
+
+  This gives the centered spectrum fftshift(fft(rotate_vol(vol, rm, dx)))
+  without the real space interpolation.  The spectrum of the zero padded
+  volume is rotated by trilinear interpolation, and the displacement and
+  the rotation center are applied as analytic phase shifts.  Frequencies
+  rotated from outside of the spectrum are zero, and the mean of the
+  volume is kept at the zero frequency, so the result is closest to
+  rotate_vol_pad_mean().
+
+  @param vol the volume to rotate
+  @param rm the rotation matrix to apply
+  @param dx displacement to apply after rotation
+  @param oversample the volume is zero padded by this factor in each
+  dimension before the FFT.  Larger values give more accurate interpolation
+  of the spectrum at the cost of a larger FFT.
+
+  @return Centered spectrum of the rotated volume.
+*/
+arma::cx_cube rotate_vol_fft(const arma::cube &vol, const rot_matrix &rm, const arma::vec3 &dx = arma::zeros<arma::vec>(3), unsigned int oversample = 2);
+
+/**
+  How rotate_vol_batch() treats each volume.
+*/
+enum rotate_mode
+{
+  ROTATE_PAD_MEAN = 0,  /**< as rotate_vol_pad_mean() */
+  ROTATE_PAD_ZERO = 1,  /**< as rotate_vol_pad_zero() */
+  ROTATE_MASK     = 2   /**< as rotate_mask(), the displacement is ignored */
+};
+
+/**
+  Rotate a stack of volumes of the same shape.
+
+  The volumes are split across OpenMP threads.  Each thread reuses a single
+  workspace for the padded cubic interpolation data, so no allocation is
+  done per volume.
+
+  @param vols  n volumes stacked along the slices.  Each volume has
+  vols.n_slices/n slices.
+  @param angs  3 x n matrix of ZYZ Euler angles, one column per volume.
+  @param locs  3 x n matrix of displacements, one column per volume.
+  @param mode  how to pad or clip the rotated volumes.
+  @param out   cube with the same shape as vols.  The rotated volumes are
+  written here.
+*/
+void rotate_vol_batch(const arma::cube &vols, const arma::mat &angs, const arma::mat &locs, rotate_mode mode, arma::cube &out);
+
 /**
   @} // end addtogroup geometry. 
 */
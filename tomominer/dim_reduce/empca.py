@@ -8,7 +8,7 @@ data properly.  This module provides Weighted Expectation Maximization PCA,
 an iterative method for solving PCA while properly weighting data.
 Missing data is simply the limit of weight=0.
 
-Given data[nobs, nvar] and weights[nobs, nvar],
+Given data[nobs, nvar] and weights[nobs, nvar] (or per-column weights[nvar]),
 
     m = empca(data, weights, options...)
 
@@ -42,7 +42,9 @@ class Model(object):
       Inputs: 
         - eigvec [nvec, nvar]
         - data   [nobs, nvar]
-        - weights[nobs, nvar]
+        - weights[nobs, nvar], or per-column weights[nvar]
+        - row_weights[nobs] - optional per-row weights, only with
+          per-column weights; weight[i,j] = row_weights[i]*weights[j]
       
       Calculated from those inputs:
         - coeff  [nobs, nvec] - coeffs to reconstruct data using eigvec
@@ -50,41 +52,74 @@ class Model(object):
     
     Not yet implemented: eigenvalues, mean subtraction/bookkeeping
     """
-    def __init__(self, eigvec, data, weights):
+
+    #- Number of rows solved together when weights vary within rows
+    block_rows = 1024
+
+    def __init__(self, eigvec, data, weights, row_weights=None):
         """
         Create a Model object with eigenvectors, data, and weights.
         
         Dimensions:
           - eigvec [nvec, nvar]  = [k, j]
           - data   [nobs, nvar]  = [i, j]
-          - weights[nobs, nvar]  = [i, j]
+          - weights[nobs, nvar]  = [i, j], or weights[nvar] = [j]
+          - row_weights[nobs]    = [i]
           - coeff  [nobs, nvec]  = [i, k]        
         """
         self.eigvec = eigvec
         self.nvec = eigvec.shape[0]
         
-        self.set_data(data, weights)
+        self.set_data(data, weights, row_weights)
 
         
-    def set_data(self, data, weights):
+    def set_data(self, data, weights, row_weights=None):
         """
         Assign a new data[nobs,nvar] and weights[nobs,nvar] to use with
         the existing eigenvectors.  Recalculates the coefficients and
         model fit.
+
+        weights may also be per-column weights[nvar], optionally combined
+        with per-row row_weights[nobs].  These are broadcast in every
+        solve, so no nobs x nvar weight matrix is ever built.
         """
         self.data = data
         self.weights = weights
+        self.row_weights = row_weights
 
         self.nobs = data.shape[0]
         self.nvar = data.shape[1]
-        self.coeff = N.zeros( (self.nobs, self.nvec) )
-        self.model = N.zeros( self.data.shape )
+        self.coeff = N.zeros( (self.nobs, self.nvec), dtype=data.dtype )
+        self.model = N.zeros( self.data.shape, dtype=data.dtype )
+
+        if weights.ndim == 1:
+            assert weights.shape == (self.nvar,)
+            self._col_weights = weights
+        else:
+            assert weights.shape == data.shape and row_weights is None
+            #- If every row has the same weights, they are per-column
+            #- weights and a single nvec x nvec system solves all rows
+            if N.all(weights == weights[0]):
+                self._col_weights = weights[0]
+            else:
+                self._col_weights = None
+        if row_weights is not None:
+            assert row_weights.shape == (self.nobs,)
         
-        #- Calculate degrees of freedom
-        ii = N.where(self.weights>0)
-        self.dof = self.data[ii].size - self.eigvec.size  - self.nvec*self.nobs
+        #- Calculate degrees of freedom, and cache variance of unmasked data
+        if self._col_weights is None:
+            ii = N.where(self.weights>0)
+            n_unmasked = ii[0].size
+        else:
+            cols = self._col_weights > 0
+            rows = N.ones(self.nobs, dtype=bool) if row_weights is None else row_weights > 0
+            if N.all(cols) and N.all(rows):
+                ii = Ellipsis
+            else:
+                ii = N.ix_(N.flatnonzero(rows), N.flatnonzero(cols))
+            n_unmasked = N.count_nonzero(rows) * N.count_nonzero(cols)
+        self.dof = n_unmasked - self.eigvec.size  - self.nvec*self.nobs
         
-        #- Cache variance of unmasked data
         self._unmasked = ii
         self._unmasked_data_var = N.var(self.data[ii])
         
@@ -94,12 +129,38 @@ class Model(object):
         """
         Solve for c[i,k] such that data[i] ~= Sum_k: c[i,k] eigvec[k]
         """
-        for i in range(self.nobs):
-            #- Only do weighted solution if really necessary
-            if N.any(self.weights[i] != self.weights[i,0]):
-                self.coeff[i] = _solve(self.eigvec.T, self.data[i], self.weights[i])
+        P = self.eigvec
+
+        if self._col_weights is not None:
+            #- Row weights cancel out of each row's solution; rows with
+            #- zero weight get the unweighted projection like uniform rows
+            w = self._col_weights
+            if N.all(w == w[0]):
+                self.coeff[:] = self.data.dot(P.T)
             else:
-                self.coeff[i] = N.dot(self.eigvec, self.data[i])
+                A = (P * w).dot(P.T)
+                b = (self.data * w).dot(P.T)
+                self.coeff[:] = _solve_stacked(A[N.newaxis], b[:, :, N.newaxis])[:, :, 0]
+                if self.row_weights is not None:
+                    zero = self.row_weights == 0
+                    self.coeff[zero] = self.data[zero].dot(P.T)
+            self.solve_model()
+            return
+
+        #- Only do weighted solution if really necessary
+        uniform = N.all(self.weights == self.weights[:, :1], axis=1)
+        self.coeff[uniform] = self.data[uniform].dot(P.T)
+
+        #- Blocked normal equations A[i] c[i] = b[i] for the remaining rows
+        rows = N.flatnonzero(~uniform)
+        for start in range(0, rows.size, self.block_rows):
+            r = rows[start:start+self.block_rows]
+            w = self.weights[r]
+            A = N.empty( (r.size, self.nvec, self.nvec), dtype=self.coeff.dtype )
+            for k in range(self.nvec):
+                A[:, k, :] = (w * P[k]).dot(P.T)
+            b = (w * self.data[r]).dot(P.T)
+            self.coeff[r] = _solve_stacked(A, b[:, :, N.newaxis])[:, :, 0]
             
         self.solve_model()
             
@@ -115,28 +176,24 @@ class Model(object):
         #- Make copy of data so we can modify it
         data = self.data.copy()
 
-        #- Solve the eigenvectors one by one
+        #- Solve the eigenvectors one by one, all variables j at once:
+        #- eigvec[k, j] = Sum_i c[i] w[i,j] x[i,j] / Sum_i c[i] w[i,j] c[i]
+        w = self._col_weights
+        r = self.row_weights
         for k in range(self.nvec):
 
-            #- Can we compact this loop into numpy matrix algebra?
             c = self.coeff[:, k]
-            for j in range(self.nvar):
-                w = self.weights[:, j]
-                x = data[:, j]
-                # self.eigvec[k, j] = c.dot(w*x) / c.dot(w*c)
-                # self.eigvec[k, j] = w.dot(c*x) / w.dot(c*c)
-                cw = c*w
-                self.eigvec[k, j] = x.dot(cw) / c.dot(cw)
+            if w is not None:
+                cr = c if r is None else c*r
+                self.eigvec[k] = (w * cr.dot(data)) / (w * cr.dot(c))
+            else:
+                self.eigvec[k] = c.dot(self.weights * data) / (c*c).dot(self.weights)
                                                 
             if smooth is not None:
                 self.eigvec[k] = smooth(self.eigvec[k])
 
             #- Remove this vector from the data before continuing with next
             #? Alternate: Resolve for coefficients before subtracting?
-            #- Loop replaced with equivalent N.outer(c,v) call (faster)
-            # for i in range(self.nobs):
-            #     data[i] -= self.coeff[i,k] * self.eigvec[k]
-                                
             data -= N.outer(self.coeff[:,k], self.eigvec[k])    
 
         #- Renormalize and re-orthogonalize the answer
@@ -155,15 +212,19 @@ class Model(object):
         """
         Uses eigenvectors and coefficients to model data
         """
-        for i in range(self.nobs):
-            self.model[i] = self.eigvec.T.dot(self.coeff[i])
+        self.model[:] = self.coeff.dot(self.eigvec)
                        
     def chi2(self):
         """
         Returns sum( (model-data)^2 / weights )
         """
-        delta = (self.model - self.data) * N.sqrt(self.weights)
-        return N.sum(delta**2)
+        delta = self.model - self.data
+        if self._col_weights is None:
+            return N.sum(delta**2 * self.weights)
+        chi2 = (delta**2).dot(self._col_weights)
+        if self.row_weights is None:
+            return N.sum(chi2)
+        return self.row_weights.dot(chi2)
         
     def rchi2(self):
         """
@@ -255,54 +316,90 @@ def _solve(A, b, w):
         
     return x
 
+def _solve_stacked(A, b):
+    """
+    Solve A[i] x[i] = b[i] for a stack of small systems; return x
+    
+    A : 3D array [n, nvec, nvec], or [1, nvec, nvec] shared by every b
+    b : 3D array [n, nvec, 1]
+    
+    Falls back to least squares per system if any of them is singular.
+    """
+    try:
+        return N.linalg.solve(A, b)
+    except N.linalg.LinAlgError:
+        A = N.broadcast_to(A, (b.shape[0],) + A.shape[1:])
+        x = N.empty(b.shape, dtype=b.dtype)
+        for i in range(b.shape[0]):
+            x[i] = N.linalg.lstsq(A[i], b[i], rcond=-1)[0]
+        return x
     
 #-------------------------------------------------------------------------
 
-def empca(data, weights=None, niter=25, nvec=5, smooth=0, randseed=1):
+def empca(data, weights=None, niter=25, nvec=5, smooth=0, randseed=1, dtype=None, row_weights=None, eigvec=None, tol=None):
     """
     Iteratively solve data[i] = Sum_j: c[i,j] p[j] using weights
     
     Input:
       - data[nobs, nvar]
-      - weights[nobs, nvar]
+      - weights[nobs, nvar], or per-column weights[nvar]
       
     Optional:
       - niter    : maximum number of iterations
       - nvec     : number of model vectors
       - smooth   : smoothing length scale (0 for no smoothing)
       - randseed : random number generator seed; None to not re-initialize
+      - dtype    : solve in this precision (e.g. N.float32); None keeps
+                   the precision of data
+      - row_weights : per-row weights[nobs], combined with per-column
+                      weights as weight[i,j] = row_weights[i]*weights[j]
+      - eigvec   : starting eigenvectors[nvec, nvar], e.g. from a previous
+                   fit of similar data; None for a random start
+      - tol      : stop before niter once no eigenvector changes by more
+                   than tol (1 - |cos| of the angle to its previous value)
     
     Returns Model object
     """
 
+    if dtype is not None:
+        data = N.asarray(data, dtype=dtype)
+        if weights is not None:
+            weights = N.asarray(weights, dtype=dtype)
+        if row_weights is not None:
+            row_weights = N.asarray(row_weights, dtype=dtype)
+
+    #- Basic dimensions
+    nobs, nvar = data.shape
+
     if weights is None:
-        weights = N.ones(data.shape)
+        weights = N.ones(nvar, dtype=data.dtype)
 
     if smooth>0:
         smooth = SavitzkyGolay(width=smooth)
     else:
         smooth = None
 
-    #- Basic dimensions
-    nobs, nvar = data.shape
-    assert data.shape == weights.shape
-
-    #- degrees of freedom for reduced chi2
-    ii = N.where(weights > 0)
-    dof = data[ii].size - nvec*nvar - nvec*nobs 
-
-    #- Starting random guess
-    eigvec = _random_orthonormal(nvec, nvar, seed=randseed)
+    #- Starting guess, random unless given
+    if eigvec is None:
+        eigvec = _random_orthonormal(nvec, nvar, seed=randseed).astype(data.dtype)
+    else:
+        assert eigvec.shape == (nvec, nvar)
+        eigvec = N.linalg.qr(N.array(eigvec, dtype=data.dtype).T)[0].T.copy()
     
-    model = Model(eigvec, data, weights)
+    model = Model(eigvec, data, weights, row_weights)
     model.solve_coeffs()
     
     #print "       iter    chi2/dof     drchi_E     drchi_M   drchi_tot       R2            rchi2"
     #print "       iter        R2             rchi2"
     
     for k in range(niter):
+        previous = model.eigvec.copy()
         model.solve_coeffs()
         model.solve_eigenvectors(smooth=smooth)
+        if tol is not None:
+            change = 1.0 - N.abs(N.sum(model.eigvec * previous, axis=1))
+            if N.max(change) < tol:
+                break
     #    sys.stdout.write( '\rEMPCA %2d/%2d  %15.8f %15.8f             ' % (k+1, niter, model.R2(), model.rchi2()) )
     #    sys.stdout.flush()
 
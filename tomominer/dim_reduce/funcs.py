@@ -18,8 +18,8 @@ def dimension_reduction_randomized_pca_transform(pca, avg_vol, data, inds):
   :todo: documentation
   """
 
-  mat = dimension_reduction_randomized_pca_stack_dif(avg_vol, data)
-  red = pca.fit_transform(mat)
+  mat = dimension_reduction_randomized_pca_stack_diff(avg_vol, data)
+  red = pca.transform(mat)
 
   return {'inds':inds, 'red':red}
 
@@ -57,13 +57,14 @@ def dimension_reduction_randomized_pca_train(dims, avg_vol_key, data, transform=
 
   mat = dimension_reduction_randomized_pca_stack_diff(avg_vol_key, data)
 
-  from sklearn.decomposition import RandomizedPCA
-  pca = RandomizedPCA(n_components=dims)
+  # RandomizedPCA was removed from scikit-learn in 0.20.
+  from sklearn.decomposition import PCA
+  pca = PCA(n_components=dims, svd_solver='randomized')
   pca.fit(mat)
 
   if not transform:
     return pca
 
-  red = pca.fit_transform(mat)
+  red = pca.transform(mat)
   return pca, red
 
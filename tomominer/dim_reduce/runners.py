@@ -3,6 +3,7 @@ import os.path
 
 import pickle
 import sys
+import tempfile
 
 import time
 import random
@@ -16,7 +17,8 @@ from numpy.fft import fftn, ifftn, fftshift, ifftshift
 from math import sqrt
 
 from tomominer.common import get_mrc, put_mrc
-from tomominer.parallel import Runner
+from tomominer.common.checkpoint import stamp, is_current
+from tomominer.parallel import get_runner
 from tomominer import core
 
 from funcs import dimension_reduction_randomized_pca_train
@@ -24,7 +26,7 @@ from empca import empca
 from worker_funcs import neighbor_product
 
 
-def pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_sigma=0, voxel_mask_inds=None):
+def pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_sigma=0, voxel_mask_inds=None, fourier_oversample=0):
   """
   :todo: documentation
 
@@ -33,9 +35,11 @@ def pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_si
   :param global_avg_vm: Disk location of average volume, and mask
   :param smoothing_gauss_sigma: ???
   :param voxel_mask_inds Indices: to be used in the dimension reduction.
+  :param fourier_oversample: If positive, rotate in Fourier space with this
+  oversampling factor.
   """
 
-  runner = Runner(host, port)
+  runner = get_runner(host, port)
 
   # TODO: better method.
   #chunk_size = max(len(vmal)/50, 20)
@@ -43,35 +47,165 @@ def pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_si
 
   avg_vol_key, avg_mask_key = global_avg_vm
 
+  if voxel_mask_inds is not None:
+    n_features = len(voxel_mask_inds)
+  else:
+    n_features = get_mrc(avg_vol_key).size
+
+  # Each task saves its rows to a file of its own.  pass_dir is usually on
+  # a shared filesystem, where writes from several hosts to one file can
+  # overwrite each other.  The chunks are copied into the matrix here.
   tasks = []
+  task_rows = {}
+  for idx in range(0, len(vmal), chunk_size):
+    t = runner.make_task('dim_reduce.pca_stack_diff', args=(avg_vol_key, avg_mask_key, vmal[idx:idx+chunk_size], smoothing_gauss_sigma, voxel_mask_inds, pass_dir, fourier_oversample))
+    tasks.append(t)
+    task_rows[t.task_id] = idx
+
+  mat = np.empty((len(vmal), n_features))
+  for res in runner.run_batch(tasks):
+    idx = task_rows[res.task_id]
+    rows = np.load(res.result)
+    mat[idx:idx+rows.shape[0]] = rows
+    os.remove(res.result)
+
+  return mat
+
+
+def distributed_pca(host, port, vmal, dims, global_avg_vm, pass_dir, voxel_mask_inds, feature_weights, smoothing_gauss_sigma=0, fourier_oversample=0):
+  """
+  Weighted PCA of the masked differences, without collecting the difference
+  matrix on one node.
+
+  The workers compute the weighted differences of their chunk and its Gram
+  matrix (n_features x n_features).  Only these are summed here, and the
+  leading eigenvectors found.  The workers then project their own rows onto
+  the eigenvectors and return the coefficients of their chunk.
+
+  With a weight per feature, this is the same subspace that empca converges
+  to, so no iterations are needed.
+
+  :param host: Host where a tm_server instance is running
+  :param port: Port where a tm_server instance is running
+  :param vmal: List of (volume, mask, angle, loc) tuples.
+  :param dims: Number of dimensions to reduce to.
+  :param global_avg_vm: Disk location of average volume, and mask
+  :param pass_dir: Temporary file location.
+  :param voxel_mask_inds: Indices of the voxels used as features.
+  :param feature_weights: Weight of each feature.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param fourier_oversample: If positive, rotate in Fourier space with this
+  oversampling factor.
+
+  :returns: Coefficients, shape (len(vmal), dims), in vmal order.
+  """
+
+  runner = get_runner(host, port)
+
+  chunk_size = int(sqrt(len(vmal)))
+
+  avg_vol_key, avg_mask_key = global_avg_vm
 
+  tasks = []
   task_order = {}
   for i,idx in enumerate(range(0, len(vmal), chunk_size)):
-    t = runner.make_task('dim_reduce.pca_stack_diff', args=(avg_vol_key, avg_mask_key, vmal[idx:idx+chunk_size], smoothing_gauss_sigma, voxel_mask_inds, pass_dir))
+    t = runner.make_task('dim_reduce.pca_gram_partial', args=(avg_vol_key, avg_mask_key, vmal[idx:idx+chunk_size], smoothing_gauss_sigma, voxel_mask_inds, feature_weights, pass_dir, fourier_oversample))
     tasks.append(t)
     task_order[t.task_id] = i
 
-  rows = [None for _ in range(len(tasks))]
+  partials = [None for _ in range(len(tasks))]
+  gram = None
+  for res in runner.run_batch(tasks):
+    rows_key, gram_key = res.result
+    partials[task_order[res.task_id]] = rows_key
+
+    if gram is None:
+      gram = np.load(gram_key)
+    else:
+      gram += np.load(gram_key)
+    os.remove(gram_key)
 
+  # leading eigenvectors of the weighted covariance.  eigh returns them in
+  # increasing order of eigenvalue.
+  dims = min(dims, gram.shape[0])
+  evals, evecs = np.linalg.eigh(gram)
+  eigvec = evecs[:, ::-1][:, :dims]
+
+  tasks = []
+  task_order = {}
+  for i,rows_key in enumerate(partials):
+    t = runner.make_task('dim_reduce.pca_project_partial', args=(rows_key, eigvec))
+    tasks.append(t)
+    task_order[t.task_id] = i
+
+  coeffs = [None for _ in range(len(tasks))]
   for res in runner.run_batch(tasks):
-    rows[task_order[res.task_id]] = res.result
+    coeffs[task_order[res.task_id]] = res.result
 
-  t = runner.make_task('dim_reduce.pca_stack_diff_merge', allow_resubmit=False, args=(rows, pass_dir))
-  res = runner.run_single(t)
+  for rows_key in partials:
+    os.remove(rows_key)
 
-  for r in rows:
-    os.remove(r)
+  return np.vstack(coeffs)
 
-  #return res
-  # actually return the loaded data.
-  return np.load(res.result)
 
-  # TODO: In Min's version the matrices are returned directly to the root
-  # node, where they are combined instead of being merged on a computational node.
-  #return np.vstack(rows)
+def randomized_pca(host, port, vmal, dims, global_avg_vm, pass_dir, voxel_mask_inds, feature_weights, fit_vmal, smoothing_gauss_sigma=0, fourier_oversample=0, n_power_iter=4, seed=0):
+  """
+  Weighted PCA of the masked differences, fitted with a randomized SVD on a
+  subset of the subtomograms and then applied to all of them.
 
+  Only the rows of fit_vmal are collected on this node, so the cost of the
+  fit depends on the subset size and not on len(vmal).  The projection of
+  all subtomograms is split into tasks like the other runners.
 
-def neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_sigma=0):
+  :param host: Host where a tm_server instance is running
+  :param port: Port where a tm_server instance is running
+  :param vmal: List of (volume, mask, angle, loc) tuples to reduce.
+  :param dims: Number of dimensions to reduce to.
+  :param global_avg_vm: Disk location of average volume, and mask
+  :param pass_dir: Temporary file location.
+  :param voxel_mask_inds: Indices of the voxels used as features.
+  :param feature_weights: Weight of each feature.
+  :param fit_vmal: Subset of vmal used to fit the components.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param fourier_oversample: If positive, rotate in Fourier space with this
+  oversampling factor.
+  :param n_power_iter: Number of power iterations of the randomized SVD.
+  :param seed: Random seed of the randomized SVD.
+
+  :returns: Coefficients, shape (len(vmal), dims), in vmal order.
+  """
+
+  from sklearn.utils.extmath import randomized_svd
+
+  mat = pca_stack_diff(host, port, fit_vmal, global_avg_vm, pass_dir, smoothing_gauss_sigma, voxel_mask_inds, fourier_oversample)
+  mat *= np.sqrt(np.maximum(feature_weights, 0))
+
+  dims = min(dims, min(mat.shape))
+  u, s, vt = randomized_svd(mat, n_components=dims, n_iter=n_power_iter, random_state=seed)
+  eigvec = vt.T
+  del mat
+
+  runner = get_runner(host, port)
+
+  chunk_size = int(sqrt(len(vmal)))
+
+  avg_vol_key, avg_mask_key = global_avg_vm
+
+  tasks = []
+  task_order = {}
+  for i,idx in enumerate(range(0, len(vmal), chunk_size)):
+    t = runner.make_task('dim_reduce.pca_transform_partial', args=(avg_vol_key, avg_mask_key, vmal[idx:idx+chunk_size], smoothing_gauss_sigma, voxel_mask_inds, feature_weights, eigvec, fourier_oversample))
+    tasks.append(t)
+    task_order[t.task_id] = i
+
+  coeffs = [None for _ in range(len(tasks))]
+  for res in runner.run_batch(tasks):
+    coeffs[task_order[res.task_id]] = res.result
+
+  return np.vstack(coeffs)
+
+
+def neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir, smoothing_gauss_sigma=0, fourier_oversample=0):
   """
   TODO: documentation
 
@@ -82,10 +216,12 @@ def neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir,
   :param avg_key:
   :param data:
   :param smoothing_gauss_sigma:
+  :param fourier_oversample: If positive, rotate in Fourier space with this
+  oversampling factor.
   """
 
   start_time = time.time()
-  runner = Runner(host, port)
+  runner = get_runner(host, port)
 
   tasks = []
   # TODO: better method.
@@ -96,7 +232,7 @@ def neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir,
   avg_vol_key, avg_mask_key = global_avg_vm
 
   for i in range(0, len(vmal), chunk_size):
-    t = runner.make_task('dim_reduce.neighbor_covariance_collect_info', args=(avg_vol_key, avg_mask_key, vmal[i:i+chunk_size], pass_dir))
+    t = runner.make_task('dim_reduce.neighbor_covariance_collect_info', args=(avg_vol_key, avg_mask_key, vmal[i:i+chunk_size], pass_dir), kwargs=dict(fourier_oversample=fourier_oversample))
     tasks.append(t)
 
 
@@ -133,7 +269,39 @@ def neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir,
 # Code dumped from filtering/gaussian.py and general_util/vol.py
 
 
-def covariance_filtered_pca(host, port, vmal, dims, global_avg_vm, cov_avg_file, pass_dir, gauss_smoothing_sigma=0, max_features=1000, n_iter=15):
+def _load_dim_reduce_state(state_file):
+  """
+  Load the state saved by covariance_filtered_pca() as a dict.
+  """
+
+  state = np.load(state_file)
+  d = dict((k, state[k]) for k in state.files)
+  state.close()
+  return d
+
+
+def _map_eigvec(eigvec, old_inds, new_inds):
+  """
+  Carry eigenvectors over to a new set of features.  Features that are not
+  in old_inds start at zero.  Both index arrays are sorted, as returned by
+  np.flatnonzero().
+
+  :returns: Array (nvec, len(new_inds)), or None if the carried over vectors
+  are not linearly independent.
+  """
+
+  seed = np.zeros((eigvec.shape[0], len(new_inds)))
+
+  pos   = np.minimum(np.searchsorted(old_inds, new_inds), len(old_inds)-1)
+  found = old_inds[pos] == new_inds
+  seed[:, found] = eigvec[:, pos[found]]
+
+  if np.linalg.matrix_rank(seed) < seed.shape[0]:
+    return None
+  return seed
+
+
+def covariance_filtered_pca(host, port, vmal, dims, global_avg_vm, cov_avg_file, pass_dir, gauss_smoothing_sigma=0, max_features=1000, n_iter=15, fourier_oversample=0, distributed=False, method='empca', subset_size=1000, state_file=None, prev_state_file=None, reuse_threshold=0.0, cov_fingerprint=None, seed=0):
   """
   Calculate average covariance between neighbor voxels, then gaussian smooth
   and segment to identify a small amount of voxels as features for PCA
@@ -151,8 +319,37 @@ def covariance_filtered_pca(host, port, vmal, dims, global_avg_vm, cov_avg_file,
   :param gauss_smoothing_sigma:
   :param max_features:
   :param n_iter:
+  :param fourier_oversample: If positive, rotate in Fourier space with this
+  oversampling factor.
+  :param distributed: If true, use distributed_pca() instead of collecting
+  the difference matrix and running empca.  n_iter is not used.
+  :param method: 'empca', or 'randomized' to fit the neighbor covariance and
+  a randomized PCA on a random subset of subset_size subtomograms and then
+  project all of them with randomized_pca().  distributed only applies to
+  'empca'.
+  :param subset_size: Number of subtomograms used to fit with 'randomized'.
+  :param seed: Random seed of the 'randomized' subset and SVD, so that the
+  same inputs give the same result.  Include it in cov_fingerprint.
+  :param state_file: If given, save the average, covariance, features and
+  eigenvectors here, for a warm start of the next pass.
+  :param prev_state_file: state_file of the previous pass.  Its eigenvectors
+  seed empca, which then stops once they converge instead of after n_iter
+  iterations.  Its covariance is reused when the global average has moved
+  by at most reuse_threshold (relative norm of the change).
+  :param reuse_threshold: See prev_state_file.
+  :param cov_fingerprint: If given, an existing cov_avg_file is only used if
+  it was saved with this fingerprint of its inputs (see
+  common.checkpoint), and the fingerprint is recorded when it is saved.
   """
 
+  if method not in ('empca', 'randomized'):
+    raise ValueError("unknown dimension reduction method: %s" % method)
+
+  if method == 'randomized' and subset_size < len(vmal):
+    fit_vmal = random.Random(seed).sample(vmal, subset_size)
+  else:
+    fit_vmal = vmal
+
   # Other parameters:
   #
   # * cov_avg_min_cutoff_ratio=0.0
@@ -166,18 +363,49 @@ def covariance_filtered_pca(host, port, vmal, dims, global_avg_vm, cov_avg_file,
 
   start_time = time.time()
 
+  avg_vol = None
+  if state_file is not None or prev_state_file is not None:
+    avg_vol = get_mrc(global_avg_vm[0])
+
+  prev = None
+  reuse_cov = False
+  if prev_state_file is not None and os.path.exists(prev_state_file):
+    prev = _load_dim_reduce_state(prev_state_file)
+    if prev['avg_vol'].shape == avg_vol.shape:
+      moved = np.linalg.norm(avg_vol - prev['avg_vol']) / np.linalg.norm(prev['avg_vol'])
+      reuse_cov = moved <= reuse_threshold
+      logging.info("Global average moved by %f since the previous pass, %s the covariance", moved, "reusing" if reuse_cov else "recomputing")
+    else:
+      prev = None
+
   # TODO: wrap the load in a try, if it fails also do else case.
 
   # try to load existing covariance data.
-  if os.path.exists(cov_avg_file):
+  if cov_fingerprint is None:
+    cov_current = os.path.exists(cov_avg_file)
+  else:
+    cov_current = is_current(cov_avg_file, cov_fingerprint)
+
+  if cov_current:
     with open(cov_avg_file) as f:
       cov_avg = np.load(f)
+  elif reuse_cov:
+    cov_avg = prev['cov_avg']
+
+    with open(cov_avg_file, 'wb') as f:
+      np.save(f, cov_avg)
+    if cov_fingerprint is not None:
+      stamp(cov_avg_file, cov_fingerprint)
   else:
     # If the covariance data does not exists, calculate it, and save the data.
-    cov_avg = neighbor_covariance_avg_parallel(host, port, vmal, global_avg_vm, pass_dir, gauss_smoothing_sigma)
+    cov_avg = neighbor_covariance_avg_parallel(host, port, fit_vmal, global_avg_vm, pass_dir, gauss_smoothing_sigma, fourier_oversample)
 
     with open(cov_avg_file, 'wb') as f:
       np.save(f, cov_avg)
+    if cov_fingerprint is not None:
+      stamp(cov_avg_file, cov_fingerprint)
+
+  cov_avg_raw = cov_avg
 
   if gauss_smoothing_sigma > 0:
     cov_avg = utils.smooth(cov_avg, sigma=gauss_smoothing_sigma)
@@ -199,28 +427,51 @@ def covariance_filtered_pca(host, port, vmal, dims, global_avg_vm, cov_avg_file,
   # extract indices of cov_avg greater then cutoff.
   voxel_mask_inds = np.flatnonzero(cov_avg > cutoff)
 
-  # perform PCA using only the voxels determined by voxel_mask_inds
-  mat = pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, gauss_smoothing_sigma, voxel_mask_inds)
+  eigvec = None
 
-  # For now skip the masking stage.
-#  # Mask out missing values
-#  empca_weight = ~np.isnan(mat)
-#  mat[~empca_weight] = 0.0
+  if method == 'randomized':
+    feature_weights = cov_avg.flatten()[voxel_mask_inds]
+    red = randomized_pca(host, port, vmal, dims, global_avg_vm, pass_dir, voxel_mask_inds, feature_weights, fit_vmal, gauss_smoothing_sigma, fourier_oversample, seed=seed)
 
-  empca_weight = np.ones(mat.shape)
+  elif distributed:
+    feature_weights = cov_avg.flatten()[voxel_mask_inds]
+    red = distributed_pca(host, port, vmal, dims, global_avg_vm, pass_dir, voxel_mask_inds, feature_weights, gauss_smoothing_sigma, fourier_oversample)
 
-  # weight every feature according to its corresponding average correlation
-  cov_avg = cov_avg.flatten()
-  for i, ind_t in enumerate(voxel_mask_inds):
-    empca_weight[:,i] *= cov_avg[ind_t]
+  else:
+    # perform PCA using only the voxels determined by voxel_mask_inds
+    mat = pca_stack_diff(host, port, vmal, global_avg_vm, pass_dir, gauss_smoothing_sigma, voxel_mask_inds, fourier_oversample)
+
+    # For now skip the masking stage.
+#    # Mask out missing values
+#    empca_weight = ~np.isnan(mat)
+#    mat[~empca_weight] = 0.0
+
+    # weight every feature according to its corresponding average correlation.
+    # empca broadcasts per-column weights, so no weight matrix is needed.
+    empca_weight = cov_avg.flatten()[voxel_mask_inds]
 
-  # note: need to watch out the R2 values to see how much variation can be
-  # explained by the estimated model, if the value is small, need to increase
-  # dims
-  pca = empca(data=mat, weights=empca_weight, nvec=dims, niter=n_iter)
+    seed = None
+    if prev is not None and 'eigvec' in prev and prev['eigvec'].shape[0] == dims:
+      seed = _map_eigvec(prev['eigvec'], prev['voxel_mask_inds'], voxel_mask_inds)
 
-  red = pca.coeff
+    # note: need to watch out the R2 values to see how much variation can be
+    # explained by the estimated model, if the value is small, need to increase
+    # dims
+    if seed is None:
+      pca = empca(data=mat, weights=empca_weight, nvec=dims, niter=n_iter)
+    else:
+      pca = empca(data=mat, weights=empca_weight, nvec=dims, niter=n_iter, eigvec=seed, tol=1e-6)
+
+    red = pca.coeff
+    eigvec = pca.eigvec
 
   #print "PCA with covariange thresholding  : %2.6f sec" % (time.time() - start_time)
 
+  if state_file is not None:
+    state = dict(avg_vol=avg_vol, cov_avg=cov_avg_raw, voxel_mask_inds=voxel_mask_inds)
+    if eigvec is not None:
+      state['eigvec'] = eigvec
+    with open(state_file, 'wb') as f:
+      np.savez(f, **state)
+
   return red
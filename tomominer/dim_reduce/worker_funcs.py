@@ -7,21 +7,45 @@ from numpy.fft import fftn, ifftn, fftshift, ifftshift
 
 from tomominer import core
 from tomominer import filtering
+from tomominer.common import prefetch_vmal
+from tomominer.parallel.profiling import phase
 
-def neighbor_product(v):
+# The 26 neighbor offsets come in pairs s, -s.  The product for -s is the
+# product for s shifted by -s, so only these 13 need to be computed.
+_half_offsets = [(sx, sy, sz) for sx in [-1, 0, 1] for sy in [-1, 0, 1] for sz in [-1, 0, 1] if (sx, sy, sz) > (0, 0, 0)]
+
+
+def _periodic_shifts(v):
   """
-  :TODO: documentation
+  Pad v by one voxel on each side, wrapping around the edges, and return a
+  function giving views of v shifted by an offset, as np.roll(v, offset)
+  would, but without copying.
+  """
+  vp = np.pad(v, 1, mode='wrap')
+  X, Y, Z = v.shape
+
+  def shifted(sx, sy, sz):
+    return vp[1-sx:1-sx+X, 1-sy:1-sy+Y, 1-sz:1-sz+Z]
+  return shifted
 
+
+def neighbor_product(v):
+  """
   Calculate product of one voxel and all its neighbors
 
-  :param v:
+  For every possible shift by +/- 1 in any direction, calculate the product
+  of the volume with the (periodically) shifted volume.
+
+  :param v: volume
+
+  :returns: Array of shape v.shape + (26,), one product per shift.
   """
 
-  # For every possible shift by +/- 1 in any direction, calculate the dot product between then two volumes.  We will store the total values in the 
   siz = list(v.shape)
   siz.append(26)
 
   P = np.zeros(siz, dtype=np.float32)
+  shifted = _periodic_shifts(v)
 
   i = 0
   for sx in [-1, 0, 1]:
@@ -29,46 +53,81 @@ def neighbor_product(v):
       for sz in [-1, 0, 1]:
         if (sx,sy,sz) == (0,0,0):
           continue
-        v2 = v.copy()
-        v2 = np.roll(v2, sx, axis=0)
-        v2 = np.roll(v2, sy, axis=1)
-        v2 = np.roll(v2, sz, axis=2)
-
-        P[:,:,:,i] = v * v2;
+        P[:,:,:,i] = v * shifted(sx, sy, sz)
         i = i+1
   return P
 
 
-def pca_stack_diff(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, pass_dir):
+def neighbor_product_accumulate(v, acc, tmp=None):
   """
-  Calculate masked differences between subtomograms and gloval average, and
-  form a matrix stacking all differences
+  Add the neighbor products of v for the 13 offsets in _half_offsets into
+  acc, in place.  Summing these over many volumes and then calling
+  neighbor_product_fold() gives the sum over all 26 neighbors, without
+  keeping a 26 channel array per volume.
 
-  :TODO: documentation.
+  :param v: volume
+  :param acc: Array of shape (13,) + v.shape to add to.
+  :param tmp: Optional scratch array of shape v.shape.
 
-  :param data:
-  :param avg_key:
-  :param pass_dir:
+  :returns: acc
   """
 
-  vol_avg  = core.read_mrc(avg_vol_key)
-  mask_avg = core.read_mrc(avg_mask_key)
+  if tmp is None:
+    tmp = np.empty(v.shape, dtype=acc.dtype)
 
-  rows = []
+  shifted = _periodic_shifts(v)
 
-  for vol_key, mask_key, ang, loc in vmal:
-    vol  = core.read_mrc(vol_key)
-    mask = core.read_mrc(mask_key)
+  for i, s in enumerate(_half_offsets):
+    np.multiply(v, shifted(*s), out=tmp)
+    acc[i] += tmp
+  return acc
 
-    vol_diff, mask_rot = masked_difference_given_vol_avg_fft(vol, mask, ang, loc, vol_avg, mask_avg, smoothing_gauss_sigma)
 
-    vol_diff = vol_diff.flatten()
-    if voxel_mask_inds is not None:
-       vol_diff =  vol_diff[voxel_mask_inds]
+def neighbor_product_fold(acc):
+  """
+  Sum the 13 half offset products from neighbor_product_accumulate() over
+  all 26 neighbors.  The product for offset -s is the product for s shifted
+  by -s.
 
-    rows.append(vol_diff)
+  :param acc: Array of shape (13,) + volume shape.
 
-  mat = np.vstack(rows)
+  :returns: Array of the volume shape.
+  """
+
+  total = np.zeros(acc.shape[1:], dtype=acc.dtype)
+  for i, s in enumerate(_half_offsets):
+    total += acc[i]
+    total += np.roll(np.roll(np.roll(acc[i], -s[0], axis=0), -s[1], axis=1), -s[2], axis=2)
+  return total
+
+
+def pca_stack_diff(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, pass_dir, fourier_oversample=0):
+  """
+  Calculate masked differences between subtomograms and the global average,
+  and save the matrix stacking them in a file of its own.
+
+  :param avg_vol_key: Global average volume.
+  :param avg_mask_key: Global average mask.
+  :param vmal: List of (volume, mask, angle, loc) tuples.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param voxel_mask_inds: Indices of the voxels to keep, or None for all.
+  :param pass_dir: Where to write the output.
+  :param fourier_oversample: See masked_difference_given_vol_avg_fft().
+
+  :returns: Name of a .npy file with the (len(vmal), n_features) matrix.
+  """
+
+  vol_avg  = core.read_mrc(avg_vol_key)
+  mask_avg = core.read_mrc(avg_mask_key)
+
+  n_features = vol_avg.size if voxel_mask_inds is None else len(voxel_mask_inds)
+  mat = np.empty((len(vmal), n_features))
+
+  for i, vol_diff in enumerate(masked_differences(vol_avg, mask_avg, vmal, smoothing_gauss_sigma, fourier_oversample)):
+    if voxel_mask_inds is not None:
+      np.take(vol_diff, voxel_mask_inds, out=mat[i])
+    else:
+      mat[i] = vol_diff.ravel()
 
   (m_fh, m_name) = tempfile.mkstemp(prefix='tm_tmp_pcadiff_', suffix='.npy', dir=pass_dir)
   os.close(m_fh)
@@ -76,6 +135,104 @@ def pca_stack_diff(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel
   np.save(m_name, mat)
   return m_name
 
+
+def weighted_feature_rows(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, feature_weights, fourier_oversample=0):
+  """
+  Selected voxels of the masked differences of a chunk of subtomograms,
+  scaled by sqrt(feature_weights).  An unweighted PCA of these rows is the
+  weighted PCA of the differences.
+
+  :param avg_vol_key: Global average volume.
+  :param avg_mask_key: Global average mask.
+  :param vmal: List of (volume, mask, angle, loc) tuples.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param voxel_mask_inds: Indices of the voxels used as features.
+  :param feature_weights: Weight of each feature.
+  :param fourier_oversample: See masked_difference_given_vol_avg_fft().
+
+  :returns: Array of shape (len(vmal), len(voxel_mask_inds)).
+  """
+
+  vol_avg  = core.read_mrc(avg_vol_key)
+  mask_avg = core.read_mrc(avg_mask_key)
+
+  scale = np.sqrt(np.maximum(feature_weights, 0))
+
+  rows = np.empty((len(vmal), len(voxel_mask_inds)))
+  for i, vol_diff in enumerate(masked_differences(vol_avg, mask_avg, vmal, smoothing_gauss_sigma, fourier_oversample)):
+    np.take(vol_diff, voxel_mask_inds, out=rows[i])
+  rows *= scale
+
+  return rows
+
+
+def pca_gram_partial(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, feature_weights, pass_dir, fourier_oversample=0):
+  """
+  First pass of the distributed PCA.  Calculate the weighted masked
+  differences for a chunk of subtomograms, and their partial Gram matrix.
+
+  The rows are the selected voxels of the differences scaled by
+  sqrt(feature_weights), so the Gram matrix summed over all chunks is the
+  weighted covariance of the features.
+
+  :param avg_vol_key: Global average volume.
+  :param avg_mask_key: Global average mask.
+  :param vmal: List of (volume, mask, angle, loc) tuples.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param voxel_mask_inds: Indices of the voxels used as features.
+  :param feature_weights: Weight of each feature.
+  :param pass_dir: Where to write the output.
+  :param fourier_oversample: See masked_difference_given_vol_avg_fft().
+
+  :returns: Tuple of file names (rows, gram).  The rows are kept for the
+  projection in pca_project_partial().
+  """
+
+  rows = weighted_feature_rows(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, feature_weights, fourier_oversample)
+
+  gram = np.dot(rows.T, rows)
+
+  (r_fh, rows_name) = tempfile.mkstemp(prefix='tm_tmp_pcarows_', suffix='.npy', dir=pass_dir)
+  (g_fh, gram_name) = tempfile.mkstemp(prefix='tm_tmp_pcagram_', suffix='.npy', dir=pass_dir)
+  os.close(r_fh)
+  os.close(g_fh)
+
+  np.save(rows_name, rows)
+  np.save(gram_name, gram)
+
+  return rows_name, gram_name
+
+
+def pca_project_partial(rows_key, eigvec):
+  """
+  Second pass of the distributed PCA.  Project the rows saved by
+  pca_gram_partial() onto the eigenvectors.
+
+  :param rows_key: Rows file from pca_gram_partial().
+  :param eigvec: Array of shape (n_features, dims).
+
+  :returns: Coefficients of the chunk, shape (n_rows, dims).
+  """
+
+  return np.dot(np.load(rows_key), eigvec)
+
+
+def pca_transform_partial(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, feature_weights, eigvec, fourier_oversample=0):
+  """
+  Project a chunk of subtomograms onto principal components fitted
+  elsewhere, e.g. by randomized_pca() on a subset.
+
+  :param eigvec: Array of shape (n_features, dims).
+
+  See weighted_feature_rows() for the other parameters.
+
+  :returns: Coefficients of the chunk, shape (len(vmal), dims).
+  """
+
+  rows = weighted_feature_rows(avg_vol_key, avg_mask_key, vmal, smoothing_gauss_sigma, voxel_mask_inds, feature_weights, fourier_oversample)
+  return np.dot(rows, eigvec)
+
+
 def pca_stack_diff_merge(rows, pass_dir):
   """
   :TODO: documentation
@@ -91,7 +248,7 @@ def pca_stack_diff_merge(rows, pass_dir):
   np.save(m_name, mat)
   return m_name
 
-def masked_difference_given_vol_avg_fft(v, m, ang, loc, vol_avg_fft, vol_mask_avg, smoothing_gauss_sigma=0):
+def masked_difference_given_vol_avg_fft(v, m, ang, loc, vol_avg_fft, vol_mask_avg, smoothing_gauss_sigma=0, fourier_oversample=0):
   """
   :TODO: documentation
 
@@ -104,11 +261,15 @@ def masked_difference_given_vol_avg_fft(v, m, ang, loc, vol_avg_fft, vol_mask_av
   :param vol_avg_fft:
   :param vol_mask_avg:
   :param smoothing_gauss_sigma:
+  :param fourier_oversample: If positive, rotate v directly in Fourier space
+  with core.rotate_vol_fft() using this oversampling factor.
   """
-  v_r = core.rotate_vol_pad_mean(v,ang,loc)
+  if fourier_oversample > 0:
+    v_r_fft = core.rotate_vol_fft(v, ang, loc, fourier_oversample)
+  else:
+    v_r_fft = fftshift(fftn(core.rotate_vol_pad_mean(v,ang,loc)))
   m_r = core.rotate_mask(m, ang)
 
-  v_r_fft = fftshift(fftn(v_r))
   v_r_msk_dif = np.real(ifftn(ifftshift( (v_r_fft - vol_avg_fft) * m_r * vol_mask_avg )))
 
   if smoothing_gauss_sigma > 0:
@@ -123,7 +284,56 @@ def masked_difference_given_vol_avg_fft(v, m, ang, loc, vol_avg_fft, vol_mask_av
   return (v_r_msk_dif, m_r)
 
 
-def neighbor_covariance_collect_info(vol_avg_key, mask_avg_key, vmal, pass_dir, smoothing_gauss_sigma=0):
+def masked_differences(vol_avg, mask_avg, vmal, smoothing_gauss_sigma=0, fourier_oversample=0):
+  """
+  Calculate the masked difference between each subtomogram and the global
+  average.  This is masked_difference_given_vol_avg_fft() for a list of
+  subtomograms, with the FFT of the average and its product with the mask
+  computed once.  The Gaussian smoothing is applied as a factor in the same
+  inverse FFT, instead of two more FFTs per subtomogram.
+
+  :param vol_avg: Global average volume (real space).
+  :param mask_avg: Global average mask.
+  :param vmal: List of (volume, mask, angle, loc) tuples.
+  :param smoothing_gauss_sigma: Gaussian smoothing of the differences.
+  :param fourier_oversample: See masked_difference_given_vol_avg_fft().
+
+  :returns: Generator of the real space difference volumes, in vmal order.
+  """
+
+  vol_avg_fft = fftshift(fftn(vol_avg))
+  avg_masked  = vol_avg_fft * mask_avg
+
+  # Same filter as filtering.gaussian_smoothing(), in unshifted order.
+  g_fft = None
+  if smoothing_gauss_sigma > 0:
+    g = filtering.filters.gauss_function(size=vol_avg.shape, sigma=smoothing_gauss_sigma)
+    g_fft = np.conj(fftn(ifftshift(g)))
+
+  # each subtomogram is used once, so the reads bypass the cache.
+  for v, m, ang, loc in prefetch_vmal(vmal, cached=False):
+
+    if fourier_oversample > 0:
+      with phase('rotate_fft'):
+        v_r_fft = core.rotate_vol_fft(v, ang, loc, fourier_oversample)
+    else:
+      with phase('rotate'):
+        v_r = core.rotate_vol_pad_mean(v,ang,loc)
+      with phase('fft'):
+        v_r_fft = fftshift(fftn(v_r))
+    with phase('rotate'):
+      m_r = core.rotate_mask(m, ang)
+
+    with phase('fft'):
+      dif_fft = ifftshift((v_r_fft * mask_avg - avg_masked) * m_r)
+      if g_fft is not None:
+        dif_fft *= g_fft
+      dif = np.real(ifftn(dif_fft))
+
+    yield dif
+
+
+def neighbor_covariance_collect_info(vol_avg_key, mask_avg_key, vmal, pass_dir, smoothing_gauss_sigma=0, fourier_oversample=0):
   """
   Collecting information for calculating the neighbor covariance, calculated
   at worker side
@@ -133,6 +343,7 @@ def neighbor_covariance_collect_info(vol_avg_key, mask_avg_key, vmal, pass_dir,
   :param vmal:
   :param smoothing_gauss_sigma:
   :param tmp_dir:
+  :param fourier_oversample: See masked_difference_given_vol_avg_fft().
   """
 
   vol_avg  = core.read_mrc(vol_avg_key)
@@ -140,25 +351,15 @@ def neighbor_covariance_collect_info(vol_avg_key, mask_avg_key, vmal, pass_dir,
 
   sum_local = np.zeros(vol_avg.shape)
 
-  neighbor_prods = []
-
-  for vk, mk, ang, loc in vmal:
-    v = core.read_mrc(vk)
-    m = core.read_mrc(mk)
-
-    v_r_msk_dif, m_r = masked_difference_given_vol_avg_fft(v, m, ang, loc, vol_avg, mask_avg, smoothing_gauss_sigma)
+  neighbor_prod_sum = np.zeros((len(_half_offsets),) + vol_avg.shape)
+  tmp = np.empty(vol_avg.shape)
 
+  for v_r_msk_dif in masked_differences(vol_avg, mask_avg, vmal, smoothing_gauss_sigma, fourier_oversample):
 
     sum_local += v_r_msk_dif
 
-    neighbor_prods.append(neighbor_product(v_r_msk_dif))
-
-    del v
-    del m
-    del v_r_msk_dif
-    del m_r
-
-  neighbor_prod_sum = sum(neighbor_prods)
+    with phase('neighbor_products'):
+      neighbor_product_accumulate(v_r_msk_dif, neighbor_prod_sum, tmp)
 
   #return sum_local, neighbor_prod_sum
 
@@ -182,11 +383,12 @@ def neighbor_covariance_merge(partials, N, pass_dir):
   avg_global      = sum( np.load(r[0]) for r in partials ) / N
   neighbor_prod_avg   = sum( np.load(r[1]) for r in partials ) / N
 
-  global_neighbor_prod = neighbor_product(avg_global)
+  global_neighbor_prod = neighbor_product_accumulate(avg_global, np.zeros(neighbor_prod_avg.shape))
 
   cov = neighbor_prod_avg - global_neighbor_prod
 
-  cov_avg = np.mean(cov, axis=3)
+  # average over all 26 neighbors.
+  cov_avg = neighbor_product_fold(cov) / 26.0
   (_fh, cov_avg_name)   = tempfile.mkstemp(prefix='tm_tmp_covavg_', suffix='.npy', dir=pass_dir)
   np.save(cov_avg_name, cov_avg)
   return cov_avg_name
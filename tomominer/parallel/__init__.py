@@ -1,8 +1,9 @@
 
 
 from server import Server
-from runner import Runner
+from runner import Runner, get_runner
+from executor import TomoMinerExecutor, Future, TaskError, as_completed
 from queue_worker import QueueWorker
 from task import Task
 
-__all__ = ["Runner", "Task", "Server", "QueueWorker"]
+__all__ = ["Runner", "get_runner", "TomoMinerExecutor", "Future", "TaskError", "as_completed", "Task", "Server", "QueueWorker"]
@@ -0,0 +1,188 @@
+
+import sys
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
+
+
+class Dataflow:
+  """
+  Run a graph of functions, each started as soon as the functions it depends
+  on have finished.
+
+  The functions run on a thread pool, and are expected to spend their time
+  waiting on the queue server (e.g. running a Runner batch).  Independent
+  parts of a pipeline then have their tasks on the server at the same time,
+  and the workers do not go idle between stages.
+
+  Nodes are identified by any hashable name.  Example:
+
+    flow = Dataflow()
+    for c in clusters:
+      flow.add(('center', c), volume_average, args=(host, port, clusters[c], ...))
+    for c in clusters:
+      flow.add(('align', c), lambda center: one_vs_all_alignment(host, port, center, ...), deps=[('center', c)])
+    flow.wait()
+    flow.result(('align', c))
+  """
+
+  def __init__(self, n_threads=16):
+    """
+    :param n_threads: Number of nodes running at the same time.
+    """
+
+    self.pool = ThreadPool(n_threads)
+    self.cond = threading.Condition()
+
+    self.results = {}
+    self.errors  = {}
+    # name -> (fn, args, deps, is_future) of nodes waiting for their
+    # dependencies.
+    self.waiting = {}
+    # dependency name -> names of the waiting nodes needing it.
+    self.dependents = {}
+    self.running = 0
+
+  def set_result(self, name, result):
+    """
+    Add a node that is already finished, e.g. one loaded from a checkpoint.
+    """
+
+    with self.cond:
+      self._finish(name, result, None)
+
+  def add(self, name, fn, args=(), deps=()):
+    """
+    Add a node.  It is started once all nodes in deps have finished, right
+    away if they already have.
+
+    :param name: Name of the node.
+    :param fn: The function to run.  It is called as fn(*(args + results of
+    deps, in order)).
+    :param args: Leading arguments of fn.
+    :param deps: Names of the nodes this one needs the results of.  They
+    may be added after this one.
+    """
+
+    self._add(name, fn, args, deps, False)
+
+  def add_future(self, name, fn, args=(), deps=()):
+    """
+    Add a node whose function only submits work and returns a Future, e.g.
+    TomoMinerExecutor.submit().  The node finishes when the future does, and
+    no thread waits for it in between, so any number of them can be
+    outstanding.  The arguments are as for add().
+    """
+
+    self._add(name, fn, args, deps, True)
+
+  def _add(self, name, fn, args, deps, is_future):
+    with self.cond:
+      if name in self.results or name in self.errors or name in self.waiting:
+        raise ValueError("Dataflow: node %s added twice" % (name,))
+
+      self.waiting[name] = (fn, tuple(args), tuple(deps), is_future)
+      missing = [d for d in deps if d not in self.results]
+      for d in missing:
+        self.dependents.setdefault(d, []).append(name)
+      if any(d in self.errors for d in deps):
+        self._fail_waiting(name, self.errors[[d for d in deps if d in self.errors][0]])
+      elif not missing:
+        self._start(name)
+
+  def _start(self, name):
+    fn, args, deps, is_future = self.waiting.pop(name)
+    args = args + tuple(self.results[d] for d in deps)
+    self.running += 1
+
+    def run():
+      try:
+        result, error = fn(*args), None
+        if is_future:
+          result.add_done_callback(lambda f: self._future_done(name, f))
+          return
+      except Exception:
+        logging.exception("Dataflow: node %s failed", name)
+        result, error = None, sys.exc_info()
+      self._done(name, result, error)
+
+    self.pool.apply_async(run)
+
+  def _future_done(self, name, future):
+    try:
+      result, error = future.result(), None
+    except Exception:
+      logging.exception("Dataflow: node %s failed", name)
+      result, error = None, sys.exc_info()
+    self._done(name, result, error)
+
+  def _done(self, name, result, error):
+    with self.cond:
+      self.running -= 1
+      self._finish(name, result, error)
+
+  def _fail_waiting(self, name, error):
+    if name in self.waiting:
+      self.waiting.pop(name)
+      self._finish(name, None, error)
+
+  def _finish(self, name, result, error):
+    """
+    Record the outcome of a node, and start (or fail) the nodes waiting on
+    it.  Called with the lock held.
+    """
+
+    if error is not None:
+      self.errors[name] = error
+    else:
+      self.results[name] = result
+
+    for d in self.dependents.pop(name, []):
+      if d not in self.waiting:
+        continue
+      if error is not None:
+        self._fail_waiting(d, error)
+      elif all(x in self.results for x in self.waiting[d][2]):
+        self._start(d)
+
+    self.cond.notify_all()
+
+  def result(self, name):
+    """
+    Wait for a node to finish.
+
+    :returns: Its result.  If the node (or one it depends on) raised an
+    exception, it is raised again here.
+    """
+
+    with self.cond:
+      while name not in self.results and name not in self.errors:
+        # nothing running means nothing will finish.
+        if self.running == 0:
+          raise KeyError(name)
+        self.cond.wait(1)
+      if name in self.errors:
+        t, v, tb = self.errors[name]
+        raise t, v, tb
+      return self.results[name]
+
+  def wait(self):
+    """
+    Wait until every node that can run has finished, and shut the thread
+    pool down.  Nodes whose dependencies were never added are left waiting.
+
+    :returns: Dictionary of the results by node name.  The first error is
+    raised, if there was one.
+    """
+
+    with self.cond:
+      while self.running > 0:
+        self.cond.wait(1)
+
+    self.pool.close()
+    self.pool.join()
+
+    if self.errors:
+      t, v, tb = self.errors.values()[0]
+      raise t, v, tb
+    return self.results
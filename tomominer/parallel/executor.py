@@ -0,0 +1,302 @@
+
+import time
+import threading
+import logging
+
+from runner import get_runner
+
+
+class TaskError(Exception):
+  """
+  A task raised an exception on the worker, and was retried as many times
+  as allowed.
+  """
+  pass
+
+
+class Future:
+  """
+  The result of a task submitted with TomoMinerExecutor.submit().  Modeled
+  on concurrent.futures.Future.
+  """
+
+  def __init__(self, task):
+    self.task = task
+    self._cond = threading.Condition()
+    self._done = False
+    self._cancelled = False
+    self._result = None
+    self._exception = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def cancelled(self):
+    return self._cancelled
+
+  def _wait(self, timeout):
+    end = None if timeout is None else time.time() + timeout
+    with self._cond:
+      while not self._done:
+        remaining = None if end is None else end - time.time()
+        if remaining is not None and remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      if not self._done:
+        raise RuntimeError("timed out waiting for task %s" % (self.task.task_id,))
+
+  def result(self, timeout=None):
+    """
+    Wait for the task to finish.
+
+    :param timeout: Seconds to wait, None to wait forever.
+    :returns: The return value of the worker function.  Raises TaskError if
+    the task failed, and RuntimeError on timeout.
+    """
+
+    self._wait(timeout)
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  def exception(self, timeout=None):
+    """
+    :returns: The TaskError of a failed task, or None.
+    """
+
+    self._wait(timeout)
+    return self._exception
+
+  def add_done_callback(self, fn):
+    """
+    Call fn(future) when the task is done, from the result pump thread, or
+    right away if it already is.
+    """
+
+    with self._cond:
+      if not self._done:
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def _set(self, result=None, exception=None, cancelled=False):
+    with self._cond:
+      if self._done:
+        return
+      self._result = result
+      self._exception = exception
+      self._cancelled = cancelled
+      self._done = True
+      self._cond.notify_all()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception:
+        logging.exception("exception in a future callback")
+
+
+def as_completed(futures, timeout=None):
+  """
+  Iterate over futures as they finish, like
+  concurrent.futures.as_completed().
+
+  :param futures: Futures from one or more TomoMinerExecutors.
+  :param timeout: Seconds to wait for all of them, None for no limit.
+  """
+
+  futures = set(futures)
+  cond = threading.Condition()
+  finished = []
+
+  def on_done(f):
+    with cond:
+      finished.append(f)
+      cond.notify()
+
+  for f in futures:
+    f.add_done_callback(on_done)
+
+  end = None if timeout is None else time.time() + timeout
+  for _ in range(len(futures)):
+    with cond:
+      while not finished:
+        remaining = None if end is None else end - time.time()
+        if remaining is not None and remaining <= 0:
+          raise RuntimeError("as_completed: timed out")
+        cond.wait(remaining)
+      f = finished.pop(0)
+    yield f
+
+
+class TomoMinerExecutor:
+  """
+  Submit worker functions to the queue server and get Futures for their
+  results, as with concurrent.futures.Executor:
+
+    with TomoMinerExecutor(host, port) as ex:
+      f = ex.submit('align.align', v1, m1, v2, m2, L)
+      scores = ex.map('align.align', v1s, m1s, v2s, m2s, Ls, chunksize=10)
+      for f in as_completed(fs):
+        ...
+
+  Tasks are sent as they are submitted, and a background thread fetches the
+  results and resolves the futures, so any number of independent batches
+  can be outstanding at once.  By default the process-wide Runner of
+  get_runner() is used, sharing its connection and project.
+  """
+
+  def __init__(self, host, port, runner=None, max_retry=1, poll_interval=1.0):
+    """
+    :param host: RPCServer IP address
+    :param port: RPCServer port
+    :param runner: Runner to submit through.  Default get_runner(host, port).
+    :param max_retry: Number of times a task is run before its exception
+    is passed to the future.
+    :param poll_interval: Seconds between polls for results.
+    """
+
+    self.runner = runner if runner is not None else get_runner(host, port)
+    self.max_retry = max_retry
+    self.poll_interval = poll_interval
+
+    self._lock = threading.Lock()
+    # task_id -> (future, tries left) of the tasks still out.
+    self._futures = {}
+    self._shutdown = False
+    self._wakeup = threading.Event()
+
+    self._pump = threading.Thread(target=self._pump_results, name='TomoMinerExecutor-pump')
+    self._pump.daemon = True
+    self._pump.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    # on an error nobody will want the remaining results.
+    self.shutdown(wait=exc_type is None)
+    return False
+
+  def submit(self, method, *args, **kwargs):
+    """
+    Run method(*args, **kwargs) on a worker.
+
+    :param method: Worker function name, e.g. 'align.align'.
+    :returns: A Future.
+    """
+
+    if self._shutdown:
+      raise RuntimeError("submit() after shutdown()")
+
+    task = self.runner.make_task(method, args=args, kwargs=kwargs)
+    future = Future(task)
+    with self._lock:
+      self._futures[task.task_id] = (future, self.max_retry)
+    self.runner._put_tasks([task])
+    self._wakeup.set()
+    return future
+
+  def map(self, method, *iterables, **kwargs):
+    """
+    Like the built-in map(), with method run on the workers.  All tasks are
+    submitted right away, and the results are yielded in order.
+
+    :param chunksize: Keyword argument.  Number of calls sent in each task,
+    default 1.  Larger chunks cut the per-task overhead for short calls.
+    :param timeout: Keyword argument.  Seconds to wait for all results, None
+    for no limit.
+    :returns: Generator of the results.
+    """
+
+    chunksize = kwargs.pop('chunksize', 1)
+    timeout   = kwargs.pop('timeout', None)
+    if kwargs:
+      raise TypeError("map() got unexpected keyword arguments: %s" % (kwargs.keys(),))
+
+    args_list = zip(*iterables)
+    if chunksize <= 1:
+      futures = [self.submit(method, *a) for a in args_list]
+    else:
+      futures = [self.submit('parallel.map_chunk', method, args_list[i:i+chunksize]) for i in range(0, len(args_list), chunksize)]
+
+    def results():
+      end = None if timeout is None else time.time() + timeout
+      for f in futures:
+        r = f.result(None if end is None else max(end - time.time(), 0))
+        if chunksize <= 1:
+          yield r
+        else:
+          for x in r:
+            yield x
+    return results()
+
+  def shutdown(self, wait=True):
+    """
+    Stop accepting tasks.  With wait, block until the outstanding ones are
+    done.  Otherwise they are cancelled on the server.
+    """
+
+    self._shutdown = True
+    if not wait:
+      with self._lock:
+        outstanding = self._futures.items()
+        self._futures = {}
+      # through the runner, which holds its lock while it talks to the
+      # server, as the pump thread may be fetching results on the same
+      # connection.
+      self.runner.cancel([task_id for task_id, _ in outstanding])
+      for task_id, (future, tries) in outstanding:
+        future._set(cancelled=True, exception=TaskError("cancelled"))
+    self._wakeup.set()
+    if wait:
+      self._pump.join()
+
+  def _pump_results(self):
+    """
+    Result pump thread.  Polls the server for finished tasks, resolves their
+    futures, and resubmits failed ones that may be retried.
+    """
+
+    while True:
+      with self._lock:
+        task_ids = self._futures.keys()
+      if not task_ids:
+        if self._shutdown:
+          return
+        self._wakeup.wait(self.poll_interval)
+        self._wakeup.clear()
+        continue
+
+      try:
+        results = self.runner._collect(task_ids)
+      except Exception:
+        logging.exception("TomoMinerExecutor: error fetching results")
+        results = []
+
+      for res in results:
+        with self._lock:
+          if res.task_id not in self._futures:
+            continue
+          future, tries = self._futures[res.task_id]
+          if res.error and tries > 1:
+            self._futures[res.task_id] = (future, tries - 1)
+          else:
+            del self._futures[res.task_id]
+
+        if res.error and tries > 1:
+          logging.warning("resubmitting crashed task: %s", res.task_id)
+          self.runner._put_tasks([future.task])
+          continue
+
+        self.runner._done(res.task_id)
+        future.task = res
+        if res.error:
+          logging.error("task %s (%s) failed: %s", res.task_id, res.method, res.result)
+          future._set(exception=TaskError("%s failed: %s" % (res.method, res.result)))
+        else:
+          future._set(result=res.result)
+
+      if not results:
+        time.sleep(self.poll_interval)
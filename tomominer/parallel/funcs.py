@@ -8,3 +8,4 @@ from tomominer.cluster      import worker_funcs as cluster
 from tomominer.common       import worker_funcs as common
 from tomominer.dim_reduce   import worker_funcs as dim_reduce
 from tomominer.test         import worker_funcs as test
+from tomominer.parallel     import worker_funcs as parallel
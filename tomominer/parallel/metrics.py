@@ -0,0 +1,308 @@
+
+import time
+import bisect
+import threading
+import logging
+from collections import deque, defaultdict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+# bucket upper bounds, in seconds and bytes.
+TIME_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+SIZE_BUCKETS = [2**k for k in range(8, 31, 2)]
+
+
+def now():
+  return time.time()
+
+
+class Histogram:
+  """
+  Distribution of a quantity, in two forms:
+
+  - cumulative counts in fixed buckets, since the server started, as
+    exported to Prometheus.
+  - the observations of the last window seconds, from which the rolling
+    summary (mean, quantiles) is computed.
+  """
+
+  def __init__(self, buckets, window=300, max_samples=10000):
+    """
+    :param buckets: Increasing bucket upper bounds.  A +Inf bucket is added.
+    :param window: Seconds of observations kept for the rolling summary.
+    :param max_samples: Bound on the number of observations kept.
+    """
+
+    self.buckets = list(buckets)
+    self.counts  = [0] * (len(self.buckets) + 1)
+    self.count   = 0
+    self.sum     = 0.0
+
+    self.window  = window
+    self.recent  = deque(maxlen=max_samples)
+
+  def observe(self, x, t=None):
+    self.counts[bisect.bisect_left(self.buckets, x)] += 1
+    self.count += 1
+    self.sum   += x
+    self.recent.append((now() if t is None else t, x))
+
+  def _prune(self, t):
+    while self.recent and self.recent[0][0] < t - self.window:
+      self.recent.popleft()
+
+  def summary(self, t=None):
+    """
+    :returns: Dictionary with the lifetime count and sum, and the count,
+    mean, p50, p95 and max of the last window seconds.
+    """
+
+    self._prune(now() if t is None else t)
+    xs = sorted(x for _,x in self.recent)
+    s = dict(count=self.count, sum=self.sum, recent_count=len(xs))
+    if xs:
+      s.update(mean=float(sum(xs)) / len(xs), p50=_quantile(xs, 0.5), p95=_quantile(xs, 0.95), max=xs[-1])
+    else:
+      s.update(mean=None, p50=None, p95=None, max=None)
+    return s
+
+  def cumulative(self):
+    """
+    :returns: List of (upper bound, count of observations <= bound), ending
+    with float('inf').
+    """
+
+    c = 0
+    out = []
+    for b, n in zip(self.buckets + [float('inf')], self.counts):
+      c += n
+      out.append((b, c))
+    return out
+
+
+def _quantile(xs, q):
+  """
+  q-quantile of the sorted list xs, by nearest rank.
+  """
+  return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+class MethodMetrics:
+  """
+  Counters and histograms of the tasks of one method.
+  """
+
+  def __init__(self, window):
+    self.submitted = 0
+    self.completed = 0
+    self.failed    = 0
+    self.retried   = 0
+    self.timed_out = 0
+
+    self.queue_wait   = Histogram(TIME_BUCKETS, window)
+    """ Time between being queued (or requeued) and being sent to a worker. """
+    self.run_time     = Histogram(TIME_BUCKETS, window)
+    """ Time between being sent to a worker and its result arriving. """
+    self.pickup_delay = Histogram(TIME_BUCKETS, window)
+    """ Time the result waited in the done queue for the manager. """
+    self.args_bytes   = Histogram(SIZE_BUCKETS, window)
+    """ Size of the request that submitted the task, or the task's share of it. """
+    self.result_bytes = Histogram(SIZE_BUCKETS, window)
+    """ Size of the put_result() request. """
+
+    # (time, failed) of the completions, and times of the retries, in the
+    # window.  For the rates.
+    self.recent_done    = deque(maxlen=100000)
+    self.recent_retried = deque(maxlen=100000)
+
+  def histograms(self):
+    return [('queue_wait_seconds', self.queue_wait), ('run_seconds', self.run_time), ('pickup_delay_seconds', self.pickup_delay), ('args_bytes', self.args_bytes), ('result_bytes', self.result_bytes)]
+
+
+class TaskMetrics:
+  """
+  Task timings, retries and payload sizes recorded by the QueueServer, per
+  method.  The server calls the event methods as tasks move through it, and
+  sets the timing fields of the Task as it goes:
+
+    put_tasks():   submitted(), sets task.queued_time.
+    get_task():    started(), sets task.todo_queue_total.
+    put_result():  finished() (or retried() if it will be rerun), sets
+                   task.calc_total.
+    get_results(): picked_up(), sets task.done_queue_total.
+  """
+
+  def __init__(self, window=300):
+    """
+    :param window: Seconds covered by the rolling summaries and throughput.
+    """
+
+    self.window  = window
+    self.lock    = threading.Lock()
+    self.methods = defaultdict(lambda: MethodMetrics(self.window))
+    self.start_time = now()
+
+  def submitted(self, task, args_bytes=None):
+    t = now()
+    with self.lock:
+      m = self.methods[task.method]
+      m.submitted += 1
+      if args_bytes is not None:
+        m.args_bytes.observe(args_bytes, t)
+    task.queued_time = t
+
+  def started(self, task):
+    t = now()
+    with self.lock:
+      m = self.methods[task.method]
+      # a task in the queue with tries > 0 is being run again, because its
+      # previous run went over max_time.
+      if task.tries > 0:
+        m.retried += 1
+        m.recent_retried.append(t)
+      if getattr(task, 'queued_time', None) is not None:
+        task.todo_queue_total = t - task.queued_time
+        m.queue_wait.observe(task.todo_queue_total, t)
+    task.start_time = t
+
+  def retried(self, task):
+    t = now()
+    with self.lock:
+      m = self.methods[task.method]
+      if getattr(task, 'start_time', None) is not None:
+        m.run_time.observe(t - task.start_time, t)
+    task.queued_time = t
+
+  def finished(self, task, error, result_bytes=None):
+    t = now()
+    with self.lock:
+      m = self.methods[task.method]
+      if error:
+        m.failed += 1
+      else:
+        m.completed += 1
+      m.recent_done.append((t, bool(error)))
+      if getattr(task, 'start_time', None) is not None:
+        task.calc_total = t - task.start_time
+        m.run_time.observe(task.calc_total, t)
+      if result_bytes is not None:
+        m.result_bytes.observe(result_bytes, t)
+    task.finish_time = t
+
+  def timed_out(self, task):
+    t = now()
+    with self.lock:
+      m = self.methods[task.method]
+      m.timed_out += 1
+      m.failed    += 1
+      m.recent_done.append((t, True))
+    task.finish_time = t
+
+  def picked_up(self, task):
+    t = now()
+    if getattr(task, 'finish_time', None) is None:
+      return
+    task.done_queue_total = t - task.finish_time
+    with self.lock:
+      self.methods[task.method].pickup_delay.observe(task.done_queue_total, t)
+
+  def summary(self):
+    """
+    :returns: Dictionary by method name of the counters, the rolling
+    summaries of the histograms, and over the window: the throughput (tasks
+    finished per second), the failure rate (fraction of the finished tasks
+    that failed) and the retry rate (retries per second).
+    """
+
+    t = now()
+    out = {}
+    with self.lock:
+      for name, m in self.methods.items():
+        while m.recent_done and m.recent_done[0][0] < t - self.window:
+          m.recent_done.popleft()
+        while m.recent_retried and m.recent_retried[0] < t - self.window:
+          m.recent_retried.popleft()
+        span = float(min(self.window, max(t - self.start_time, 1e-6)))
+        n_failed = sum(1 for _, failed in m.recent_done if failed)
+        s = dict(submitted=m.submitted, completed=m.completed, failed=m.failed, retried=m.retried, timed_out=m.timed_out,
+                 throughput=len(m.recent_done) / span,
+                 failure_rate=float(n_failed) / len(m.recent_done) if m.recent_done else 0.0,
+                 retry_rate=len(m.recent_retried) / span)
+        for hname, h in m.histograms():
+          s[hname] = h.summary(t)
+        out[name] = s
+    return out
+
+  def prometheus(self, gauges=None):
+    """
+    The metrics in the Prometheus text exposition format.
+
+    :param gauges: Optional dictionary of extra gauge values by name, e.g.
+    the queue sizes.
+    """
+
+    lines = []
+    if gauges:
+      for name, value in sorted(gauges.items()):
+        lines.append('# TYPE tomominer_%s gauge' % (name,))
+        lines.append('tomominer_%s %s' % (name, value))
+
+    with self.lock:
+      methods = sorted(self.methods.items())
+
+      for counter in ['submitted', 'completed', 'failed', 'retried', 'timed_out']:
+        lines.append('# TYPE tomominer_tasks_%s_total counter' % (counter,))
+        for name, m in methods:
+          lines.append('tomominer_tasks_%s_total{method="%s"} %d' % (counter, name, getattr(m, counter)))
+
+      for hname, _ in MethodMetrics(self.window).histograms():
+        lines.append('# TYPE tomominer_task_%s histogram' % (hname,))
+        for name, m in methods:
+          h = dict(m.histograms())[hname]
+          for b, c in h.cumulative():
+            le = '+Inf' if b == float('inf') else repr(b)
+            lines.append('tomominer_task_%s_bucket{method="%s",le="%s"} %d' % (hname, name, le, c))
+          lines.append('tomominer_task_%s_sum{method="%s"} %r' % (hname, name, h.sum))
+          lines.append('tomominer_task_%s_count{method="%s"} %d' % (hname, name, h.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = self.server.queue_server.metrics_text()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug("metrics http: " + format, *args)
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def serve_metrics(queue_server, host, port):
+  """
+  Serve queue_server.metrics_text() over HTTP at /metrics, for Prometheus to
+  scrape, from a background thread.
+
+  :returns: The HTTP server.  Call shutdown() on it to stop.
+  """
+
+  httpd = _MetricsHTTPServer((host, port), _MetricsHandler)
+  httpd.queue_server = queue_server
+  t = threading.Thread(target=httpd.serve_forever, name='metrics-http')
+  t.daemon = True
+  t.start()
+  logging.info("serving metrics on http://%s:%d/metrics", host, port)
+  return httpd
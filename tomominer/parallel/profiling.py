@@ -0,0 +1,163 @@
+
+import os
+import time
+import threading
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+
+# name -> [calls, seconds] while profiling is enabled in this process, None
+# otherwise.
+_phases   = None
+# name -> number of events, for count().
+_counts   = None
+_profiler = None
+_start    = None
+_lock     = threading.Lock()
+
+
+@contextmanager
+def phase(name):
+  """
+  Time a named phase of a task, e.g.
+
+    with phase('read_mrc'):
+      vol = core.read_mrc(path)
+
+  The calls and total time of each phase are added up while profiling is
+  enabled (see enable()), and it costs next to nothing otherwise.  Phases
+  may nest, and each records its inclusive time.  Phases run on background
+  threads (e.g. prefetch()) overlap the caller, so their times may add up
+  to more than the wall time.
+  """
+
+  if _phases is None:
+    yield
+    return
+
+  t = time.time()
+  try:
+    yield
+  finally:
+    dt = time.time() - t
+    with _lock:
+      rec = _phases.setdefault(name, [0, 0.0])
+      rec[0] += 1
+      rec[1] += dt
+
+
+def count(name, n=1):
+  """
+  Count a named event of a task, e.g. a cache hit, without timing it.  Does
+  nothing unless profiling is enabled.
+  """
+
+  if _counts is None:
+    return
+
+  with _lock:
+    _counts[name] = _counts.get(name, 0) + n
+
+
+def enabled():
+  return _phases is not None
+
+
+def enable(use_cprofile=False):
+  """
+  Start recording phases in this process, and with use_cprofile, run
+  cProfile on the calling thread too.
+  """
+
+  global _phases, _counts, _profiler, _start
+
+  _phases = {}
+  _counts = {}
+  _start  = time.time()
+  _profiler = None
+  if use_cprofile:
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def disable(top=25):
+  """
+  Stop profiling.
+
+  :param top: Number of functions kept from the cProfile statistics, by
+  internal time.
+
+  :returns: The summary: a dictionary with the number of tasks (1), the
+  wall time, the phases as {name: (calls, seconds)}, the counts as {name:
+  n}, and the functions as a list of (name, calls, internal seconds,
+  cumulative seconds).
+  """
+
+  global _phases, _counts, _profiler, _start
+
+  wall = time.time() - _start
+  functions = []
+  if _profiler is not None:
+    _profiler.disable()
+    st = pstats.Stats(_profiler)
+    for (fn, line, func), (cc, nc, tt, ct, callers) in st.stats.items():
+      functions.append(("%s:%d(%s)" % (os.path.basename(fn), line, func), nc, tt, ct))
+    functions.sort(key=lambda x: -x[2])
+    functions = functions[:top]
+
+  with _lock:
+    phases = dict((k, tuple(v)) for k, v in _phases.items())
+    counts = dict(_counts)
+  _phases, _counts, _profiler, _start = None, None, None, None
+
+  return dict(tasks=1, wall=wall, phases=phases, counts=counts, functions=functions)
+
+
+def merge(a, b):
+  """
+  Add up two summaries from disable() (or merge()).  Either may be None.
+  """
+
+  if a is None:
+    return b
+  if b is None:
+    return a
+
+  phases = dict(a['phases'])
+  for k, (n, s) in b['phases'].items():
+    n0, s0 = phases.get(k, (0, 0.0))
+    phases[k] = (n0 + n, s0 + s)
+
+  counts = dict(a['counts'])
+  for k, n in b['counts'].items():
+    counts[k] = counts.get(k, 0) + n
+
+  functions = dict((f[0], f[1:]) for f in a['functions'])
+  for name, nc, tt, ct in b['functions']:
+    n0, t0, c0 = functions.get(name, (0, 0.0, 0.0))
+    functions[name] = (n0 + nc, t0 + tt, c0 + ct)
+  functions = sorted([(k,) + v for k, v in functions.items()], key=lambda x: -x[2])
+
+  return dict(tasks=a['tasks'] + b['tasks'], wall=a['wall'] + b['wall'], phases=phases, counts=counts, functions=functions)
+
+
+def format_summary(summary, top=15):
+  """
+  :returns: A summary as a printable table of the phases and counts, and of
+  the top functions if cProfile was used.
+  """
+
+  lines = ["%d tasks, %.2f s total" % (summary['tasks'], summary['wall'])]
+  lines.append("  %-28s %10s %10s %7s" % ('phase', 'calls', 'seconds', '% time'))
+  for name, (n, s) in sorted(summary['phases'].items(), key=lambda x: -x[1][1]):
+    lines.append("  %-28s %10d %10.2f %6.1f%%" % (name, n, s, 100.0 * s / max(summary['wall'], 1e-9)))
+  if summary['counts']:
+    lines.append("  %-28s %10s" % ('count', 'n'))
+    for name, n in sorted(summary['counts'].items()):
+      lines.append("  %-28s %10d" % (name, n))
+  if summary['functions']:
+    lines.append("  %-50s %10s %10s %10s" % ('function', 'calls', 'internal', 'cumulative'))
+    for name, nc, tt, ct in summary['functions'][:top]:
+      lines.append("  %-50s %10d %10.2f %10.2f" % (name[-50:], nc, tt, ct))
+  return '\n'.join(lines)
@@ -10,6 +10,8 @@ import logging
 
 #import logging.handlers
 from task import Task
+from metrics import TaskMetrics
+from rpc_server import request_size
 
 def now():
     return time.time()
@@ -57,6 +59,7 @@ class max_time_monitor(threading.Thread):
 
               # mark it as timed out.
               task.fail("Task exceeded max_time")
+              self.server.metrics.timed_out(task)
               self.server.done_queues[task.proj_id].put(task)
               del self.server.tasks[task_id]
               logging.debug("max_time_queue_thread: Killing task %s!", task_id)
@@ -66,6 +69,30 @@ class max_time_monitor(threading.Thread):
       self.finished.wait(self.interval)
 
 
+class heartbeat_monitor(threading.Thread):
+
+  def __init__(self, server, interval):
+    threading.Thread.__init__(self)
+    self.finished = threading.Event()
+    self.interval = interval
+    self.server   = server
+
+  def cancel(self):
+    self.finished.set()
+
+  def run(self):
+    """
+    Every interval seconds, look for workers that have missed their
+    heartbeats while running a task, and requeue the task.  Without this a
+    task lost with its worker is only noticed when its max_time expires.
+    """
+
+    while not self.finished.is_set():
+      with self.server.lock:
+        self.server._check_heartbeats()
+      self.finished.wait(self.interval)
+
+
 class QueueServer:
   """
 
@@ -101,9 +128,15 @@ class QueueServer:
   are passed back.  They are removed from the done_queue.
   """
 
-  def __init__(self, timeout_thread_interval=30, get_task_timeout=30):
+  def __init__(self, timeout_thread_interval=30, get_task_timeout=30, metrics_window=300, heartbeat_misses=3, heartbeat_check_interval=5):
     """
     Setup the QueueServer for task processing.
+
+    :param metrics_window: Seconds covered by the rolling task statistics.
+    :param heartbeat_misses: Number of heartbeats a worker running a task
+    may miss before it is taken for dead, and the task is requeued.
+    :param heartbeat_check_interval: Seconds between checks for dead
+    workers.
     """
 
     self.get_task_timeout = get_task_timeout
@@ -129,14 +162,31 @@ class QueueServer:
       when it is returned to a worker.  If it exceeds max_time, the task
       will be recorded as a failure and placed in done_queues. """
 
+    self.metrics = TaskMetrics(metrics_window)
+    """ Timings, retries and payload sizes of the tasks, by method. """
+
+    self.workers = {}
+    """ Workers that have identified themselves, by worker_id: when they
+      were last heard from, their heartbeat interval, whether they are taken
+      for dead, and the task they were last sent. """
+
+    self.heartbeat_misses = heartbeat_misses
+
     # The thread which monitors max_time_queue.
     self.monitor = max_time_monitor(self, timeout_thread_interval)
     self.monitor.daemon = True
     self.monitor.start()
 
+    # The thread which requeues the tasks of dead workers.
+    self.heartbeat_monitor = heartbeat_monitor(self, heartbeat_check_interval)
+    self.heartbeat_monitor.daemon = True
+    self.heartbeat_monitor.start()
+
   def __del__(self):
     self.monitor.cancel()
     self.monitor.join(timeout=1)
+    self.heartbeat_monitor.cancel()
+    self.heartbeat_monitor.join(timeout=1)
 
   def new_project(self, proj_id):
     """
@@ -172,22 +222,94 @@ class QueueServer:
       return False
 
 
-  def stats(self):
+  def stats(self, n_slowest=0):
     """
+    Queue sizes, and the task metrics by method.  See TaskMetrics.summary()
+    for the contents of 'methods'.
+
+    :param n_slowest: Number of the longest running tasks to list in
+    'slowest'.
+
+    :returns: Dictionary of the totals, and of:
+      projects: by project id, the number of tasks queued, running, and
+        waiting for pickup.
+      workers: by worker id, seconds since it was last heard from, and the
+        task it is running.
+      slowest: records of the n_slowest longest running tasks.
     """
+    t = now()
+    with self.lock:
+      projects = dict((proj_id, dict(queued=0, running=0, waiting_for_pickup=q.qsize())) for proj_id, q in self.done_queues.items())
+      running = []
+      for task in self.tasks.values():
+        if task.proj_id not in projects:
+          continue
+        if _is_running(task):
+          projects[task.proj_id]['running'] += 1
+          running.append(task)
+        else:
+          projects[task.proj_id]['queued'] += 1
+
+      running.sort(key=lambda task: task.start_time)
+      slowest = [dict(task_id=task.task_id, proj_id=task.proj_id, method=task.method, tries=task.tries, running_for=t - task.start_time, worker_id=task.worker_id) for task in running[:n_slowest]]
+
+      workers = {}
+      for worker_id, w in self.workers.items():
+        task = self.tasks.get(w['task_id'])
+        busy = task is not None and task.worker_id == worker_id and _is_running(task)
+        workers[worker_id] = dict(last_seen=t - w['last_seen'], dead=w['dead'], task_id=w['task_id'] if busy else None, method=task.method if busy else None, completed=w['completed'])
+
     return dict(active_connections=self.active_connections,
                 waiting=self.todo_queue.qsize(),
                 num_projects=len(self.done_queues),
-                waiting_for_pickup=sum(_.qsize() for _ in self.done_queues.values()),
-                num_running=len(self.tasks))
+                waiting_for_pickup=sum(_['waiting_for_pickup'] for _ in projects.values()),
+                num_running=len(self.tasks),
+                uptime=t - self.metrics.start_time,
+                methods=self.metrics.summary(),
+                projects=projects,
+                workers=workers,
+                slowest=slowest)
 
 
   def dump(self):
     """
     Dump several internal data structures for an external monitor.  Very
     expensive, call infrequently
+
+    :returns: Dictionary with stats(), and one record per task known to the
+    server (queued or running) with its timings so far.
+    """
+    stats = self.stats()
+    t = now()
+    with self.lock:
+      queued = set(task_id for _, task_id in list(self.todo_queue.queue))
+      tasks = []
+      for task in self.tasks.values():
+        tasks.append(dict(task_id=task.task_id,
+                          proj_id=task.proj_id,
+                          method=task.method,
+                          tries=task.tries,
+                          max_tries=task.max_tries,
+                          max_time=task.max_time,
+                          queued=task.task_id in queued,
+                          queued_for=(t - task.queued_time) if task.queued_time is not None else None,
+                          worker_id=task.worker_id,
+                          running_for=(t - task.start_time) if _is_running(task) else None))
+      done = dict((proj_id, q.qsize()) for proj_id, q in self.done_queues.items())
+    return dict(time=t, stats=stats, tasks=tasks, waiting_for_pickup=done)
+
+
+  def metrics_text(self):
+    """
+    :returns: The task metrics and queue sizes in the Prometheus text
+    format.  tm_server --metrics-port serves this over HTTP.
     """
-    raise NotImplementedError
+    gauges = dict(active_connections=self.active_connections,
+                  tasks_waiting=self.todo_queue.qsize(),
+                  tasks_running=len(self.tasks),
+                  tasks_waiting_for_pickup=sum(_.qsize() for _ in self.done_queues.values()),
+                  projects=len(self.done_queues))
+    return self.metrics.prometheus(gauges)
 
 
   def put_tasks(self, tasks):
@@ -197,11 +319,17 @@ class QueueServer:
 
     :param tasks: A list of tasks to be added of type Task()
     """
+    # the tasks arrive in one message, so each is counted as an equal share
+    # of it.
+    size = request_size()
+    if size is not None and tasks:
+      size //= len(tasks)
     with self.lock:
       for task in tasks:
         if not isinstance(task.max_time, int) or task.max_time < 0:
           raise Exception("All tasks must have a valid (integer > 0) max_time")
         self.tasks[task.task_id] = task
+        self.metrics.submitted(task, size)
         self.todo_queue.put((now(), task.task_id))
         logging.debug("put_task %s", task)
 
@@ -218,10 +346,12 @@ class QueueServer:
 
     :todo: perform type checking on task object.
     """
+    size = request_size()
     with self.lock:
       if not isinstance(task.max_time, int) or task.max_time < 0:
         raise Exception("All tasks must have a valid (integer > 0) max_time")
       self.tasks[task.task_id] = task
+      self.metrics.submitted(task, size)
       self.todo_queue.put((now(), task.task_id))
       logging.debug("put_task %s", task)
 
@@ -242,9 +372,88 @@ class QueueServer:
       return False
 
 
-  def get_state(self, proj_id, task_id):
+  def register_worker(self, worker_id, heartbeat_interval):
+    """
+    Called by a worker when it starts.
+
+    Every call a worker makes with its worker_id counts as a heartbeat.
+    While running a task, a worker must call get_state() at least every
+    heartbeat_interval seconds.  If it misses heartbeat_misses of them, it
+    is taken for dead and its task is requeued.
+
+    :param worker_id: Unique id of the worker.
+    :param heartbeat_interval: Seconds between its heartbeats.
+    """
+
+    with self.lock:
+      w = self._seen(worker_id)
+      w['heartbeat_interval'] = heartbeat_interval
+    logging.info("register_worker: %s, heartbeat every %ss", worker_id, heartbeat_interval)
+
+
+  def _seen(self, worker_id):
+    """
+    Note that a worker is alive.  Called with the lock held.
+    """
+    if worker_id is None:
+      return None
+    if worker_id not in self.workers:
+      logging.info("new worker: %s", worker_id)
+      self.workers[worker_id] = dict(task_id=None, completed=0, heartbeat_interval=10, dead=False)
+    w = self.workers[worker_id]
+    if w['dead']:
+      logging.warning("worker %s is back after being taken for dead", worker_id)
+      w['dead'] = False
+    w['last_seen'] = now()
+    return w
+
+
+  def _check_heartbeats(self, forget_after=3600):
+    """
+    Requeue the tasks of workers that have missed their heartbeats.  A task
+    that has used up its tries fails instead, as if it had exceeded
+    max_time.  Called with the lock held.
+
+    :param forget_after: Seconds after which dead workers are dropped from
+    self.workers.
+    """
+
+    t = now()
+    for worker_id, w in self.workers.items():
+      if w['dead']:
+        if t - w['last_seen'] > forget_after:
+          del self.workers[worker_id]
+        continue
+
+      task = self.tasks.get(w['task_id'])
+      if task is None or task.worker_id != worker_id or not _is_running(task):
+        continue
+      if t - w['last_seen'] <= self.heartbeat_misses * w['heartbeat_interval']:
+        continue
+
+      logging.warning("worker %s missed its heartbeats (last seen %.0fs ago), taking it for dead", worker_id, t - w['last_seen'])
+      w['dead'] = True
+      w['task_id'] = None
+
+      if task.proj_id not in self.done_queues:
+        continue
+      if task.tries < task.max_tries:
+        logging.warning("requeueing task %s of dead worker %s", task.task_id, worker_id)
+        self.metrics.retried(task)
+        self.todo_queue.put((now(), task.task_id))
+      else:
+        logging.warning("task %s of dead worker %s has no tries left, failing it", task.task_id, worker_id)
+        task.fail("Worker %s running the task stopped responding" % (worker_id,))
+        self.metrics.finished(task, True)
+        self.done_queues[task.proj_id].put(task)
+        del self.tasks[task.task_id]
+
+
+  def get_state(self, proj_id, task_id, worker_id=None):
     """
     :param task_id:  task_id of the target task
+    :param worker_id: Id of the calling worker, if it is a worker polling on
+    its running task.
 
     :returns: True if the task is queued or running.  False if crashed, done,
     or otherwise unknown
@@ -257,6 +466,7 @@ class QueueServer:
     # currently running processes.
 
     with self.lock:
+      self._seen(worker_id)
       if proj_id not in self.done_queues:
         return False
       if task_id in self.tasks:
@@ -264,17 +474,22 @@ class QueueServer:
       return False
 
 
-  def get_task(self, timeout=None):
+  def get_task(self, timeout=None, worker_id=None):
     """
     Pop a task from the todo_queue, and send it out to be completed.  This
     function is called by idle workers looking for work.
 
+    :param worker_id: Id of the calling worker, for monitoring.  See stats().
+
     :returns: A task to be completed.
     """
 
     if timeout is None:
       timeout = self.get_task_timeout
 
+    with self.lock:
+      self._seen(worker_id)
+
     while True:
       try:
         start_time, task_id = self.todo_queue.get(timeout=timeout)
@@ -327,6 +542,11 @@ class QueueServer:
                           "%s: %s", task.max_time, task_id)
             self.max_time_queue.put((now() + self.tasks[task_id].max_time, task_id))
 
+          self.metrics.started(task)
+          task.worker_id = worker_id
+          w = self._seen(worker_id)
+          if w is not None:
+            w['task_id'] = task_id
           self.tasks[task_id].tries += 1
           logging.debug("get_task: sending %s", task)
           return self.tasks[task_id]
@@ -338,7 +558,7 @@ class QueueServer:
         logging.error("Trying to continue")
         continue
 
-  def put_result(self, task_id, error, result):
+  def put_result(self, task_id, error, result, worker_id=None, profile=None):
     """
     Send the results of a computation back to the server.
 
@@ -348,6 +568,8 @@ class QueueServer:
     :param task_id:    The id of the task being returned
     :param error:    Boolean value, True if an error has occurred.
     :param result:     The result of the computation, or the error message on failure.
+    :param worker_id:  Id of the calling worker.
+    :param profile:    Profile summary of the run, from a profiling worker.
     """
 
     # if error:
@@ -362,7 +584,15 @@ class QueueServer:
     #   else: 
     #     mark job as complete, and put result in done_queues.
 
+    size = request_size() if not error else None
+
     with self.lock:
+      w = self._seen(worker_id)
+      if w is not None:
+        w['completed'] += 1
+        if w['task_id'] == task_id:
+          w['task_id'] = None
+
       if task_id not in self.tasks:
         logging.warning("put_result: Result not expected. (duplicate or"
                         " finished): %s", task_id)
@@ -378,6 +608,7 @@ class QueueServer:
       if error:
         logging.error("put_result: Task threw exception: %s", task)
         if task.tries < task.max_tries:
+          self.metrics.retried(task)
           self.todo_queue.put((now(), task_id))
           logging.error("put_result: Task failed.  Retry immediately.")
           logging.error("put_result: tries = %s, task.max_tries = %s", task.tries,
@@ -391,6 +622,8 @@ class QueueServer:
           # put error in done_queues.
           task.error = True
           task.result = result
+          task.profile = profile
+          self.metrics.finished(task, True)
           # TODO: this only saves most recent error.  Consider adding storage
           # to hold all errors until final return.
           self.done_queues[task.proj_id].put(task)
@@ -398,6 +631,8 @@ class QueueServer:
       else:
         task.error   = False
         task.result  = result
+        task.profile = profile
+        self.metrics.finished(task, False, size)
 
         self.done_queues[task.proj_id].put(task)
         del self.tasks[task_id]
@@ -421,11 +656,20 @@ class QueueServer:
       while True:
         try:
           task = self.done_queues[proj_id].get_nowait()
+          self.metrics.picked_up(task)
           results.append(task)
         except Queue.Empty:
           return results
 
 
+def _is_running(task):
+  """
+  True if the task has been sent to a worker, and has not been requeued
+  since.
+  """
+  return task.start_time is not None and task.queued_time <= task.start_time
+
+
 if __name__ == '__main__':
 
   """Run a server locally."""
@@ -2,13 +2,16 @@ import logging
 import os
 import sys
 import time
+import socket
 import traceback
+import cPickle as pickle
 
 from Queue import Empty
 from multiprocessing import Process, Queue
 
 from rpc_client import RPCClient
 from task import Task
+import profiling
 
 
 # This now forks, and runs the requested program in a separate process.
@@ -17,33 +20,56 @@ from task import Task
 # multiprocessing.Queue, and use that as an interface to the original
 # processes cache.  But is that not general enough?
 
+class _Pickled(str):
+  """
+  A task result pickled in the child process, so the time it takes is part
+  of the profile.
+  """
+  pass
+
+
 class QueueWorker:
 
-  def __init__(self, host, port, instance=None, get_task_timeout=30, get_task_sleep=10, poll_freq=10):
+  def __init__(self, host, port, instance=None, get_task_timeout=30, get_task_sleep=10, poll_freq=10, profile=None):
     """
     A worker that connects to a Queue Server and processes jobs.
 
     :param host: The IP host to connect to.
     :param port: The port to contact the server on.
     :param instance: An object with a set of functions that we will be running on behalf of connecting clients.
+    :param get_task_timeout: Seconds the server waits for a task before get_task() returns.
+    :param poll_freq: Seconds between checks on a running task.  Each check
+    calls get_state() on the server, which is the worker's heartbeat.
+    :param profile: None, or 'phases' to time the named phases of each task
+    (see parallel.profiling), or 'cprofile' to also run cProfile on it.  The
+    summary is sent back with the result, as task.profile.
     """
 
     self.work_queue = RPCClient(host,port)
     self.instance   = instance
 
+    self.get_task_timeout = get_task_timeout
+    self.poll_freq        = poll_freq
+    self.profile          = profile
+
+    # identifies this worker to the server, for monitoring.
+    self.worker_id  = "%s:%d" % (socket.gethostname(), os.getpid())
+
   def run(self):
     """
     Enter a loop connecting to the server to get work, and return results.
     """
 
+    self.work_queue.register_worker(self.worker_id, self.poll_freq)
+
     while True:
-      task = self.work_queue.get_task(timeout=30)
+      task = self.work_queue.get_task(timeout=self.get_task_timeout, worker_id=self.worker_id)
 
       if isinstance(task, (int, float)):
-        time.sleep(min(task, 30))
+        time.sleep(min(task, self.get_task_timeout))
       else:
         task = self._dispatch(task)
-        self.work_queue.put_result(task.task_id, task.error, task.result)
+        self.work_queue.put_result(task.task_id, task.error, task.result, worker_id=self.worker_id, profile=task.profile)
 
 
   def _dispatch(self, task):
@@ -82,23 +108,32 @@ class QueueWorker:
       # This queue will be used to communicate the result from the child process.
       Q = Queue()
 
-      # A local wrapper around the task function.
-      def proc_run(q, f, args, kwargs):
+      # A local wrapper around the task function.  It sends back (result or
+      # exception, profile summary or None).
+      def proc_run(q, f, args, kwargs, profile):
+        if profile:
+          profiling.enable(use_cprofile=(profile == 'cprofile'))
         try:
           res = f(*args, **kwargs)
-          q.put(res)
+          if profile:
+            with profiling.phase('pickle_result'):
+              res = _Pickled(pickle.dumps(res, 2))
         except Exception as e:
-          q.put(e)
+          res = e
+        q.put((res, profiling.disable() if profile else None))
 
-      proc = Process(target=proc_run, args=(Q, instance, task.args, task.kwargs))
+      proc = Process(target=proc_run, args=(Q, instance, task.args, task.kwargs, self.profile))
       proc.start()
       start_time = time.time()
 
       while True:
         try:
-          res = Q.get(timeout=10)
+          res, task.profile = Q.get(timeout=self.poll_freq)
           proc.join()
 
+          if isinstance(res, _Pickled):
+            res = pickle.loads(res)
+
           if isinstance(res, Exception):
             logging.error("task failed with exception, re-raising")
             raise res
@@ -114,7 +149,7 @@ class QueueWorker:
 
           # Check to see if the result is still needed by the
           # server, or if another worker has finished it.
-          state = self.work_queue.get_state(task.proj_id, task.task_id)
+          state = self.work_queue.get_state(task.proj_id, task.task_id, worker_id=self.worker_id)
 
           if not state:
             proc.terminate()
@@ -13,6 +13,38 @@ import logging
 
 # TODO: This should be rewritten using Tornado or something similar.
 
+# size of the request being dispatched, per handler thread.
+_request = threading.local()
+
+
+def request_size():
+  """
+  :returns: The size in bytes of the pickled request being dispatched on
+  this thread, or None outside of a request.
+  """
+  return getattr(_request, 'size', None)
+
+
+class _CountingReader:
+  """
+  Wraps a file, and counts the bytes read from it.
+  """
+
+  def __init__(self, f):
+    self.f = f
+    self.count = 0
+
+  def read(self, *args):
+    s = self.f.read(*args)
+    self.count += len(s)
+    return s
+
+  def readline(self, *args):
+    s = self.f.readline(*args)
+    self.count += len(s)
+    return s
+
+
 class RPCHandler(SocketServer.StreamRequestHandler):
   """
   Connection object that communicates with a RPCClient object.
@@ -27,19 +59,24 @@ class RPCHandler(SocketServer.StreamRequestHandler):
     it and returning results.
     """
     self.server.increment_active_connections()
+    rfile = _CountingReader(self.rfile)
     while True:
 
+      rfile.count = 0
       try:
-        data = pickle.load(self.rfile)
+        data = pickle.load(rfile)
       except EOFError:
         # EOF means we're done with this request.
         break
+      _request.size = rfile.count
       try:
         result = self.server._dispatch(data)
       except Exception, e:
         pickle.dump(('ERR', e), self.wfile, protocol=2)
       else:
         pickle.dump(('OK', result), self.wfile, protocol=2)
+      finally:
+        _request.size = None
 
     self.server.decrement_active_connections()
 
@@ -3,15 +3,17 @@ import os
 import sys
 import uuid
 import logging
+import atexit
+import threading
 from multiprocessing import Process
 
 from rpc_client import RPCClient
 from task import Task
+import profiling
 
 
-# TODO: Look at the Executor class available in Python 3.2+ for interface ideas.
-# http://docs.python.org/dev/library/concurrent.futures.html#concurrent.futures.Executor
-# original source from PEP: http://code.google.com/p/pythonfutures/source/browse/concurrent/futures/
+# See executor.TomoMinerExecutor for a concurrent.futures style interface on
+# top of a Runner.
 
 class Runner:
 
@@ -21,6 +23,11 @@ class Runner:
     are sent to the server.  A new project is created for the duration of
     this objects lifecycle.
 
+    A Runner may be used from several threads at once, e.g. the one
+    returned by get_runner().  Calls on the connection are serialized, and
+    since the server returns the results of a project all together, results
+    of tasks submitted by other threads are held for them.
+
     :param host: RPCServer IP address
     :param port: RPCServer port
     """
@@ -30,13 +37,90 @@ class Runner:
     self.proj_id = str(uuid.uuid4())
     self.work_queue.new_project(self.proj_id)
 
+    self.lock = threading.RLock()
+    # ids of the submitted tasks that have not been returned to a caller.
+    self.active  = set()
+    # results received for tasks waited on by other threads.
+    self.pending = {}
+    # profiles of the returned tasks, by method, from profiling workers.
+    self.profiles = {}
+
   def __del__(self):
     """
     When we are done, delete our project from the remove server, so it will
     not hold any more jobs or results on the server.
     """
-    self.work_queue.del_project(self.proj_id)
-    del self.work_queue
+    if hasattr(self, 'lock'):
+      self.close()
+
+  def close(self):
+    """
+    Delete the project on the server, and close the connection.
+    """
+    with self.lock:
+      if self.work_queue is None:
+        return
+      try:
+        self.work_queue.del_project(self.proj_id)
+      finally:
+        self.work_queue = None
+
+  def _put_tasks(self, tasks):
+    with self.lock:
+      self.active.update(t.task_id for t in tasks)
+      self.work_queue.put_tasks(tasks)
+
+  def _collect(self, task_ids):
+    """
+    Fetch the finished tasks of the project from the server.
+
+    :param task_ids: Ids of the tasks the caller is waiting for.
+    :returns: The results of those tasks that have arrived.  Other results
+    are kept for the threads waiting on them.
+    """
+    with self.lock:
+      for res in self.work_queue.get_results(self.proj_id):
+        if getattr(res, 'profile', None) is not None:
+          self.profiles[res.method] = profiling.merge(self.profiles.get(res.method), res.profile)
+        if res.task_id in self.active:
+          self.pending[res.task_id] = res
+        else:
+          # from a previous run that got cancelled?
+          # or a timed out job?
+          logging.warning("recieved result from an unknown task: %s", (res,))
+      return [self.pending.pop(t) for t in task_ids if t in self.pending]
+
+  def _done(self, task_id):
+    """
+    Stop tracking a task: its result was returned, or nobody waits for it
+    any more.
+    """
+    with self.lock:
+      self.active.discard(task_id)
+      self.pending.pop(task_id, None)
+
+  def cancel(self, task_ids):
+    """
+    Cancel tasks on the server, and stop tracking them.  Their results, if
+    they are already done, are dropped.
+    """
+    with self.lock:
+      for task_id in task_ids:
+        try:
+          self.work_queue.cancel_task(task_id)
+        except Exception:
+          logging.warning("could not cancel task %s", task_id)
+        self._done(task_id)
+
+  def take_profiles(self):
+    """
+    :returns: The profile summaries of the tasks returned since the last
+    call, added up by method.  Empty unless the workers run with profiling
+    on (tm_worker --profile).
+    """
+    with self.lock:
+      profiles, self.profiles = self.profiles, {}
+    return profiles
 
   def make_task(self, method, *args, **kwargs):
 
@@ -54,10 +138,10 @@ class Runner:
     while tries <= max_retry:
 
       tries += 1
-      self.work_queue.put_task(task)
+      self._put_tasks([task])
 
       while True:
-        results = self.work_queue.get_results(self.proj_id)
+        results = self._collect([task.task_id])
 
         # If the job is not complete, wait and try again.
         if not results:
@@ -65,19 +149,16 @@ class Runner:
           logging.debug("run_single: No results yet")
           continue
 
-        # Otherwise we should have a list with a single element.  The
-        # result we are waiting on.
-        for res in results:
-          if res.task_id != task.task_id:
-            logging.warn("run_single got the wrong task back: %s", res)
-            continue
-          if res.error:
-            if tries >= max_retry:
-              raise Exception(res.error_msg)
-          else:
-            logging.debug("run_single: returning %s", res)
-            return res
-        time.sleep(1)
+        res = results[0]
+        if res.error:
+          if tries >= max_retry:
+            self._done(task.task_id)
+            raise Exception(res.error_msg)
+          break
+        else:
+          self._done(task.task_id)
+          logging.debug("run_single: returning %s", res)
+          return res
 
     raise Exception("run_single: should never reach this point")
 
@@ -104,47 +185,46 @@ class Runner:
       task_dict[t.task_id] = t
       state[t.task_id] = max_retry
       logging.debug("sending task %s to queue", (t.task_id,t.method))
-    self.work_queue.put_tasks(tasks)
-
-    while len(state):
-      logging.debug("%s tasks out to workers", len(state))
+    self._put_tasks(tasks)
 
-      results = self.work_queue.get_results(self.proj_id)
+    # a caller that stops early (or an error) leaves tasks that nobody will
+    # wait for.
+    try:
+      while len(state):
+        logging.debug("%s tasks out to workers", len(state))
 
-      for res in results:
+        results = self._collect(state.keys())
 
-        if res.task_id not in state:
-          # from a previous run that got cancelled?
-          # or a timed out job?
-          logging.warning("recieved result from an unknown task: %s", (res,))
-          continue
+        for res in results:
 
-        # What to do in case of an error running a task.
-        if res.error:
-          logging.error("result %s, contains error flag.  task raised exception remotely: %s", res.task_id, res)
-          logging.error("error in result %s:", (dict(proj_id = res.proj_id, task_id = res.task_id, method=res.method, args = res.args, kwargs = res.kwargs, result = res.result, error = res.error),))
-          # Reduce the number of times we will rerun it.
-          state[res.task_id] -= 1
-          # Resubmit the task if we are allowed to retry.
-          if state[res.task_id] > 0:
-            logging.warning("resubmitting crashed task: %s", res.task_id)
-            self.work_queue.put_task(task_dict[res.task_id])
-          else:
-            # Panic!  The task failed, and we have retried the maximum number of times.  So we exit.
-            logging.error("task failed too many times: %s", res)
-            raise Exception
-
-        # iterate over the results.
-        del state[res.task_id]
-        yield res
-
-      # TODO: if we attempt to resubmit jobs taht are active, we need to
-      # make sure they are not going to be competing for resources, or
-      # overwriting each others results.  Currently for instance,
-      # multiple attempts to run a volume averaging may cause issues if
-      # multiple instances are writing the same file.  In this case, a
-      # reader application may attempt to read while a later running
-      # version is rewriting the file and get bad data.
+          # What to do in case of an error running a task.
+          if res.error:
+            logging.error("result %s, contains error flag.  task raised exception remotely: %s", res.task_id, res)
+            logging.error("error in result %s:", (dict(proj_id = res.proj_id, task_id = res.task_id, method=res.method, args = res.args, kwargs = res.kwargs, result = res.result, error = res.error),))
+            # Reduce the number of times we will rerun it.
+            state[res.task_id] -= 1
+            # Resubmit the task if we are allowed to retry.
+            if state[res.task_id] > 0:
+              logging.warning("resubmitting crashed task: %s", res.task_id)
+              self._put_tasks([task_dict[res.task_id]])
+              continue
+            else:
+              # Panic!  The task failed, and we have retried the maximum number of times.  So we exit.
+              logging.error("task failed too many times: %s", res)
+              raise Exception
+
+          # iterate over the results.
+          del state[res.task_id]
+          self._done(res.task_id)
+          yield res
+
+        # TODO: if we attempt to resubmit jobs taht are active, we need to
+        # make sure they are not going to be competing for resources, or
+        # overwriting each others results.  Currently for instance,
+        # multiple attempts to run a volume averaging may cause issues if
+        # multiple instances are writing the same file.  In this case, a
+        # reader application may attempt to read while a later running
+        # version is rewriting the file and get bad data.
 
 
 #      # when task queue (pending tasks) is empty, re-assign those tasks to idle workers.
@@ -157,7 +237,41 @@ class Runner:
 #          self.work_queue.put_task(task_dict[task_id])
 
 
-      time.sleep(1)
+        time.sleep(1)
+    finally:
+      for task_id in state:
+        self._done(task_id)
+
+
+_shared_runners = {}
+_shared_lock = threading.Lock()
+
+def get_runner(host, port):
+  """
+  The Runner shared by all callers in this process for the given server.
+  The runner functions use it so that a pipeline keeps a single connection
+  and project, instead of opening and deleting one per call.  A forked
+  child process gets its own.
+
+  :param host: RPCServer IP address
+  :param port: RPCServer port
+  """
+
+  key = (host, port, os.getpid())
+  with _shared_lock:
+    if key not in _shared_runners:
+      _shared_runners[key] = Runner(host, port)
+    return _shared_runners[key]
+
+@atexit.register
+def _close_shared_runners():
+  for key, runner in _shared_runners.items():
+    if key[2] == os.getpid():
+      try:
+        runner.close()
+      except Exception:
+        pass
+  _shared_runners.clear()
 
 
 if __name__ == '__main__':
@@ -6,6 +6,6 @@ from queue_server import QueueServer
 
 class Server(RPCServer, QueueServer):
 
-  def __init__(self, addr, timeout_thread_interval=30, get_task_timeout=30):
-    QueueServer.__init__(self, timeout_thread_interval, get_task_timeout) #, self)
+  def __init__(self, addr, timeout_thread_interval=30, get_task_timeout=30, metrics_window=300, heartbeat_misses=3, heartbeat_check_interval=5):
+    QueueServer.__init__(self, timeout_thread_interval, get_task_timeout, metrics_window, heartbeat_misses, heartbeat_check_interval) #, self)
     RPCServer.__init__(self, addr)
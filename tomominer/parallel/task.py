@@ -77,6 +77,19 @@ class Task(object):
     """ Total time spent waiting for the project owner to pick up finished
     tasks.  """
 
+    self.queued_time  = None
+    self.start_time   = None
+    self.finish_time  = None
+    """ Server clock times at which the task was last put in the todo_queue,
+    sent to a worker, and finished.  Set by the server's TaskMetrics. """
+
+    self.worker_id = None
+    """ The worker the task was last sent to, if it identified itself. """
+
+    self.profile = None
+    """ Profile summary of the run, if the worker was profiling.  See
+    tomominer.parallel.profiling. """
+
   def fail(self, msg=""):
     """
     This function is called in the event of an error or an exception, with
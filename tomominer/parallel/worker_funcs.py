@@ -0,0 +1,22 @@
+
+def map_chunk(method, args_list):
+  """
+  Call a worker function on each of a list of argument tuples, in one task.
+  Used by TomoMinerExecutor.map() with chunksize > 1.
+
+  :param method: Worker function name, as given to Runner.make_task(), e.g.
+  'align.align'.
+  :param args_list: List of argument tuples.
+
+  :returns: List of the results, in order.
+  """
+
+  from tomominer.parallel import funcs
+
+  f = funcs
+  for p in method.split('.'):
+    if p.startswith('_'):
+      raise ValueError("method starts with underscore: %s" % (method,))
+    f = getattr(f, p)
+
+  return [f(*args) for args in args_list]